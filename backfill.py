@@ -0,0 +1,132 @@
+import asyncio
+import io
+import urllib.error
+import urllib.request
+
+import pandas as pd
+from datahandler import DataHandler
+
+CSSE_DAILY_REPORTS_URL = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/' \
+                         'csse_covid_19_daily_reports/'
+
+
+class DailyReportBackfill:
+
+    def __init__(self, db, base_url=CSSE_DAILY_REPORTS_URL, concurrency=8, retries=3, batch_size=30):
+        """
+        :param db: Database the reports are loaded into
+        :param base_url: URL of the directory with the MM-DD-YYYY.csv daily reports
+        :param concurrency: Maximum number of reports downloaded at the same time
+        :param retries: Number of retries of a failed download
+        :param batch_size: Number of reports upserted in one transaction
+        """
+        self.db = db
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = 1.0  # Seconds before the first retry, doubled on each further retry
+        self.batch_size = batch_size
+        self.timeout = 60
+        self.total_table = db.deaths_table
+        self.change_table = db.deaths_change_python_table
+        self.metric = 'deaths'
+
+    def run(self, start_date, end_date):
+        """
+        Loads the daily reports from start_date to end_date into the totals table and updates the affected daily
+        changes. Reports loaded by an earlier run are skipped. The matrix exports are refreshed if the database has
+        an export directory
+
+        :param start_date: Date of the first report
+        :param end_date: Date of the last report
+        :return: Dict with the number of loaded reports, the dates of missing reports and the number of changed rows
+        """
+        return asyncio.run(self.run_async(start_date, end_date))
+
+    async def run_async(self, start_date, end_date):
+        """
+        Coroutine of run, for callers that already run an event loop
+        """
+        self.db.create_data_table(self.total_table, self.metric)
+        self.db.create_data_table(self.change_table, self.metric + '_change')
+        self.db.create_ingest_times_table(self.total_table)
+
+        done = self.db.get_backfilled_dates(self.total_table)
+        dates = [date for date in pd.date_range(start_date, end_date, freq='D') if date not in done]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self._fetch_report(semaphore, date)) for date in dates]
+
+        summary = {'loaded': 0, 'missing': [], 'changed_rows': 0}
+        batch = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                date, report_df = await task
+                if report_df is None:
+                    summary['missing'].append(date)
+                    continue
+                batch.append((date, report_df))
+                if len(batch) >= self.batch_size:
+                    summary['changed_rows'] += self._write(batch)
+                    summary['loaded'] += len(batch)
+                    batch = []
+            if batch:
+                summary['changed_rows'] += self._write(batch)
+                summary['loaded'] += len(batch)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        summary['missing'].sort()
+        if self.db.export_dir is not None and summary['loaded'] > 0:
+            self.db.export_matrix(self.total_table)
+            self.db.export_matrix(self.change_table)
+        return summary
+
+    async def _fetch_report(self, semaphore, date):
+        """
+        Downloads and normalizes the daily report of a date, retrying failed downloads with exponential backoff
+
+        :param semaphore: Semaphore that bounds the number of concurrent downloads
+        :param date: Date of the report
+        :return: Tuple with the date and the normalized report, or None if the report does not exist
+        """
+        url = self.base_url + date.strftime('%m-%d-%Y') + '.csv'
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    content = await asyncio.to_thread(self._download, url)
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code == 404:
+                        return date, None
+                    if attempt == self.retries:
+                        raise
+                except (urllib.error.URLError, TimeoutError, ConnectionError):
+                    if attempt == self.retries:
+                        raise
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+        report_df = pd.read_csv(io.BytesIO(content))
+        return date, DataHandler().get_total_deaths_from_daily_report(report_df, date, self.metric)
+
+    def _download(self, url):
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read()
+
+    def _write(self, batch):
+        """
+        Upserts a batch of normalized reports, updates the daily changes they affect and records the reports as
+        loaded, all in one transaction
+
+        :param batch: List of (date, normalized report) tuples
+        :return: The number of changed totals rows
+        """
+        totals_df = pd.concat([report_df for _, report_df in batch], ignore_index=True)
+        with self.db.transaction():
+            changed_rows = sum(self.db.bulk_upsert_to_table(totals_df, self.total_table))
+            # Only the rows that no later ingest time supersedes were upserted, see Database.last_upserted
+            self.db.update_change_table(self.total_table, self.change_table)
+            self.db.mark_backfilled(self.total_table, [date for date, _ in batch])
+        return changed_rows
+
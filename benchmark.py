@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from datahandler import DataHandler
+from db import Database
+import testutils
+
+# (countries, provinces per country, dates) of the default run. The global CSSE file is about 200 x 1 x 1100
+DEFAULT_SIZES = [(50, 2, 100), (200, 3, 1000), (1000, 5, 1000)]
+
+STAGES = ['transform', 'daily_change', 'diff', 'first_insert', 'full_upsert', 'incremental_upsert', 'sql_refresh']
+
+
+class Benchmark:
+
+    def __init__(self, sizes=None, correction_share=0.01, engine='pandas', seed=0, trace_memory=True):
+        """
+        :param sizes: List of (countries, provinces per country, dates) sizes of the synthetic data
+        :param correction_share: Share of the cells in the revision window that are corrected retrospectively before
+            the upserts
+        :param engine: Engine of the DataHandler transforms, 'pandas' or 'numpy'
+        :param seed: Seed of the synthetic data
+        :param trace_memory: Whether to measure the peak memory of the stages in a second, traced run
+        """
+        self.sizes = sizes if sizes is not None else DEFAULT_SIZES
+        self.correction_share = correction_share
+        self.engine = engine
+        self.seed = seed
+        self.trace_memory = trace_memory
+        self.threshold = 1.5  # A stage regresses when it takes this many times its baseline
+        self.min_seconds = 0.05  # Differences below this are timer noise, never regressions
+
+    def run(self):
+        """
+        Runs all stages for each size
+
+        :return: Dict with the run environment and one result per size, see run_size
+        """
+        return {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'engine': self.engine,
+                'correction_share': self.correction_share,
+                'results': [self.run_size(*size) for size in self.sizes]}
+
+    def run_size(self, countries, provinces, dates):
+        """
+        Runs the stages of a sync on synthetic data: the transform to the vertical table, the daily change, the diff
+        against the corrected data, the first insert into an empty database, the upsert of the corrections by the
+        default full compare and by the incremental sync, and the refresh of the SQL daily change table. The
+        corrections fall into the revision window, so the incremental sync has to apply all of them.
+        tracemalloc slows down the traced code, so the stages are timed untraced and their peak memory is measured
+        in a second run on fresh databases
+
+        :param countries: Number of countries
+        :param provinces: Number of provinces per country
+        :param dates: Number of dates
+        :return: Dict with the size and the wall time, CPU time and, if traced, peak memory of each stage
+        """
+        stages = {}
+        rows, changed_rows = self._run_stages(stages, False, countries, provinces, dates)
+        if self.trace_memory:
+            self._run_stages(stages, True, countries, provinces, dates)
+        return {'countries': countries, 'provinces': provinces, 'dates': dates, 'rows': rows,
+                'changed_rows': changed_rows, 'stages': stages}
+
+    def _run_stages(self, stages, traced, countries, provinces, dates):
+        """
+        Runs the stages of run_size once on fresh databases
+
+        :param stages: Dict the measures of each stage are recorded in
+        :param traced: Whether to record the peak memory instead of the times
+        :return: Tuple with the number of rows and of corrected rows
+        """
+        dh = DataHandler()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with Database(os.path.join(tmp_dir, 'full.db')) as full_db, \
+                    Database(os.path.join(tmp_dir, 'incremental.db')) as incremental_db:
+                csv_df = testutils.get_synthetic_data(countries, provinces, dates, seed=self.seed)
+                corrected_csv_df = testutils.get_corrected_data(csv_df, self.correction_share, seed=self.seed,
+                                                                window=incremental_db.revision_window)
+
+                totals_df = self._measure(stages, 'transform', traced, dh.get_total_deaths_per_country_and_day,
+                                          csv_df, engine=self.engine)
+                self._measure(stages, 'daily_change', traced, dh.get_daily_change_of_deaths, totals_df,
+                              engine=self.engine)
+                corrected_df = dh.get_total_deaths_per_country_and_day(corrected_csv_df, engine=self.engine)
+                changed_rows = self._measure(stages, 'diff', traced, dh.get_changed_rows, corrected_df, totals_df)
+
+                for db in (full_db, incremental_db):
+                    db.create_total_deaths_table()
+                self._measure(stages, 'first_insert', traced, full_db.insert_to_deaths_total_table, totals_df)
+                self._measure(stages, 'full_upsert', traced, full_db.insert_to_deaths_total_table, corrected_df)
+
+                incremental_db.insert_to_deaths_total_table(totals_df, incremental=True)
+                incremental_db.rebuild_deaths_change_sql_table()
+                applied = self._measure(stages, 'incremental_upsert', traced,
+                                        incremental_db.insert_to_deaths_total_table, corrected_df, incremental=True)
+                if applied != len(changed_rows):
+                    raise RuntimeError('The incremental upsert applied ' + str(applied) + ' of ' +
+                                       str(len(changed_rows)) + ' corrected rows')
+                self._measure(stages, 'sql_refresh', traced, incremental_db.refresh_deaths_change_sql_table)
+
+        return len(totals_df), len(changed_rows)
+
+    def _measure(self, stages, name, traced, func, *args, **kwargs):
+        """
+        Calls a stage function and records either its wall time and CPU time, or its peak traced memory in
+        stages[name]
+
+        :return: Return value of the function
+        """
+        measures = stages.setdefault(name, {})
+        if not traced:
+            wall, cpu = time.perf_counter(), time.process_time()
+            result = func(*args, **kwargs)
+            measures['seconds'] = round(time.perf_counter() - wall, 4)
+            measures['cpu_seconds'] = round(time.process_time() - cpu, 4)
+            return result
+
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            measures['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+        return result
+
+    def check_regressions(self, results, baseline):
+        """
+        Compares a run with a baseline run. Sizes, stages or peak memory missing from either run are not compared
+
+        :param results: Dict returned by run
+        :param baseline: Dict returned by an earlier run
+        :return: List of messages, one per stage whose time or peak memory exceeds threshold times the baseline
+        """
+        baseline_sizes = {(r['countries'], r['provinces'], r['dates']): r['stages'] for r in baseline['results']}
+        regressions = []
+        for result in results['results']:
+            size = (result['countries'], result['provinces'], result['dates'])
+            for stage, measures in result['stages'].items():
+                base = baseline_sizes.get(size, {}).get(stage)
+                if base is None:
+                    continue
+                if measures['seconds'] > base['seconds'] * self.threshold and \
+                        measures['seconds'] - base['seconds'] > self.min_seconds:
+                    regressions.append(stage + ' ' + str(size) + ': ' + str(measures['seconds']) + ' s, baseline ' +
+                                       str(base['seconds']) + ' s')
+                if 'peak_mb' not in measures or 'peak_mb' not in base:
+                    continue
+                if measures['peak_mb'] > base['peak_mb'] * self.threshold and measures['peak_mb'] - base['peak_mb'] > 1:
+                    regressions.append(stage + ' ' + str(size) + ': ' + str(measures['peak_mb']) + ' MB, baseline ' +
+                                       str(base['peak_mb']) + ' MB')
+        return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sync stages on synthetic data')
+    parser.add_argument('--size', action='append', nargs=3, type=int, metavar=('COUNTRIES', 'PROVINCES', 'DATES'),
+                        help='Size of the synthetic data, repeatable. Defaults to ' + str(DEFAULT_SIZES))
+    parser.add_argument('--corrections', type=float, default=0.01, help='Share of retrospectively corrected cells')
+    parser.add_argument('--engine', choices=['pandas', 'numpy'], default='pandas')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.5, help='Allowed slowdown factor against the baseline')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced run that measures peak memory')
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark([tuple(size) for size in args.size] if args.size else None, args.corrections, args.engine,
+                          trace_memory=not args.no_memory)
+    benchmark.threshold = args.threshold
+    results = benchmark.run()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for result in results['results']:
+        print(str((result['countries'], result['provinces'], result['dates'])) + ' ' + str(result['rows']) + ' rows')
+        for stage in STAGES:
+            measures = result['stages'][stage]
+            print('  ' + stage.ljust(20) + str(measures['seconds']).rjust(10) + ' s' +
+                  (str(measures['peak_mb']).rjust(10) + ' MB' if 'peak_mb' in measures else ''))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = benchmark.check_regressions(results, json.load(f))
+        for regression in regressions:
+            print('Regression: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+import pandas as pd
+
+# Rows submitted for a data table, with the daily change table to update along with it, if any
+ChangeSet = namedtuple('ChangeSet', ['data', 'table_name', 'change_table', 'ingested_at', 'future'])
+
+
+class WriteCoordinator:
+
+    def __init__(self, db, max_queue=64, max_batch_rows=500000):
+        """
+        :param db: Database the change sets are written to. Only the writer thread of this object writes to it
+        :param max_queue: Number of change sets waiting to be written. submit blocks while the queue is full
+        :param max_batch_rows: Number of submitted rows the writer collects into one transaction
+        """
+        self.db = db
+        self.max_batch_rows = max_batch_rows
+        self.batches = 0  # Transactions written
+        self.rows_submitted = 0
+        self.rows_written = 0  # Rows left after coalescing and dropping the rows superseded in the database
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer = None
+        self._submit_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        """
+        Starts the writer thread
+
+        :return:
+        """
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name='WriteCoordinator', daemon=True)
+            self._writer.start()
+
+    def submit(self, data_df, table_name, change_table=None, ingested_at=None, timeout=None):
+        """
+        Queues rows for the writer. Producers may call this from any thread. Processes submit through their parent,
+        e.g. as the Pipeline workers return their blocks
+
+        :param data_df: Data frame with country, date and value columns
+        :param table_name: Name of the data table
+        :param change_table: Daily change table updated for the rows, if table_name is a totals table
+        :param ingested_at: Ingest time of the rows. Of two rows of the same country and date, the one with the later
+            ingest time is kept, whatever the order of the submissions. The ingest times are stored in the database,
+            so this holds across restarts and for every coordinator writing to it. Defaults to now
+        :param timeout: Seconds to wait while the queue is full. Waits until there is room if None
+        :return: Future that is resolved when the rows are committed, or fails with the error of their transaction
+        """
+        ingested_at = pd.Timestamp.now(tz='UTC') if ingested_at is None else pd.Timestamp(ingested_at)
+        ingested_at = ingested_at.tz_localize('UTC') if ingested_at.tzinfo is None else ingested_at.tz_convert('UTC')
+        future = Future()
+        self._queue.put(ChangeSet(data_df, table_name, change_table, ingested_at, future), timeout=timeout)
+        with self._submit_lock:
+            self.rows_submitted += len(data_df)
+        return future
+
+    def flush(self):
+        """
+        Waits until all submitted change sets are written
+
+        :return:
+        """
+        self.start()
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes the remaining change sets and stops the writer thread
+
+        :return:
+        """
+        self.start()
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, rows = [], 0
+            item = self._queue.get()
+            while item is not None:
+                batch.append(item)
+                rows += len(item.data)
+                if rows >= self.max_batch_rows:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                stopping = True
+                self._queue.task_done()
+
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        """
+        Coalesces a batch of change sets per table and writes them in one transaction
+
+        :param batch: List of ChangeSet
+        :return:
+        """
+        groups = OrderedDict()
+        for change_set in batch:
+            groups.setdefault((change_set.table_name, change_set.change_table), []).append(change_set)
+
+        try:
+            written = 0
+            with self.db.transaction():
+                for (table_name, change_table), change_sets in groups.items():
+                    data_df, ingested_at = self._coalesce(change_sets)
+                    self.db.create_ingest_times_table(table_name)
+                    self.db.bulk_upsert_to_table(data_df, table_name, ingested_at)
+                    # The rows left after dropping the ones superseded in the database
+                    data_df = self.db.last_upserted[table_name]
+                    if change_table is not None:
+                        self.db.update_change_table(table_name, change_table, data_df)
+                    written += len(data_df)
+        except Exception as e:
+            for change_set in batch:
+                change_set.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.rows_written += written
+        for change_set in batch:
+            change_set.future.set_result(None)
+
+    def _coalesce(self, change_sets):
+        """
+        Keeps the row with the latest ingest time of each country and date in a batch. Rows written earlier are
+        compared by the database, see Database.create_ingest_times_table
+
+        :param change_sets: Change sets of one table
+        :return: Tuple with the coalesced rows and their ingest times as UTC text
+        """
+        data_df = pd.concat([change_set.data for change_set in change_sets], ignore_index=True)
+        ingested_at = pd.Series(pd.DatetimeIndex([change_set.ingested_at for change_set in change_sets]).repeat(
+            [len(change_set.data) for change_set in change_sets]))
+
+        order = ingested_at.sort_values(kind='stable').index
+        data_df, ingested_at = data_df.loc[order], ingested_at.loc[order]
+        latest = ~data_df.duplicated(list(data_df.columns.values[:2]), keep='last').values
+        return data_df[latest].reset_index(drop=True), \
+            ingested_at[latest].dt.strftime('%Y-%m-%d %H:%M:%S.%f').values
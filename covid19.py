@@ -0,0 +1,229 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+# The data modules import pandas, so they are imported by the subcommands that need them and 'covid19 --help' or a
+# failing argument check stays fast
+
+
+class Daemon:
+
+    def __init__(self, db, pipeline, interval=3600, trigger_file=None):
+        """
+        :param db: Database kept open between syncs, so its connections and page cache stay warm
+        :param pipeline: Pipeline run on each sync. It skips the files whose content the database already holds
+        :param interval: Seconds between scheduled syncs
+        :param trigger_file: Path of a file whose creation triggers a sync, e.g. by 'touch'. It is removed when the
+            sync starts
+        """
+        self.db = db
+        self.pipeline = pipeline
+        self.interval = interval
+        self.trigger_file = trigger_file
+        self.poll_interval = 1.0  # Seconds between checks of the trigger file
+        self.last_results = None
+        self.last_sync = None
+        self._triggered = threading.Event()
+        self._stopped = threading.Event()
+
+    def sync(self):
+        """
+        Runs the pipeline once
+
+        :return: Dict with the number of changed totals and change rows per series name
+        """
+        started = time.perf_counter()
+        self.last_results = self.pipeline.run()
+        self.last_sync = time.time()
+        print('Synced in ' + format(time.perf_counter() - started, '.3f') + ' s: ' + format_results(self.last_results),
+              flush=True)
+        return self.last_results
+
+    def trigger(self):
+        """
+        Requests a sync as soon as possible, e.g. from a signal handler
+
+        :return:
+        """
+        self._triggered.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._triggered.set()
+
+    def run(self):
+        """
+        Syncs at once, then on every interval and on every trigger until stop is called
+
+        :return:
+        """
+        self._sync_safely()
+        next_sync = time.monotonic() + self.interval
+        while not self._stopped.is_set():
+            self._triggered.wait(min(self.poll_interval, max(next_sync - time.monotonic(), 0)))
+            if self._stopped.is_set():
+                break
+            if self.trigger_file is not None and os.path.exists(self.trigger_file):
+                os.remove(self.trigger_file)
+                self._triggered.set()
+            if self._triggered.is_set() or time.monotonic() >= next_sync:
+                self._triggered.clear()
+                self._sync_safely()
+                next_sync = time.monotonic() + self.interval
+
+    def _sync_safely(self):
+        """
+        Runs a sync and reports its error instead of raising it. A failed sync, e.g. a network error at startup, must
+        not end the daemon. The next sync retries
+
+        :return:
+        """
+        try:
+            self.sync()
+        except Exception as e:
+            print('Sync failed: ' + type(e).__name__ + ': ' + str(e), file=sys.stderr, flush=True)
+
+
+def format_results(results):
+    return ', '.join(name + ' ' + str(totals) + '/' + str(changes) for name, (totals, changes) in results.items())
+
+
+def create_pipeline(db, args):
+    """
+    :param db: Database the series are synced to
+    :param args: Parsed arguments of the sync or daemon subcommand
+    :return: Pipeline of the selected series with a SnapshotCache
+    """
+    from fetcher import SnapshotCache
+    from pipeline import CSSE_SERIES, Pipeline, Series
+
+    series = {s.name: s for s in CSSE_SERIES}
+    names = args.series or ['deaths']
+    unknown = [name for name in names if name not in series]
+    if unknown:
+        raise ValueError('Unknown series ' + str(unknown) + '. Choose from ' + str(list(series)))
+    selected = [series[name] for name in names]
+    if args.source is not None:
+        if len(selected) != 1:
+            raise ValueError('--source needs exactly one --series')
+        selected = [Series(selected[0].name, selected[0].metric, args.source)]
+
+    return Pipeline(db, series=selected, max_workers=args.workers, cache=SnapshotCache(args.cache_dir))
+
+
+def sync(args):
+    from db import Database
+
+    with Database(args.db) as db:
+        db.export_dir = args.export_dir
+        results = create_pipeline(db, args).run()
+    print('Changed rows (totals/changes): ' + format_results(results))
+    return 0
+
+
+def backfill(args):
+    from backfill import CSSE_DAILY_REPORTS_URL, DailyReportBackfill
+    from db import Database
+
+    with Database(args.db) as db:
+        db.export_dir = args.export_dir
+        summary = DailyReportBackfill(db, args.base_url or CSSE_DAILY_REPORTS_URL, concurrency=args.concurrency,
+                                      batch_size=args.batch_size).run(args.start_date, args.end_date)
+    print('Loaded ' + str(summary['loaded']) + ' reports, ' + str(summary['changed_rows']) + ' changed rows, ' +
+          str(len(summary['missing'])) + ' missing reports')
+    return 0
+
+
+def query(args):
+    from db import Database
+
+    with Database(args.db) as db:
+        if args.what == 'country':
+            if args.country is None:
+                raise ValueError('query country needs --country')
+            result = db.get_country_series(args.country, args.table, args.start_date, args.end_date).reset_index()
+        elif args.what == 'range':
+            result = db.get_date_range(args.start_date, args.end_date, args.table)
+        elif args.what == 'top':
+            result = db.get_top_countries(args.n, args.date, args.table)
+        else:
+            result = db.get_global_totals(args.table).reset_index()
+
+    if args.format == 'csv':
+        result.to_csv(sys.stdout, index=False)
+    else:
+        print(result.to_string(index=False))
+    return 0
+
+
+def daemon(args):
+    from db import Database
+
+    with Database(args.db) as db:
+        db.export_dir = args.export_dir
+        service = Daemon(db, create_pipeline(db, args), interval=args.interval, trigger_file=args.trigger_file)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: service.trigger())
+        signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='covid19', description='Sync and query the COVID-19 time series database')
+    parser.add_argument('--db', default='Covid19.db', help='SQLite database file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_sync_arguments(subparser):
+        subparser.add_argument('--series', action='append', help='Series to sync, repeatable. Defaults to deaths')
+        subparser.add_argument('--source', help='Path or URL of the csv file of the only --series')
+        subparser.add_argument('--cache-dir', default='.snapshot_cache', help='Directory of the snapshot cache')
+        subparser.add_argument('--workers', type=int, help='Number of worker processes')
+        subparser.add_argument('--export-dir', help='Directory of the matrix exports refreshed after each sync')
+
+    add_sync_arguments(subparsers.add_parser('sync', help='Sync the time series files once'))
+
+    backfill_parser = subparsers.add_parser('backfill', help='Load the daily reports between two dates')
+    backfill_parser.add_argument('start_date', help='Date of the first report, e.g. 2020-01-22')
+    backfill_parser.add_argument('end_date', help='Date of the last report')
+    backfill_parser.add_argument('--base-url', help='URL of the daily reports directory')
+    backfill_parser.add_argument('--concurrency', type=int, default=8)
+    backfill_parser.add_argument('--batch-size', type=int, default=30)
+    backfill_parser.add_argument('--export-dir', help='Directory of the matrix exports refreshed after the backfill')
+
+    query_parser = subparsers.add_parser('query', help='Print data from the database')
+    query_parser.add_argument('what', choices=['country', 'range', 'top', 'global'])
+    query_parser.add_argument('--country')
+    query_parser.add_argument('--table', help='Data table. Defaults to the table of the query')
+    query_parser.add_argument('--start-date')
+    query_parser.add_argument('--end-date')
+    query_parser.add_argument('--date', help='Date of the top query. The last date if omitted')
+    query_parser.add_argument('-n', type=int, default=10, help='Number of countries of the top query')
+    query_parser.add_argument('--format', choices=['table', 'csv'], default='table')
+
+    daemon_parser = subparsers.add_parser('daemon', help='Keep the database open and sync on a schedule or trigger')
+    add_sync_arguments(daemon_parser)
+    daemon_parser.add_argument('--interval', type=float, default=3600, help='Seconds between syncs')
+    daemon_parser.add_argument('--trigger-file', help='File whose creation triggers a sync. SIGHUP triggers too')
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    commands = {'sync': sync, 'backfill': backfill, 'query': query, 'daemon': daemon}
+    try:
+        return commands[args.command](args)
+    except ValueError as e:
+        print('covid19: ' + str(e), file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
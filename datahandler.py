@@ -1,17 +1,337 @@
+import numpy as np
 import pandas as pd
+import pandas.api.types as ptypes
 import re
 
 
 class DataHandler:
 
-    def get_total_deaths_per_country_and_day(self, csv_as_df):
+    def get_total_deaths_per_country_and_day(self, csv_as_df, engine='pandas', metric='deaths'):
         """
         Converts the horizontally growing csv table to a vertically growing RDBMS friendly table with one 'date' column
 
         :param csv_as_df: DataFrame loaded from the csv file
+        :param engine: 'pandas' to group and melt the data frame, 'numpy' to aggregate a countries x dates matrix
+        :param metric: Name of the value column, e.g. 'confirmed' for the confirmed cases time series
         :return: DataFrame with one row per each Country and Date.
         """
+        if engine == 'numpy':
+            return self.matrix_to_frame(*self.get_deaths_matrix(csv_as_df), value_name=metric)
 
+        country_col, date_cols = self._get_country_and_date_columns(csv_as_df)
+
+        stats_df = csv_as_df[[country_col] + date_cols]
+        stats_df = stats_df.rename(columns={country_col: 'country'})  # use a short name for country
+
+        stats_df = stats_df.groupby('country', as_index=False).sum()  # sum of deaths of all states in a country
+        dates = self._parse_date_headers(date_cols)  # parse each header once, not once per melted row
+        stats_df = pd.melt(stats_df, id_vars=['country'], var_name='date', value_name=metric)  # arrange vertically
+        stats_df['date'] = dates.repeat(len(stats_df) // len(dates)) if len(dates) else dates
+
+        return stats_df
+
+    def get_total_deaths_from_daily_report(self, report_df, report_date, metric='deaths'):
+        """
+        Converts a CSSE daily report, one row per province or county on a single day, to the vertically growing table
+        of get_total_deaths_per_country_and_day. The report schema changed over time, e.g. 'Country/Region' became
+        'Country_Region', so the columns are found by name pattern
+
+        :param report_df: DataFrame loaded from a daily report csv file
+        :param report_date: Date of the report
+        :param metric: Name of the value column, matched case insensitively against the report columns
+        :return: DataFrame with one row per Country for the report date
+        """
+        country_col = [col for col in report_df.columns.values if re.match('[cC]ountry', col)]
+        value_col = [col for col in report_df.columns.values if col.lower() == metric]
+        if len(country_col) != 1 or len(value_col) != 1:
+            raise ValueError("Cannot determine the country and " + metric + " columns of the daily report. Found " +
+                             str(country_col + value_col))
+
+        stats_df = report_df[[country_col[0], value_col[0]]]
+        stats_df = stats_df.rename(columns={country_col[0]: 'country', value_col[0]: metric})
+        stats_df[metric] = stats_df[metric].fillna(0).astype('int64')
+
+        stats_df = stats_df.groupby('country', as_index=False).sum()
+        stats_df.insert(1, 'date', pd.Timestamp(report_date))
+        return stats_df
+
+    def get_deaths_matrix(self, csv_as_df):
+        """
+        Sums the deaths of all states in a country into a countries x dates matrix. The date headers are parsed once
+        and the provinces are aggregated with a single np.add.reduceat over the rows sorted by country
+
+        :param csv_as_df: DataFrame loaded from the csv file
+        :return: Tuple with the sorted country names, the DatetimeIndex of dates and the deaths matrix
+        """
+        country_col, date_cols = self._get_country_and_date_columns(csv_as_df)
+
+        dates = self._parse_date_headers(date_cols)
+        values = csv_as_df[date_cols].to_numpy()
+        if values.dtype.kind == 'f':
+            values = np.nan_to_num(values)  # groupby sum skips missing values
+
+        countries, matrix = self._sum_by_country(csv_as_df[country_col].to_numpy(dtype=object), values)
+        return countries, dates, matrix
+
+    def read_csv_dates(self, csv_source):
+        """
+        Reads only the header of the csv file and parses its date columns
+
+        :param csv_source: Path, URL or seekable file object of the csv file
+        :return: DatetimeIndex of the dates in the file
+        """
+        _, date_cols = self._get_country_and_date_columns(self._read_csv(csv_source, nrows=0))
+        return self._parse_date_headers(date_cols)
+
+    def read_deaths_matrix(self, csv_source, since=None, chunksize=1000, date_chunksize=None, value_dtype='int32',
+                           until=None):
+        """
+        Streams the csv file into a countries x dates matrix without loading the whole table. The header is read
+        first, then only the country column and the date columns after 'since' are parsed, with compact dtypes. Rows
+        are read in chunks of 'chunksize' and summed per country as they arrive, and a file with many dates can be
+        read in blocks of 'date_chunksize' columns, one pass over the file per block
+
+        :param csv_source: Path, URL or seekable file object of the csv file
+        :param since: Only dates after this date are read, e.g. the database watermark. All dates if None
+        :param until: Only dates up to and including this date are read. All dates if None
+        :param chunksize: Number of rows per chunk. The whole file at once if None
+        :param date_chunksize: Number of date columns per pass. All date columns in one pass if None
+        :param value_dtype: Dtype of the returned matrix. Integer dtypes are parsed as float64, so a blank cell reads
+            as 0, and each chunk is cast to the dtype before it is summed, so the sums must fit in it
+        :return: Tuple with the sorted country names, the DatetimeIndex of dates and the deaths matrix
+        """
+        country_col, date_cols = self._get_country_and_date_columns(self._read_csv(csv_source, nrows=0))
+
+        dates = self._parse_date_headers(date_cols)
+        selected = np.ones(len(dates), dtype=bool)
+        if since is not None:
+            selected &= dates > pd.Timestamp(since)
+        if until is not None:
+            selected &= dates <= pd.Timestamp(until)
+        date_cols, dates = [col for col, keep in zip(date_cols, selected) if keep], dates[selected]
+
+        step = date_chunksize or max(len(date_cols), 1)
+        blocks = [date_cols[start:start + step] for start in range(0, len(date_cols), step)] or [[]]
+        countries, matrices = None, []
+        for block in blocks:
+            countries, matrix = self._read_column_block(csv_source, country_col, block, chunksize, value_dtype)
+            matrices.append(matrix)
+
+        return countries, dates, np.hstack(matrices)
+
+    def _read_column_block(self, csv_source, country_col, date_cols, chunksize, value_dtype):
+        """
+        Reads the country column and a block of date columns of the csv file in row chunks, and sums them per country
+
+        :param csv_source: Path, URL or seekable file object of the csv file
+        :param country_col: Name of the country column
+        :param date_cols: Names of the date columns to read
+        :param chunksize: Number of rows per chunk. The whole file at once if None
+        :param value_dtype: Dtype of the returned matrix
+        :return: Tuple with the sorted country names and their deaths matrix
+        """
+        # A blank cell cannot be parsed as an integer, so integer columns are parsed as floats, whose 53 bit mantissa
+        # holds any count exactly, and the blanks are read as 0 below. The nullable integer dtypes are much slower
+        parse_dtype = 'float64' if np.dtype(value_dtype).kind in 'iu' else value_dtype
+        dtypes = dict.fromkeys(date_cols, parse_dtype)
+        dtypes[country_col] = object
+        chunks = self._read_csv(csv_source, usecols=[country_col] + date_cols, dtype=dtypes, chunksize=chunksize)
+        if chunksize is None:
+            chunks = [chunks]
+
+        countries, matrix = np.empty(0, dtype=object), np.zeros((0, len(date_cols)), dtype=value_dtype)
+        for chunk in chunks:
+            countries, matrix = self._sum_by_country(
+                np.concatenate([countries, chunk[country_col].to_numpy(dtype=object)]),
+                np.vstack([matrix, np.nan_to_num(chunk[date_cols].to_numpy()).astype(value_dtype)]))
+        return countries, matrix
+
+    def _read_csv(self, csv_source, **kwargs):
+        """
+        Reads the csv file from its start, so a file object can be read more than once
+
+        :param csv_source: Path, URL or seekable file object of the csv file
+        :return: Result of pd.read_csv
+        """
+        if hasattr(csv_source, 'seek'):
+            csv_source.seek(0)
+        return pd.read_csv(csv_source, **kwargs)
+
+    def _sum_by_country(self, country_values, values):
+        """
+        Sums the rows of a matrix that belong to the same country with a single np.add.reduceat
+
+        :param country_values: Country name of each row
+        :param values: Matrix with one row per province
+        :return: Tuple with the sorted country names and the matrix with one row per country
+        """
+        countries, country_ids = np.unique(country_values, return_inverse=True)
+        if len(countries) == 0:
+            return countries, values
+
+        order = np.argsort(country_ids, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(country_ids[order]) != 0])
+        return countries, np.add.reduceat(values[order], starts, axis=0, dtype=values.dtype)
+
+    def get_daily_change_matrix(self, matrix):
+        """
+        Calculates the daily change along the dates axis of a countries x dates matrix. The change on the first day
+        is the value of that day
+
+        :param matrix: Total deaths matrix
+        :return: Deaths change matrix
+        """
+        return np.diff(matrix, axis=1, prepend=0).astype(int)
+
+    def matrix_to_frame(self, countries, dates, matrix, value_name):
+        """
+        Melts a countries x dates matrix into the vertically growing table, with all countries of the first date
+        followed by all countries of the next date
+
+        :param countries: Country names of the matrix rows
+        :param dates: Dates of the matrix columns
+        :param matrix: Countries x dates matrix
+        :param value_name: Name of the value column
+        :return: DataFrame with one row per each Country and Date
+        """
+        return pd.DataFrame({'country': np.tile(np.asarray(countries, dtype=object), len(dates)),
+                             'date': np.repeat(np.asarray(dates, dtype='M8[ns]'), len(countries)),
+                             value_name: matrix.T.ravel()})
+
+    def frame_to_matrix(self, data_df, value_col):
+        """
+        Scatters the vertically growing table into a countries x dates matrix, the inverse of matrix_to_frame. A
+        country without a row on a date counts as 0 on that date, as before its first report
+
+        :param data_df: Data frame with country, date and value columns
+        :param value_col: Name of the value column
+        :return: Tuple with the sorted country names, the DatetimeIndex of sorted dates and the matrix
+        """
+        country_ids, countries = pd.factorize(data_df['country'], sort=True)
+        date_ids, dates = pd.factorize(self._to_datetime(data_df['date']), sort=True)
+
+        matrix = np.zeros((len(countries), len(dates)), dtype='int64')
+        matrix[country_ids, date_ids] = data_df[value_col].to_numpy()
+        return np.asarray(countries, dtype=object), pd.DatetimeIndex(dates), matrix
+
+    def get_analytics_lookback(self, windows=(7, 14)):
+        """
+        :param windows: Rolling mean windows in days
+        :return: Number of dates before the first analytics date that get_rolling_analytics reads. Week-over-week
+            growth compares two 7 day windows, so at least 14
+        """
+        return max(max(windows), 14)
+
+    def get_rolling_analytics(self, countries, dates, matrix, since=None, windows=(7, 14), metric='deaths'):
+        """
+        Calculates rolling means of the daily change, week-over-week growth and doubling time for all countries at
+        once. The daily changes are summed once along the dates axis, so every window sum is the difference of two
+        cumulative sums. Only the dates after since are calculated, from the lookback dates before them
+
+        :param countries: Country names of the matrix rows
+        :param dates: Dates of the matrix columns, one column per day
+        :param matrix: Countries x dates total deaths matrix
+        :param since: Only dates after this date are returned. All dates if None
+        :param windows: Rolling mean windows in days
+        :param metric: Name of the totals column. The analytics columns are named metric + '_avg_7',
+            metric + '_wow_growth' etc.
+        :return: DataFrame with one row per each Country and Date after since. Values that are undefined, e.g. a mean
+            over fewer days than the window or the growth from a week without deaths, are NaN
+        """
+        dates = pd.DatetimeIndex(dates)
+        start = 0 if since is None else int((dates <= pd.Timestamp(since)).sum())
+        first = max(start - self.get_analytics_lookback(windows), 0)
+        totals = np.asarray(matrix[:, first:], dtype='int64')
+
+        # cumulative[:, k] is the sum of the first k daily changes of the slice
+        changes = self.get_daily_change_matrix(totals)
+        cumulative = np.zeros((totals.shape[0], totals.shape[1] + 1), dtype='int64')
+        np.cumsum(changes, axis=1, out=cumulative[:, 1:])
+
+        def window_sum(days):
+            sums = np.full(totals.shape, np.nan)
+            if days <= totals.shape[1]:
+                sums[:, days - 1:] = cumulative[:, days:] - cumulative[:, :-days]
+            return sums
+
+        columns = {metric + '_avg_' + str(days): window_sum(days) / days for days in windows}
+
+        this_week, two_weeks = window_sum(7), window_sum(14)
+        last_week = two_weeks - this_week
+        week_ago = np.full(totals.shape, np.nan)
+        week_ago[:, 7:] = totals[:, :-7]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns[metric + '_wow_growth'] = np.where(last_week > 0, this_week / last_week - 1, np.nan)
+            ratio = totals / week_ago
+            columns[metric + '_doubling_days'] = np.where(ratio > 1, 7 * np.log(2) / np.log(ratio), np.nan)
+
+        offset = start - first
+        analytics_df = self.matrix_to_frame(countries, dates[start:], totals[:, offset:], value_name=metric)
+        for name, values in columns.items():
+            analytics_df[name] = values[:, offset:].T.ravel()
+        return analytics_df.drop(columns=metric)
+
+    def get_daily_change_of_deaths(self, df_total_deaths, engine='pandas', metric='deaths'):
+        """
+        Calculates the daily change of deaths for each country
+
+        :param df_total_deaths: Total deaths data frame
+        :param engine: 'pandas' for a grouped diff, 'numpy' to scatter the rows into a countries x dates matrix and
+            diff along the dates axis. The numpy engine needs exactly one row per country and date and falls back to
+            pandas otherwise
+        :param metric: Name of the value column. The change column is named metric + '_change'
+        :return: DataFrame showing change of deaths per day for each country
+        """
+        if engine == 'numpy':
+            changes_df = self._get_daily_change_of_deaths_from_matrix(df_total_deaths, metric)
+            if changes_df is not None:
+                return changes_df
+
+        sorted_df = df_total_deaths.sort_values(['country', 'date'], ascending=[True, True], inplace=False)
+
+        # Calculate difference between rows in each Country slice
+        diffs = sorted_df.groupby(['country'])[metric].diff()
+        diffs.loc[diffs.isna()] = sorted_df.loc[diffs.isna(), metric]  # Replace nans with original value
+        changes_df = sorted_df.rename(columns={metric: metric + '_change'})
+        changes_df.loc[:, metric + '_change'] = diffs.astype(int)
+        return changes_df
+
+    def _get_daily_change_of_deaths_from_matrix(self, df_total_deaths, metric):
+        """
+        Numpy engine of get_daily_change_of_deaths. The rows keep their index labels and come out sorted by country
+        and date, as in the pandas engine
+
+        :param df_total_deaths: Total deaths data frame
+        :param metric: Name of the value column
+        :return: DataFrame showing change of deaths per day for each country, None if the rows are not a complete
+            countries x dates grid
+        """
+        country_ids, countries = pd.factorize(df_total_deaths['country'], sort=True)
+        date_ids, dates = pd.factorize(df_total_deaths['date'], sort=True)
+        n_cells = len(countries) * len(dates)
+        if len(df_total_deaths) != n_cells or (country_ids < 0).any() or (date_ids < 0).any():
+            return None
+        cells = country_ids * len(dates) + date_ids
+        if np.bincount(cells, minlength=n_cells).max(initial=0) > 1:
+            return None  # Duplicated country and date pairs
+
+        matrix = np.empty(len(cells), dtype=df_total_deaths[metric].dtype)
+        matrix[cells] = df_total_deaths[metric].to_numpy()
+        labels = np.empty(len(cells), dtype=df_total_deaths.index.dtype)
+        labels[cells] = df_total_deaths.index.to_numpy()
+
+        changes = self.get_daily_change_matrix(matrix.reshape(len(countries), len(dates)))
+        return pd.DataFrame({'country': np.repeat(np.asarray(countries, dtype=object), len(dates)),
+                             'date': np.tile(np.asarray(dates, dtype='M8[ns]'), len(countries)),
+                             metric + '_change': changes.ravel()}, index=labels)
+
+    def _get_country_and_date_columns(self, csv_as_df):
+        """
+        Finds the country column and the date columns of the csv table
+
+        :param csv_as_df: DataFrame loaded from the csv file
+        :return: Tuple with the country column name and the list of date column names
+        """
         csv_cols = csv_as_df.columns.values
 
         # Regex selects the column names that start with the term 'Country'
@@ -24,30 +344,57 @@ class DataHandler:
         # Regex selects the column names that look like a date
         date_cols = [col for col in csv_cols if re.match('(?:[0-9]{1,2}/){1,2}[0-9]{2}', col)]
 
-        stats_df = csv_as_df[country_col + date_cols]
-        stats_df = stats_df.rename(columns={country_col[0]: 'country'})  # use a short name for country
+        return country_col[0], date_cols
 
-        stats_df = stats_df.groupby('country', as_index=False).sum()  # sum of deaths of all states in a country
-        stats_df = pd.melt(stats_df, id_vars=['country'], var_name='date', value_name='deaths')  # arrange vertically
-        stats_df.loc[:, 'date'] = pd.to_datetime(stats_df['date'], infer_datetime_format=True)
+    def get_daily_change_of_deaths_incremental(self, changed_totals_df, stored_totals_df, metric='deaths'):
+        """
+        Calculates the daily change of deaths only for the rows affected by new or revised total deaths rows. A
+        revised total changes the change of its own day and of the following day, so the stored rows directly before
+        and after each changed row are needed to seed the calculation
 
-        return stats_df
+        :param changed_totals_df: New or revised total deaths rows
+        :param stored_totals_df: Stored total deaths rows directly before and after the changed rows of each country.
+            Stale values of the changed rows are ignored
+        :param metric: Name of the value column. The change column is named metric + '_change'
+        :return: DataFrame with the changed rows and the rows following them, sorted by country and date
+        """
+        changed_df = changed_totals_df[['country', 'date', metric]].assign(changed=True)
+        stored_df = stored_totals_df[['country', 'date', metric]].assign(changed=False)
+        stored_df['date'] = self._to_datetime(stored_df['date'])
+
+        totals_df = pd.concat([stored_df, changed_df], ignore_index=True)
+        totals_df = totals_df.drop_duplicates(['country', 'date'], keep='last')  # changed rows replace stored ones
+        totals_df = totals_df.sort_values(['country', 'date']).reset_index(drop=True)
+
+        diffs = totals_df.groupby('country')[metric].diff()
+        diffs.loc[diffs.isna()] = totals_df.loc[diffs.isna(), metric]  # First day of a country's history
+        follows_change = totals_df.groupby('country')['changed'].shift(fill_value=False).astype(bool)
 
-    def get_daily_change_of_deaths(self, df_total_deaths):
+        changes_df = totals_df.rename(columns={metric: metric + '_change'})
+        changes_df[metric + '_change'] = diffs.astype(int)
+        affected = (totals_df['changed'] | follows_change).values
+        return changes_df.loc[affected, ['country', 'date', metric + '_change']].reset_index(drop=True)
+
+    def get_day_numbers(self, dates):
         """
-        Calculates the daily change of deaths for each country
+        Converts dates to integer day numbers, the number of days since 1970-01-01
 
-        :param df_total_deaths: Total deaths data frame
-        :return: DataFrame showing change of deaths per day for each country
+        :param dates: Series of dates
+        :return: int32 array of day numbers
         """
-        sorted_df = df_total_deaths.sort_values(['country', 'date'], ascending=[True, True], inplace=False)
+        return self._to_datetime(dates).values.astype('datetime64[D]').astype('int32')
 
-        # Calculate difference between rows in each Country slice
-        diffs = sorted_df.groupby(['country'])['deaths'].diff()
-        diffs.loc[diffs.isna()] = sorted_df.loc[diffs.isna(), 'deaths']  # Replace nans with original value
-        changes_df = sorted_df.rename(columns={'deaths': 'deaths_change'})
-        changes_df.loc[:, 'deaths_change'] = diffs.astype(int)
-        return changes_df
+    def get_compact_frame(self, data_df):
+        """
+        Converts a total deaths or deaths change data frame to the compact dtypes of the compact database schema
+
+        :param data_df: Total deaths or deaths change data frame
+        :return: DataFrame with categorical country, int32 day and int32 value columns
+        """
+        compact_df = pd.DataFrame({'country': data_df['country'].astype('category').values,
+                                   'day': self.get_day_numbers(data_df['date'])}, index=data_df.index)
+        compact_df[data_df.columns.values[2]] = data_df.iloc[:, 2].values.astype('int32')
+        return compact_df
 
     def get_changed_rows(self, new_df, curr_df):
         """
@@ -56,8 +403,87 @@ class DataHandler:
         :param curr_df: Data currently in the database
         :return: List of changed row numbers in new_df
         """
-        new_df.reset_index(drop=True, inplace=True)
-        curr_df.loc[:, 'date'] = pd.to_datetime(curr_df.loc[:, 'date'], infer_datetime_format=True)
-        diff = new_df[~new_df.isin(curr_df)]
-        indices = diff.loc[~diff.iloc[:, 2].isna()].index
-        return indices
+        inserted, updated, _ = self.get_row_changes(new_df, curr_df)
+        return pd.Index(np.sort(np.concatenate([inserted, updated])))
+
+    def get_row_changes(self, new_df, curr_df):
+        """
+        Splits the rows of new_df into inserted, updated and unchanged rows compared to curr_df. Rows are matched on
+        their (country, date) key through 64 bit hashes of the key and value columns, so the row order of either
+        data frame does not matter
+
+        :param new_df: New data frame from the repository
+        :param curr_df: Data currently in the database
+        :return: Tuple of arrays with the inserted, updated and unchanged row numbers in new_df
+        """
+        new_keys, new_values = self._hash_rows(new_df)
+        curr_keys, curr_values = self._hash_rows(curr_df)
+
+        matches = pd.Index(curr_keys).get_indexer(new_keys)  # -1 where the key is not in curr_df
+        found = matches >= 0
+        unchanged = found.copy()
+        unchanged[found] = new_values[found] == curr_values[matches[found]]
+
+        return np.flatnonzero(~found), np.flatnonzero(found & ~unchanged), np.flatnonzero(unchanged)
+
+    def _hash_rows(self, data_df):
+        """
+        Hashes the (country, date) key and the value column of each data row
+
+        :param data_df: Total deaths or deaths change data frame
+        :return: Tuple of uint64 arrays with the key hashes and the value hashes
+        """
+        dates = self._to_datetime(data_df.iloc[:, 1])
+        keys = pd.util.hash_pandas_object(pd.DataFrame({'country': data_df.iloc[:, 0].values, 'date': dates.values}),
+                                          index=False).values
+        values = pd.util.hash_array(self._to_common_dtype(data_df.iloc[:, 2].values))
+        return keys, values
+
+    def get_checksum_per_country(self, data_df):
+        """
+        Calculates an order independent checksum of the date and value columns of each country's data rows
+
+        :param data_df: Total deaths or deaths change data frame
+        :return: Series of signed 64 bit checksums indexed by country
+        """
+        hashed_df = pd.DataFrame({'date': data_df.iloc[:, 1].values,
+                                  'value': self._to_common_dtype(data_df.iloc[:, 2].values)})
+        hashes = pd.util.hash_pandas_object(hashed_df, index=False).values
+        checksums = pd.Series(hashes, index=data_df['country'].values).groupby(level=0).sum()  # wraps around 2**64
+        return checksums.astype('int64')
+
+    def _to_common_dtype(self, values):
+        """
+        Casts a value column to float64 before it is hashed, since hashes depend on the dtype: a float64 column read
+        from a csv file with a blank cell must match the int64 values stored in the database, and int32 values their
+        int64 equal. float64 holds every count below 2**53 exactly
+
+        :param values: Array of values
+        :return: float64 array
+        """
+        return np.asarray(values).astype('float64', copy=False)
+
+    def _parse_date_headers(self, date_cols):
+        """
+        Parses the date column headers with an explicit format. Inferring the format falls back to dateutil for
+        headers like '1/22/20', which parses every header separately
+
+        :param date_cols: Date column headers of a csv file, e.g. '1/22/20'
+        :return: DatetimeIndex of the dates
+        """
+        headers = pd.Index(date_cols)
+        try:
+            return pd.to_datetime(headers, format='%m/%d/%y')
+        except ValueError:
+            return pd.to_datetime(headers, format='%m/%d/%Y')
+
+    def _to_datetime(self, dates):
+        """
+        Converts dates read back from the database, where they are stored as text, to datetime
+
+        :param dates: Series of dates
+        :return: Series of datetime dates
+        """
+        if ptypes.is_datetime64_any_dtype(dates):
+            return dates
+        return pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S')
@@ -1,14 +1,75 @@
+import csv
+import glob
+import io
+import itertools
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+import metrics
+import numpy as np
 import pandas as pd
 from datahandler import DataHandler
+from fileutils import write_atomic
 
 
 class Database:
 
-    def __init__(self, dbname):
+    def __init__(self, dbname, compact=False):
         self.db = dbname
+        self.compact = compact  # Store the data tables with integer country ids and day numbers, see create_*_table
         self.deaths_table = 'deaths_total'
         self.deaths_change_python_table = 'deaths_change_python'
+        self.deaths_change_sql_table = 'deaths_change_sql'
+        self.watermark_table = 'sync_watermark'
+        self.countries_table = 'countries'
+        self.backfill_table = 'backfill_progress'
+        self.source_table = 'sync_source'
+        self.deaths_analytics_table = 'deaths_analytics'
+        self.revision_window = 14  # Days before the last synced date in which CSSE may backfill corrections
+        self.upsert_batch_size = 50000  # Rows per executemany call when filling the staging table
+        # UPDATE ... FROM needs SQLite 3.33. Older versions apply the bulk upsert with INSERT ... ON CONFLICT
+        self.update_from = sqlite3.sqlite_version_info >= (3, 33, 0)
+        self.pragmas = {
+            'journal_mode': 'WAL',  # Readers are not blocked while a sync writes
+            'synchronous': 'NORMAL',  # With WAL, fsync only at checkpoints
+            'cache_size': -65536,  # 64 MiB page cache
+            'mmap_size': 268435456,  # 256 MiB memory mapped I/O
+            'temp_store': 'MEMORY',  # Staging tables stay in memory
+            'busy_timeout': 30000,  # Milliseconds a writer of another process waits for the lock before failing
+        }
+        self.cached_statements = 256  # Prepared statements kept per connection
+        self.reader_pool_size = 4
+        self.last_upserted = {}  # Rows passed to the latest bulk upsert of each table
+        self.data_version = 0  # Bumped by every committed transaction that changed rows
+        self.query_cache_size = 128  # Results kept by the cached query API
+        self.export_dir = None  # Directory of the matrix exports refreshed after each sync, see export_matrix
+
+        self._con = None
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._tx_changes = 0
+        self._readers = queue.LifoQueue(maxsize=self.reader_pool_size)
+        self._version_con = None
+        self._cache_lock = threading.Lock()
+        self._query_cache = OrderedDict()
+        self._cache_version = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def create_connection(self):
         """
@@ -18,18 +79,139 @@ class Database:
         """
         con = None
         try:
-            con = sqlite3.connect(self.db)
+            con = sqlite3.connect(self.db, check_same_thread=False, cached_statements=self.cached_statements,
+                                  factory=metrics.Connection)
+            for pragma, value in self.pragmas.items():
+                con.execute('PRAGMA ' + pragma + '=' + str(value) + ';')
         except sqlite3.Error as e:
             print(e)
         return con
 
+    def get_connection(self):
+        """
+        Returns the long-lived connection owned by this object, opening it on first use. Transactions on it are
+        managed explicitly through transaction()
+
+        :return: Connection to the database
+        """
+        with self._lock:
+            if self._con is None:
+                self._con = self.create_connection()
+                self._con.isolation_level = None
+            return self._con
+
+    @contextmanager
+    def transaction(self, write=True):
+        """
+        Runs the enclosed statements in one transaction on the long-lived connection. Nested blocks join the outer
+        transaction, which commits once when the outermost block exits and rolls back if it raises. A write
+        transaction takes the write lock when it begins: a deferred transaction that reads before it writes cannot
+        wait for the writer of another process under WAL and fails with 'database is locked', while BEGIN IMMEDIATE
+        waits for up to busy_timeout. A read transaction is deferred, so it reads while another process writes
+
+        :param write: Whether the outermost block writes. A read block may only write with its first statement
+        :return: Connection to the database
+        """
+        with self._lock:
+            con = self.get_connection()
+            if self._tx_depth == 0:
+                con.execute('BEGIN IMMEDIATE;' if write else 'BEGIN;')
+                self._tx_changes = con.total_changes
+            self._tx_depth += 1
+            try:
+                yield con
+            except BaseException:
+                if self._tx_depth == 1 and con.in_transaction:
+                    con.rollback()
+                raise
+            else:
+                if self._tx_depth == 1 and con.in_transaction:
+                    con.commit()
+                    if con.total_changes != self._tx_changes:
+                        self.data_version += 1
+            finally:
+                self._tx_depth -= 1
+
+    @contextmanager
+    def _temp_store(self, mode):
+        """
+        Switches the temp_store pragma of the writer connection for the enclosed block, e.g. to 'FILE' so large
+        staging tables and sorts spill to temporary files instead of growing in memory. SQLite cannot switch it
+        inside a transaction, so within one the block keeps the current setting
+
+        :param mode: 'DEFAULT', 'FILE' or 'MEMORY'
+        :return:
+        """
+        with self._lock:
+            con = self.get_connection()
+            if con.in_transaction:
+                yield
+                return
+            previous = con.execute('PRAGMA temp_store;').fetchone()[0]
+            con.execute('PRAGMA temp_store=' + mode + ';')
+            try:
+                yield
+            finally:
+                con.execute('PRAGMA temp_store=' + str(previous) + ';')
+
+    @contextmanager
+    def reader(self):
+        """
+        Borrows a read-only connection from a small pool, so queries can run while a sync holds the writer
+        connection. An in-memory database is private to one connection, so the writer connection is used instead
+
+        :return: Connection to the database
+        """
+        if self.db == ':memory:':
+            with self.transaction() as con:
+                yield con
+            return
+
+        try:
+            con = self._readers.get_nowait()
+        except queue.Empty:
+            con = self.create_connection()
+            con.isolation_level = None  # No implicit transaction that would pin an old snapshot
+            con.execute('PRAGMA query_only=ON;')
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            try:
+                self._readers.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+    def close(self):
+        """
+        Closes the long-lived connection and the pooled reader connections
+
+        :return:
+        """
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+        with self._cache_lock:
+            if self._version_con is not None:
+                self._version_con.close()
+                self._version_con = None
+            self._query_cache.clear()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
     def execute_query(self, sql):
         """
-        Executes an SQL query and returns the result
+        Executes an SQL query and returns the result. It runs in a deferred transaction, so a read does not wait for
+        the writer of another process
         :param sql: SQL query
         :return: Query result
         """
-        with self.create_connection() as con:
+        with self.transaction(write=False) as con:
             cursor = con.cursor()
             cursor.execute(sql)
             result = cursor.fetchall()
@@ -42,39 +224,357 @@ class Database:
 
         :return:
         """
-        with self.create_connection() as con:
+        self.create_data_table(self.deaths_table, 'deaths')
+
+    def create_deaths_change_python_table(self):
+        """
+        Creates a table named 'deaths_change_python' in the database with country, date and deaths_change as columns.
+        The composite primary keys are country and date
+
+        :return:
+        """
+        self.create_data_table(self.deaths_change_python_table, 'deaths_change')
+
+    def create_data_table(self, table_name, value_col):
+        """
+        Creates a data table with country, date and value_col as columns, e.g. 'confirmed_total' with a 'confirmed'
+        column. The composite primary keys are country and date
+
+        :param table_name: Name of the table
+        :param value_col: Name of the value column
+        :return:
+        """
+        if self.compact:
+            return self._create_compact_table(table_name, value_col)
+
+        with self.transaction() as con:
             cursor = con.cursor()
-            cursor.execute('CREATE TABLE IF NOT EXISTS deaths_total ( \
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + ' ( \
                                country TEXT, \
                                date DATE, \
-                               deaths INT, \
+                               ' + value_col + ' INT, \
                                PRIMARY KEY (country, date));'
                            )
-            con.commit()
 
-    def create_deaths_change_python_table(self):
+    def _create_compact_table(self, table_name, value_col):
         """
-        Creates a table named 'deaths_change_python' in the database with country, date and deaths_change as columns.
-        The composite primary keys are country and date
+        Creates the compact form of a data table: a clustered WITHOUT ROWID table named table_name + '_compact' with
+        integer country_id, day (days since 1970-01-01) and value columns, the 'countries' dimension table, and a
+        view named table_name with the country, date and value columns of the regular table
 
+        :param table_name: Name of the regular table
+        :param value_col: Name of the value column
         :return:
         """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS countries ( \
+                               country_id INTEGER PRIMARY KEY, \
+                               country TEXT NOT NULL UNIQUE);'
+                           )
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + '_compact ( \
+                               country_id INT, \
+                               day INT, \
+                               ' + value_col + ' INT, \
+                               PRIMARY KEY (country_id, day)) WITHOUT ROWID;'
+                           )
+            cursor.execute('CREATE VIEW IF NOT EXISTS ' + table_name + ' AS \
+                               SELECT c.country, strftime(\'%Y-%m-%d %H:%M:%S\', d.day * 86400, \'unixepoch\') AS date, \
+                               d.' + value_col + ' \
+                               FROM ' + table_name + '_compact d JOIN countries c ON c.country_id=d.country_id;'
+                           )
+
+    def create_analytics_table(self, table_name, value_cols):
+        """
+        Creates an analytics table with country, date and one REAL column per analytic, e.g. 'deaths_analytics' with
+        'deaths_avg_7' and 'deaths_doubling_days' columns. The composite primary keys are country and date. Analytics
+        tables keep the regular layout in compact mode too
+
+        :param table_name: Name of the table
+        :param value_cols: Names of the analytics columns
+        :return:
+        """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + ' ( \
+                               country TEXT, \
+                               date DATE, \
+                               ' + ', '.join(col + ' REAL' for col in value_cols) + ', \
+                               PRIMARY KEY (country, date));'
+                           )
+
+    def create_deaths_change_sql_table(self):
+        """
+        Creates a table named 'deaths_change_sql' in the database with country, date and deaths_change as columns.
+        The composite primary keys are country and date. The table is derived from deaths_total in SQL, see
+        rebuild_deaths_change_sql_table and refresh_deaths_change_sql_table
 
-        with self.create_connection() as con:
+        :return:
+        """
+        with self.transaction() as con:
             cursor = con.cursor()
-            cursor.execute('CREATE TABLE IF NOT EXISTS deaths_change_python ( \
+            cursor.execute('CREATE TABLE IF NOT EXISTS deaths_change_sql ( \
                                country TEXT, \
                                date DATE, \
                                deaths_change INT, \
                                PRIMARY KEY (country, date));'
                            )
-            con.commit()
 
-    def insert_to_deaths_total_table(self, total_deaths_df):
-        return self._insert_deaths_data(total_deaths_df, self.deaths_table)
+    def create_watermark_table(self):
+        """
+        Creates a table named 'sync_watermark' in the database that keeps a high-water mark per data table and
+        country: the last synced date and a checksum of the rows in the trailing revision window. The composite
+        primary keys are table_name and country
 
-    def insert_to_deaths_change_python_table(self, deaths_change_df):
-        return self._insert_deaths_data(deaths_change_df, self.deaths_change_python_table)
+        :return:
+        """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS sync_watermark ( \
+                               table_name TEXT, \
+                               country TEXT, \
+                               last_date DATE, \
+                               window_checksum INT, \
+                               PRIMARY KEY (table_name, country));'
+                           )
+
+    def create_backfill_progress_table(self):
+        """
+        Creates a table named 'backfill_progress' in the database that records the daily reports already loaded into
+        each data table, so an interrupted backfill can resume. The composite primary keys are table_name and
+        report_date
+
+        :return:
+        """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS backfill_progress ( \
+                               table_name TEXT, \
+                               report_date DATE, \
+                               PRIMARY KEY (table_name, report_date));'
+                           )
+
+    def create_source_table(self):
+        """
+        Creates a table named 'sync_source' in the database that records the content hash of the source file last
+        ingested into each data table, so a database skips the files it already holds whatever cache it is synced
+        through. The primary key is table_name
+
+        :return:
+        """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS sync_source ( \
+                               table_name TEXT PRIMARY KEY, \
+                               source TEXT, \
+                               content_hash TEXT, \
+                               ingested_at TEXT);'
+                           )
+
+    def create_revisions_table(self, table_name):
+        """
+        Starts keeping the revision log of a data table. From then on every upsert to the table appends the values it
+        supersedes to table_name + '_revisions', a WITHOUT ROWID table keyed by country, date and ingested_at, the
+        UTC time of the upsert. Only corrections are logged, so the log stays small. table_name + '_ingests' keeps
+        the time each date was first ingested, so rows of new dates need no log rows. See get_as_of
+
+        :param table_name: Name of the data table
+        :return:
+        """
+        if self.compact:
+            raise ValueError('Revision logs need a Database created with compact=False')
+
+        with self.transaction() as con:
+            cursor = con.cursor()
+            value_col = cursor.execute('SELECT * FROM ' + table_name + ' LIMIT 0;').description[2][0]
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + '_revisions ( \
+                               country TEXT, \
+                               date DATE, \
+                               ingested_at TEXT, \
+                               ' + value_col + ' INT, \
+                               PRIMARY KEY (country, date, ingested_at)) WITHOUT ROWID;'
+                           )
+            cursor.execute('CREATE INDEX IF NOT EXISTS ' + table_name + '_revisions_ingested_at \
+                               ON ' + table_name + '_revisions (ingested_at);')
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + '_ingests ( \
+                               date DATE PRIMARY KEY, \
+                               ingested_at TEXT NOT NULL) WITHOUT ROWID;'
+                           )
+            # The rows already stored count as ingested now, their history is unknown
+            cursor.execute('INSERT OR IGNORE INTO ' + table_name + '_ingests \
+                               SELECT DISTINCT date, ? FROM ' + table_name + ' WHERE true;', (self._now(),))
+
+    def _log_revisions(self, cursor, table_name, value_col, staging='temp.staging'):
+        """
+        Appends the values that the staged rows supersede to the revision log of a table: the stored value of each
+        changed row, and a NULL value for each new row of a date that was ingested before, e.g. a backfilled country
+
+        :param cursor: Cursor of the connection in the current transaction
+        :param table_name: Name of the data table
+        :param value_col: Name of the value column
+        :param staging: Table with the country, date and value_col of the rows about to be upserted
+        :return:
+        """
+        now = self._now()
+        revisions, ingests = table_name + '_revisions', table_name + '_ingests'
+        cursor.execute('INSERT OR IGNORE INTO ' + revisions + ' \
+                           SELECT t.country, t.date, ?, t.' + value_col + ' \
+                           FROM ' + staging + ' s JOIN ' + table_name + ' t ON t.country=s.country AND t.date=s.date \
+                           WHERE t.' + value_col + ' IS NOT s.' + value_col + ';', (now,))
+        cursor.execute('INSERT OR IGNORE INTO ' + revisions + ' \
+                           SELECT s.country, s.date, ?, NULL \
+                           FROM ' + staging + ' s JOIN ' + ingests + ' i ON i.date=s.date \
+                           WHERE NOT EXISTS (SELECT 1 FROM ' + table_name + ' t \
+                               WHERE t.country=s.country AND t.date=s.date);', (now,))
+        cursor.execute('INSERT OR IGNORE INTO ' + ingests + ' SELECT DISTINCT date, ? FROM ' + staging + ' WHERE true;',
+                       (now,))
+
+    def create_ingest_times_table(self, table_name):
+        """
+        Creates table_name + '_ingest_times', a WITHOUT ROWID table that keeps the ingest time of the row of each
+        country and date of a data table. Once it exists, every bulk upsert to the data table records the ingest times
+        of its rows and drops the rows that a stored row with a later ingest time supersedes, so concurrent writers are
+        ordered by ingest time across restarts and processes. The composite primary keys are the keys of the data
+        table, country_id and day in compact mode
+
+        :param table_name: Name of the data table
+        :return:
+        """
+        with self.transaction() as con:
+            cursor = con.cursor()
+            if self._get_compact_table(cursor, table_name) is None:
+                keys = 'country TEXT, date DATE, ingested_at TEXT, PRIMARY KEY (country, date)'
+            else:
+                keys = 'country_id INT, day INT, ingested_at TEXT, PRIMARY KEY (country_id, day)'
+            cursor.execute('CREATE TABLE IF NOT EXISTS ' + table_name + '_ingest_times (' + keys + ') WITHOUT ROWID;')
+
+    def _drop_superseded_rows(self, cursor, table_name, key_cols, staging='temp.staging'):
+        """
+        Deletes the staged rows that a stored row with a later ingest time supersedes, and records the ingest times of
+        the remaining rows in the ingest times table of a data table. Of two rows with the same ingest time, the staged
+        one wins
+
+        :param cursor: Cursor of the connection in the current transaction
+        :param table_name: Name of the data table
+        :param key_cols: Names of the two key columns of the staged rows
+        :param staging: Table with the key columns and an ingested_at column of the rows about to be upserted
+        :return: List of the key tuples of the deleted rows
+        """
+        ingest_times = table_name + '_ingest_times'
+        superseded = 'FROM ' + staging + ' s JOIN ' + ingest_times + ' t ' \
+                     'ON t.' + key_cols[0] + '=s.' + key_cols[0] + ' AND t.' + key_cols[1] + '=s.' + key_cols[1] + ' ' \
+                     'WHERE t.ingested_at > s.ingested_at'
+        keys = cursor.execute('SELECT s.' + key_cols[0] + ', s.' + key_cols[1] + ' ' + superseded + ';').fetchall()
+        if keys:
+            cursor.execute('DELETE FROM ' + staging + ' WHERE rowid IN (SELECT s.rowid ' + superseded + ');')
+        cursor.execute('INSERT INTO ' + ingest_times + ' SELECT ' + ', '.join(key_cols) + ', ingested_at \
+                           FROM ' + staging + ' WHERE true \
+                           ON CONFLICT (' + ', '.join(key_cols) + ') \
+                           DO UPDATE SET ingested_at=excluded.ingested_at \
+                           WHERE excluded.ingested_at >= ingested_at;')
+        return keys
+
+    def get_backfilled_dates(self, table_name):
+        """
+        Reads the dates of the daily reports already loaded into a data table
+
+        :param table_name: Name of the data table
+        :return: Set of report dates as Timestamps
+        """
+        with self.transaction(write=False) as con:
+            cursor = con.cursor()
+            rows = []
+            if self._table_exists(cursor, self.backfill_table):
+                cursor.execute('SELECT report_date FROM ' + self.backfill_table + ' WHERE table_name=?;', (table_name,))
+                rows = cursor.fetchall()
+        return set(pd.to_datetime([row[0] for row in rows], format='%Y-%m-%d %H:%M:%S'))
+
+    def mark_backfilled(self, table_name, report_dates):
+        """
+        Records daily reports as loaded into a data table
+
+        :param table_name: Name of the data table
+        :param report_dates: Dates of the loaded reports
+        :return:
+        """
+        self.create_backfill_progress_table()
+        with self.transaction() as con:
+            con.executemany('INSERT OR IGNORE INTO ' + self.backfill_table + ' VALUES (?, ?);',
+                            [(table_name, date) for date in self._format_dates(pd.Series(pd.to_datetime(report_dates)))])
+
+    def get_ingested_hash(self, table_name):
+        """
+        :param table_name: Name of the data table
+        :return: Content hash of the source file last ingested into the table, None if it was never ingested
+        """
+        with self.transaction(write=False) as con:
+            cursor = con.cursor()
+            rows = []
+            if self._table_exists(cursor, self.source_table):
+                cursor.execute('SELECT content_hash FROM ' + self.source_table + ' WHERE table_name=?;', (table_name,))
+                rows = cursor.fetchall()
+        return rows[0][0] if rows else None
+
+    def mark_ingested(self, table_name, source, content_hash):
+        """
+        Records the content of a source file as ingested into a data table. Call it in the transaction that writes
+        the content, so the record never gets ahead of the data
+
+        :param table_name: Name of the data table
+        :param source: Path or URL of the source file
+        :param content_hash: Content hash of the file, e.g. Snapshot.content_hash
+        :return:
+        """
+        self.create_source_table()
+        with self.transaction() as con:
+            con.execute('INSERT OR REPLACE INTO ' + self.source_table + ' VALUES (?, ?, ?, ?);',
+                        (table_name, source, content_hash, self._now()))
+
+    def insert_to_deaths_total_table(self, total_deaths_df, incremental=False):
+        return self.insert_to_table(total_deaths_df, self.deaths_table, incremental)
+
+    def insert_to_deaths_change_python_table(self, deaths_change_df, incremental=False):
+        return self.insert_to_table(deaths_change_df, self.deaths_change_python_table, incremental)
+
+    def insert_to_table(self, data_df, table_name, incremental=False):
+        """
+        Inserts new and retrospectively modified rows to a data table
+
+        :param data_df: Data frame with country, date and value columns
+        :param table_name: Name of the table
+        :param incremental: Sync against the table's high-water marks instead of comparing with the whole table
+        :return: The number of updated rows
+        """
+        if incremental:
+            return self._sync_deaths_data(data_df, table_name)
+        return self._insert_deaths_data(data_df, table_name)
+
+    def get_watermarks(self, table_name):
+        """
+        Reads the high-water marks of a data table
+
+        :param table_name: Name of the data table
+        :return: DataFrame with country, last_date and window_checksum columns
+        """
+        with self.transaction(write=False) as con:
+            watermarks = pd.read_sql_query('SELECT country, last_date, window_checksum FROM ' + self.watermark_table +
+                                           ' WHERE table_name=?;', con=con, params=(table_name,))
+        watermarks['last_date'] = pd.to_datetime(watermarks['last_date'], format='%Y-%m-%d %H:%M:%S')
+        return watermarks
+
+    def get_sync_start_date(self, table_name):
+        """
+        Returns the date after which source data has to be read for an incremental sync of a table: the earliest
+        high-water mark minus the revision window, so that the window of every country can be checksummed
+
+        :param table_name: Name of the data table
+        :return: Timestamp, or None if the table was never synced and all data is needed
+        """
+        self.create_watermark_table()
+        watermarks = self.get_watermarks(table_name)
+        if len(watermarks) == 0:
+            return None
+        return watermarks['last_date'].min() - pd.Timedelta(days=self.revision_window)
 
     def upsert_to_table(self, data_df, table_name):
         """
@@ -83,6 +583,12 @@ class Database:
         :param table_name: Name of the table
         :return: The number of changed rows
         """
+        with self.transaction(write=False) as con:
+            logged = self._table_exists(con.cursor(), table_name + '_revisions') or \
+                self._table_exists(con.cursor(), table_name + '_ingest_times')
+        if self.compact or logged:  # The bulk upsert logs the superseded values and the ingest times
+            return sum(self.bulk_upsert_to_table(data_df, table_name))
+
         sql = 'INSERT INTO ' + table_name + '(' + ','.join(data_df.columns.values) + ') ' \
                                                                                      'VALUES (?, ?, ?) ' \
                                                                                      'ON CONFLICT (country, date) ' \
@@ -96,12 +602,183 @@ class Database:
         # Copy the deaths/ deaths_change column to a temp column as the fourth parameter
         data_df.loc[:, 'temp'] = data_df.iloc[:, 2]
         param_list = [tuple(x) for x in data_df.values]
-        with self.create_connection() as con:
+        with self.transaction() as con:
             cursor = con.cursor()
             resp = cursor.executemany(sql, param_list)
 
         return resp.rowcount
 
+    def bulk_upsert_to_table(self, data_df, table_name, ingested_at=None):
+        """
+        Inserts data into a table through a temporary staging table. The typed rows are streamed into an unindexed
+        staging table in batches and applied with one UPDATE ... FROM for the stored rows whose values changed and
+        one INSERT ... SELECT for the new rows, all inside one transaction. Before SQLite 3.33, which added
+        UPDATE ... FROM, they are applied with one INSERT ... ON CONFLICT instead. Rows whose values did not change
+        are not rewritten. In compact mode the rows are written to the compact table with their country ids and day
+        numbers. If the table has ingest times, see create_ingest_times_table, the rows that a stored row with a later
+        ingest time supersedes are dropped, and the ingest times of the others are recorded
+
+        :param data_df: Data frame with country and date columns followed by one or more value columns
+        :param table_name: Name of the table
+        :param ingested_at: UTC ingest time of the rows as text, e.g. '2020-03-01 12:00:00.000000', or an array with
+            one per row. Defaults to now
+        :return: Tuple with the number of inserted rows and the number of updated rows
+        """
+        ingested_at = self._now() if ingested_at is None else ingested_at
+        key_names = list(data_df.columns.values[:2])
+        if data_df.duplicated(key_names, keep='last').any():
+            latest = ~data_df.duplicated(key_names, keep='last').values  # The last row of a key wins
+            data_df = data_df[latest]
+            if not isinstance(ingested_at, str):
+                ingested_at = np.asarray(ingested_at)[latest]
+        value_cols = list(data_df.columns.values[2:])
+        order = slice(None)
+
+        with self.transaction() as con:
+            cursor = con.cursor()
+            if self.compact and self._table_exists(cursor, table_name + '_compact'):
+                target, key_cols, key_types = table_name + '_compact', ['country_id', 'day'], ['INT', 'INT']
+                keys = [self._get_country_ids(cursor, data_df.iloc[:, 0]).tolist(),
+                        DataHandler().get_day_numbers(data_df.iloc[:, 1]).tolist()]
+            else:
+                target, key_cols, key_types = table_name, ['country', 'date'], ['TEXT', 'DATE']
+                # Each distinct country and date is converted to text once, and the rows are sent in primary key
+                # order, so SQLite appends to the b-tree pages instead of splitting them
+                country_codes, countries = pd.factorize(data_df.iloc[:, 0].astype(str), sort=True)
+                date_codes, dates = pd.factorize(data_df.iloc[:, 1], sort=True)
+                order = np.lexsort((date_codes, country_codes))
+                keys = [np.asarray(countries, dtype=object)[country_codes[order]].tolist(),
+                        self._format_dates(pd.Series(dates))[date_codes[order]].tolist()]
+            cols = key_cols + value_cols
+            # Python ints, so the values are stored as INTEGER
+            values = [data_df[col].to_numpy()[order].tolist() for col in value_cols]
+            timed = self._table_exists(cursor, table_name + '_ingest_times')
+            if timed:
+                values.append([ingested_at] * len(data_df) if isinstance(ingested_at, str) else
+                              np.asarray(ingested_at, dtype=object)[order].tolist())
+            rows = (zip(*[column[start:start + self.upsert_batch_size] for column in keys + values])
+                    for start in range(0, len(data_df), self.upsert_batch_size))
+
+            log_revisions = target == table_name and len(value_cols) == 1 and \
+                self._table_exists(cursor, table_name + '_revisions')
+            if not log_revisions and not timed and \
+                    cursor.execute('SELECT 1 FROM ' + target + ' LIMIT 1;').fetchone() is None:
+                # Nothing to update in an empty table, e.g. on a first load: insert directly
+                for batch in rows:
+                    cursor.executemany('INSERT INTO ' + target + '(' + ','.join(cols) + ') VALUES (' +
+                                       ', '.join(['?'] * len(cols)) + ');', batch)
+                self.last_upserted[table_name] = data_df
+                return len(data_df), 0
+
+            # No primary key: maintaining an index per staged row costs more than the lookups into the target's
+            # primary key below. The value columns have no type, so integers and reals are staged as they are
+            cursor.execute('DROP TABLE IF EXISTS temp.staging;')
+            cursor.execute('CREATE TEMP TABLE staging ( \
+                               ' + key_cols[0] + ' ' + key_types[0] + ', \
+                               ' + key_cols[1] + ' ' + key_types[1] + ', \
+                               ' + ', '.join(value_cols + ['ingested_at'] * timed) + ');'
+                           )
+            for batch in rows:
+                cursor.executemany('INSERT INTO temp.staging VALUES (' + ', '.join(['?'] * (len(cols) + timed)) + ');',
+                                   batch)
+
+            if timed:
+                superseded = self._drop_superseded_rows(cursor, table_name, key_cols)
+                if superseded:
+                    kept = np.ones(len(data_df), dtype=bool)
+                    kept[order] = ~pd.MultiIndex.from_arrays(keys).isin(superseded)
+                    data_df = data_df[kept]
+
+            if log_revisions:
+                self._log_revisions(cursor, table_name, value_cols[0])
+
+            join = target + '.' + key_cols[0] + '=s.' + key_cols[0] + ' AND ' + \
+                target + '.' + key_cols[1] + '=s.' + key_cols[1]
+            new_rows = 'FROM temp.staging s WHERE NOT EXISTS (SELECT 1 FROM ' + target + ' WHERE ' + join + ')'
+            if self.update_from:
+                cursor.execute('UPDATE ' + target + ' SET ' + ', '.join(col + '=s.' + col for col in value_cols) + ' '
+                               'FROM temp.staging s '
+                               'WHERE ' + join + ' AND (' +
+                               ' OR '.join(target + '.' + col + ' IS NOT s.' + col for col in value_cols) + ');')
+                updated = cursor.rowcount
+                cursor.execute('INSERT INTO ' + target + '(' + ','.join(cols) + ') '
+                               'SELECT ' + ','.join('s.' + col for col in cols) + ' ' + new_rows + ';')
+                inserted = cursor.rowcount
+            else:
+                inserted = cursor.execute('SELECT COUNT(*) ' + new_rows + ';').fetchone()[0]
+                cursor.execute('INSERT INTO ' + target + '(' + ','.join(cols) + ') '
+                               'SELECT ' + ','.join(cols) + ' FROM temp.staging WHERE true '
+                               'ON CONFLICT (' + ','.join(key_cols) + ') '
+                               'DO UPDATE SET ' + ', '.join(col + '=excluded.' + col for col in value_cols) + ' '
+                               'WHERE ' + ' OR '.join(col + ' IS NOT excluded.' + col for col in value_cols) + ';')
+                updated = cursor.rowcount - inserted
+            cursor.execute('DROP TABLE temp.staging;')
+
+        self.last_upserted[table_name] = data_df
+        return inserted, updated
+
+    def get_neighbour_totals(self, changed_totals_df, table_name=None):
+        """
+        Reads the stored total deaths rows directly before and after each given row of the same country. Each
+        neighbour is found with one primary key index lookup
+
+        :param changed_totals_df: New or revised total deaths rows
+        :param table_name: Name of the totals table. Defaults to deaths_total
+        :return: DataFrame with the neighbouring rows in the totals table
+        """
+        table_name = table_name or self.deaths_table
+        with self.transaction(write=False) as con:
+            cursor = con.cursor()
+            compact_table = self._get_compact_table(cursor, table_name)
+            if compact_table is None:
+                neighbour_sql = 'SELECT t.* FROM temp.changed_keys k ' \
+                                'JOIN ' + table_name + ' t ON t.country=k.country AND t.date=(' \
+                                'SELECT n.date FROM ' + table_name + ' n ' \
+                                'WHERE n.country=k.country AND n.date {} k.date ORDER BY n.date {} LIMIT 1)'
+            else:
+                neighbour_sql = 'SELECT ' + self._compact_columns(cursor, compact_table, 't') + ' ' \
+                                'FROM temp.changed_keys k ' \
+                                'JOIN ' + compact_table + ' t ON t.country_id=k.country_id AND t.day=(' \
+                                'SELECT n.day FROM ' + compact_table + ' n ' \
+                                'WHERE n.country_id=k.country_id AND n.day {} k.day ORDER BY n.day {} LIMIT 1) ' \
+                                'JOIN countries c ON c.country_id=t.country_id'
+            self._create_key_table(cursor, 'changed_keys', changed_totals_df, compact=compact_table is not None)
+            neighbours_df = pd.read_sql_query(neighbour_sql.format('<', 'DESC') + ' UNION ' +
+                                              neighbour_sql.format('>', 'ASC') + ';', con=con)
+            cursor.execute('DROP TABLE temp.changed_keys;')
+        return neighbours_df
+
+    def update_deaths_change_python_table(self, changed_totals_df=None):
+        """
+        Updates deaths_change_python only for the rows affected by new or revised total deaths rows, instead of
+        recalculating and comparing every country's full history
+
+        :param changed_totals_df: New or revised total deaths rows. Defaults to the rows of the latest upsert to
+            deaths_total
+        :return: The number of changed rows
+        """
+        return self.update_change_table(self.deaths_table, self.deaths_change_python_table, changed_totals_df)
+
+    def update_change_table(self, total_table, change_table, changed_totals_df=None):
+        """
+        Updates a daily change table only for the rows affected by new or revised rows of its totals table
+
+        :param total_table: Name of the totals table, e.g. 'confirmed_total'
+        :param change_table: Name of the change table, e.g. 'confirmed_change_python'
+        :param changed_totals_df: New or revised totals rows. Defaults to the rows of the latest upsert to total_table
+        :return: The number of changed rows
+        """
+        if changed_totals_df is None:
+            changed_totals_df = self.last_upserted.get(total_table)
+        if changed_totals_df is None or len(changed_totals_df) == 0:
+            return 0
+
+        metric = changed_totals_df.columns.values[2]
+        with self.transaction():
+            stored_df = self.get_neighbour_totals(changed_totals_df, total_table)
+            changes_df = DataHandler().get_daily_change_of_deaths_incremental(changed_totals_df, stored_df, metric)
+            return sum(self.bulk_upsert_to_table(changes_df, change_table))
+
     def _insert_deaths_data(self, new_data_df, table_name):
         """
         Inserts deaths data to COVID19 deaths data table, denoted by table_name. If the new data contain
@@ -111,33 +788,727 @@ class Database:
         :param table_name: Name of the table to insert data
         :return: The number of updated rows
         """
+        with self.transaction() as con:
+            changed_rows = -1
 
-        changed_rows = -1
+            row_count = self.execute_query('SELECT COUNT(*) FROM ' + table_name + ';')[0][0]
 
-        row_count = self.execute_query('SELECT COUNT(*) FROM ' + table_name + ';')[0][0]
+            if row_count == 0:
+                '''
+                The table is empty, insert all the data in the data frame
+                '''
+                changed_rows = sum(self.bulk_upsert_to_table(new_data_df, table_name))
 
-        if row_count == 0:
-            '''
-            The table is empty, insert all the data in the data frame
-            '''
-            with self.create_connection() as con:
-                new_data_df.to_sql(con=con, name=table_name, if_exists='append', index=False)
+            else:
+                '''
+                If the table is not empty append only the new data rows because re-writing all the 
+                data is too expensive
+                '''
+                # Read the current data from table as a data frame
+                curr_data = pd.read_sql_query('SELECT * FROM ' + table_name + ';', con=con)
 
-            changed_rows = len(new_data_df)
+                dh = DataHandler()
+                # Filter changed or newly added country and date combinations
+                modified_rows = dh.get_changed_rows(new_data_df, curr_data)
+                # Update the database
+                changed_rows = sum(self.bulk_upsert_to_table(new_data_df.iloc[modified_rows, ], table_name))
 
-        else:
-            '''
-            If the table is not empty append only the new data rows because re-writing all the 
-            data is too expensive
-            '''
-            # Read the current data from table as a data frame
-            with self.create_connection() as con:
-                curr_data = pd.read_sql_query('SELECT * FROM ' + table_name + ';', con=con)
+            return changed_rows
+
+    def _sync_deaths_data(self, new_data_df, table_name):
+        """
+        Incrementally syncs deaths data to the table denoted by table_name. Only the dates after each country's
+        high-water mark are inserted. The rows inside the trailing revision window are checksummed against the
+        stored mark and read back from the table only when they differ, so retrospective corrections in the window
+        are updated without loading the whole table. Corrections older than the window are not detected.
+
+        :param new_data_df: Data frame with new data
+        :param table_name: Name of the table to insert data
+        :return: The number of updated rows
+        """
+        with self.transaction():
+            self.create_watermark_table()
+            watermarks = self.get_watermarks(table_name)
+
+            if len(watermarks) == 0:
+                # First sync of this table, fall back to the full comparison once
+                changed_rows = self._insert_deaths_data(new_data_df, table_name)
+                self._update_watermarks(new_data_df, table_name, watermarks)
+                return changed_rows
 
             dh = DataHandler()
-            # Filter changed or newly added country and date combinations
-            modified_rows = dh.get_changed_rows(new_data_df, curr_data)
-            # Update the database
-            changed_rows = self.upsert_to_table(new_data_df.iloc[modified_rows, ], table_name)
+            data_cols = list(new_data_df.columns.values)
 
+            data_df = new_data_df.merge(watermarks, on='country', how='left')
+            is_known = data_df['last_date'].notna().values
+            window_start = data_df['last_date'] - pd.Timedelta(days=self.revision_window)
+            in_window = is_known & (data_df['date'] > window_start).values & (data_df['date'] <= data_df['last_date']).values
+
+            # Countries whose revision window no longer matches the stored checksum
+            checksums = dh.get_checksum_per_country(data_df.loc[in_window, data_cols])
+            stored = watermarks.set_index('country')['window_checksum'].reindex(checksums.index)
+            revised = checksums.index[checksums.values != stored.values]
+
+            new_rows = data_df.loc[~is_known | (data_df['date'] > data_df['last_date']).values, data_cols]
+            upserts = [new_rows]
+
+            if len(revised) > 0:
+                window_df = data_df.loc[in_window & data_df['country'].isin(revised).values, data_cols]
+                curr_df = self._read_revision_windows(table_name, watermarks[watermarks['country'].isin(revised)])
+                upserts.append(window_df.iloc[dh.get_changed_rows(window_df, curr_df)])
+
+            upsert_df = pd.concat(upserts)
+            changed_rows = 0
+            if len(upsert_df) > 0:
+                changed_rows = sum(self.bulk_upsert_to_table(upsert_df, table_name))
+
+            self._update_watermarks(new_data_df, table_name, watermarks)
+            return changed_rows
+
+    def _read_revision_windows(self, table_name, watermarks):
+        """
+        Reads the rows inside the revision window of the given countries from a data table
+
+        :param table_name: Name of the data table
+        :param watermarks: High-water marks of the countries to read
+        :return: DataFrame with the stored rows
+        """
+        window = pd.Timedelta(days=self.revision_window)
+        with self.transaction(write=False) as con:
+            compact_table = self._get_compact_table(con.cursor(), table_name)
+            if compact_table is None:
+                sql = 'SELECT * FROM ' + table_name + ' WHERE country=? AND date>? AND date<=?;'
+                bounds = [((last_date - window).strftime('%Y-%m-%d %H:%M:%S'), last_date.strftime('%Y-%m-%d %H:%M:%S'))
+                          for last_date in watermarks['last_date']]
+            else:
+                sql = 'SELECT ' + self._compact_columns(con.cursor(), compact_table, 't') + ' ' \
+                      'FROM countries c JOIN ' + compact_table + ' t ON t.country_id=c.country_id ' \
+                      'WHERE c.country=? AND t.day>? AND t.day<=?;'
+                bounds = [(self._get_day_number(last_date - window), self._get_day_number(last_date))
+                          for last_date in watermarks['last_date']]
+            frames = [pd.read_sql_query(sql, con=con, params=(country,) + bound)
+                      for country, bound in zip(watermarks['country'], bounds)]
+        return pd.concat(frames, ignore_index=True)
+
+    def _update_watermarks(self, new_data_df, table_name, watermarks):
+        """
+        Moves the high-water marks of a data table forward to the latest date of each country in the synced data
+
+        :param new_data_df: Data frame that was synced
+        :param table_name: Name of the data table
+        :param watermarks: High-water marks read before the sync
+        :return:
+        """
+        last_dates = new_data_df.groupby('country')['date'].max()
+        stored = watermarks.set_index('country')['last_date'].reindex(last_dates.index)
+        last_dates = last_dates[~(last_dates < stored)]  # Never move a mark backwards
+
+        window_start = new_data_df['country'].map(last_dates) - pd.Timedelta(days=self.revision_window)
+        in_window = (new_data_df['date'] > window_start).values
+        checksums = DataHandler().get_checksum_per_country(new_data_df.loc[in_window]).reindex(last_dates.index)
+
+        param_list = list(zip([table_name] * len(last_dates), last_dates.index,
+                              last_dates.dt.strftime('%Y-%m-%d %H:%M:%S'), checksums.astype(int).tolist()))
+        sql = 'INSERT INTO ' + self.watermark_table + '(table_name, country, last_date, window_checksum) ' \
+              'VALUES (?, ?, ?, ?) ' \
+              'ON CONFLICT (table_name, country) ' \
+              'DO UPDATE SET last_date=excluded.last_date, window_checksum=excluded.window_checksum;'
+        with self.transaction() as con:
+            con.executemany(sql, param_list)
+
+    def rebuild_deaths_change_sql_table(self):
+        """
+        Recalculates the whole deaths_change_sql table from deaths_total with a LAG window function
+
+        :return: The number of rows in the table
+        """
+        with self.transaction() as con:
+            self.create_deaths_change_sql_table()
+            cursor = con.cursor()
+            cursor.execute('DELETE FROM ' + self.deaths_change_sql_table + ';')
+            cursor.execute('INSERT INTO ' + self.deaths_change_sql_table + ' (country, date, deaths_change) \
+                               SELECT country, date, \
+                               deaths - LAG(deaths,1,0) OVER (PARTITION BY country ORDER BY date) AS deaths_change \
+                               FROM ' + self.deaths_table + ';')
+            return cursor.rowcount
+
+    def refresh_deaths_change_sql_table(self, changed_totals_df=None):
+        """
+        Keeps deaths_change_sql current after an upsert to deaths_total. The change is recalculated only for the
+        touched (country, date) keys and the next stored date of each, the rows whose LAG value can differ. The
+        previous and next dates are looked up through the (country, date) primary key index, so no window function
+        scans the whole table
+
+        :param changed_totals_df: New or revised total deaths rows. Defaults to the rows of the latest upsert to
+            deaths_total
+        :return: The number of changed rows
+        """
+        if changed_totals_df is None:
+            changed_totals_df = self.last_upserted.get(self.deaths_table)
+        if changed_totals_df is None or len(changed_totals_df) == 0:
+            return 0
+
+        total, change = self.deaths_table, self.deaths_change_sql_table
+        with self.transaction() as con:
+            self.create_deaths_change_sql_table()
+            cursor = con.cursor()
+            compact_table = self._get_compact_table(cursor, total)
+            self._create_key_table(cursor, 'changed_keys', changed_totals_df, compact=compact_table is not None)
+            if compact_table is None:
+                changes = 'SELECT t.country, t.date, t.deaths - COALESCE(( \
+                               SELECT p.deaths FROM ' + total + ' p WHERE p.country=t.country AND p.date<t.date \
+                               ORDER BY p.date DESC LIMIT 1), 0) \
+                           FROM ( \
+                               SELECT country, date FROM temp.changed_keys \
+                               UNION \
+                               SELECT k.country, (SELECT n.date FROM ' + total + ' n \
+                                   WHERE n.country=k.country AND n.date>k.date ORDER BY n.date LIMIT 1) \
+                               FROM temp.changed_keys k \
+                           ) a JOIN ' + total + ' t ON t.country=a.country AND t.date=a.date'
+            else:
+                changes = 'SELECT c.country, strftime(\'%Y-%m-%d %H:%M:%S\', t.day * 86400, \'unixepoch\'), \
+                           t.deaths - COALESCE(( \
+                               SELECT p.deaths FROM ' + compact_table + ' p \
+                               WHERE p.country_id=t.country_id AND p.day<t.day ORDER BY p.day DESC LIMIT 1), 0) \
+                           FROM ( \
+                               SELECT country_id, day FROM temp.changed_keys \
+                               UNION \
+                               SELECT k.country_id, (SELECT n.day FROM ' + compact_table + ' n \
+                                   WHERE n.country_id=k.country_id AND n.day>k.day ORDER BY n.day LIMIT 1) \
+                               FROM temp.changed_keys k \
+                           ) a JOIN ' + compact_table + ' t ON t.country_id=a.country_id AND t.day=a.day \
+                           JOIN countries c ON c.country_id=t.country_id'
+            cursor.execute('INSERT INTO ' + change + ' (country, date, deaths_change) \
+                               ' + changes + ' \
+                               WHERE true \
+                               ON CONFLICT (country, date) \
+                               DO UPDATE SET deaths_change=excluded.deaths_change \
+                               WHERE deaths_change IS NOT excluded.deaths_change;')
+            changed_rows = cursor.rowcount
+            cursor.execute('DROP TABLE temp.changed_keys;')
         return changed_rows
+
+    def ingest_csv(self, csv_source, total_table=None, change_table=None, metric='deaths'):
+        """
+        SQL engine of the sync: streams the wide csv file with the csv module into a staging table in batches and
+        sums the provinces per country, unpivots the dates and calculates the daily change with LAG in SQL. The
+        tables end up with the same contents as with get_total_deaths_per_country_and_day and
+        get_daily_change_of_deaths, without building data frames. The staging tables and the sorts of the aggregation
+        are kept in temporary files rather than in memory, so memory does not grow with the file
+
+        :param csv_source: Path, URL or text file object of the csv file
+        :param total_table: Name of the totals table. Defaults to deaths_total
+        :param change_table: Name of the daily change table. Defaults to deaths_change_python
+        :param metric: Name of the value column. The change column is named metric + '_change'
+        :return: Tuple with the number of changed totals rows and change rows
+        """
+        if self.compact:
+            raise ValueError('ingest_csv needs a Database created with compact=False')
+        total_table = total_table or self.deaths_table
+        change_table = change_table or self.deaths_change_python_table
+        self.create_data_table(total_table, metric)
+        self.create_data_table(change_table, metric + '_change')
+
+        with self._open_csv(csv_source) as f, self._temp_store('FILE'), self.transaction() as con:
+            rows = csv.reader(f)
+            header = next(rows)
+            country_cols = [i for i, col in enumerate(header) if re.match('[cC]ountry', col)]
+            if len(country_cols) != 1:
+                raise ValueError("Cannot determine country column. Found " + str(len(country_cols)) +
+                                 " with term 'Country'.")
+            date_cols = [i for i, col in enumerate(header) if re.match('(?:[0-9]{1,2}/){1,2}[0-9]{2}', col)]
+
+            cursor = con.cursor()
+            cursor.execute('DROP TABLE IF EXISTS temp.csv_dates;')
+            cursor.execute('CREATE TEMP TABLE csv_dates (idx INTEGER PRIMARY KEY, date DATE);')
+            cursor.executemany('INSERT INTO temp.csv_dates VALUES (?, ?);',
+                               [(i, self._parse_header_date(header[col])) for i, col in enumerate(date_cols)])
+
+            # One row per province with its values as a JSON array, unpivoted by json_each below. A wide staging
+            # table would hit SQLite's column limit with a few thousand dates
+            cursor.execute('DROP TABLE IF EXISTS temp.csv_staging;')
+            cursor.execute('CREATE TEMP TABLE csv_staging (country TEXT, vals TEXT);')
+            country_col = country_cols[0]
+            staged = (
+                (row[country_col], '[' + ','.join(row[col] or '0' for col in date_cols) + ']') for row in rows if row)
+            while True:
+                batch = list(itertools.islice(staged, self.upsert_batch_size))
+                if not batch:
+                    break
+                cursor.executemany('INSERT INTO temp.csv_staging VALUES (?, ?);', batch)
+
+            totals = 'SELECT s.country, d.date, SUM(CAST(j.value AS INT)) AS ' + metric + ' \
+                      FROM temp.csv_staging s, json_each(s.vals) j \
+                      JOIN temp.csv_dates d ON d.idx=j.key \
+                      GROUP BY s.country, d.date'
+            logged = self._table_exists(cursor, total_table + '_revisions')
+            timed = self._table_exists(cursor, total_table + '_ingest_times')
+            if logged or timed:
+                # The aggregated rows are kept, so the rows with a later stored ingest time can be dropped and the
+                # values they supersede logged before the upsert
+                cursor.execute('DROP TABLE IF EXISTS temp.csv_totals;')
+                cursor.execute('CREATE TEMP TABLE csv_totals AS SELECT *, ? AS ingested_at FROM (' + totals + ');',
+                               (self._now(),))
+                if timed:
+                    self._drop_superseded_rows(cursor, total_table, ['country', 'date'], staging='temp.csv_totals')
+                if logged:
+                    self._log_revisions(cursor, total_table, metric, staging='temp.csv_totals')
+                totals = 'SELECT country, date, ' + metric + ' FROM temp.csv_totals'
+
+            cursor.execute('INSERT INTO ' + total_table + ' (country, date, ' + metric + ') \
+                               SELECT * FROM (' + totals + ') WHERE true \
+                               ON CONFLICT (country, date) \
+                               DO UPDATE SET ' + metric + '=excluded.' + metric + ' \
+                               WHERE ' + metric + ' IS NOT excluded.' + metric + ';')
+            total_rows = cursor.rowcount
+
+            cursor.execute('INSERT INTO ' + change_table + ' (country, date, ' + metric + '_change) \
+                               SELECT country, date, \
+                               ' + metric + ' - LAG(' + metric + ',1,0) OVER (PARTITION BY country ORDER BY date) \
+                               FROM ' + total_table + ' WHERE true \
+                               ON CONFLICT (country, date) \
+                               DO UPDATE SET ' + metric + '_change=excluded.' + metric + '_change \
+                               WHERE ' + metric + '_change IS NOT excluded.' + metric + '_change;')
+            change_rows = cursor.rowcount
+
+            cursor.execute('DROP TABLE temp.csv_staging;')
+            cursor.execute('DROP TABLE temp.csv_dates;')
+            cursor.execute('DROP TABLE IF EXISTS temp.csv_totals;')
+        return total_rows, change_rows
+
+    def update_analytics_table(self, total_table=None, analytics_table=None, since=None):
+        """
+        Recalculates the rolling analytics of a totals table, see DataHandler.get_rolling_analytics, and upserts them
+        in bulk. With since, only the analytics of the later dates are recalculated, from the lookback dates before
+        them, so a sync that changed the last few days rewrites only those days
+
+        :param total_table: Name of the totals table. Defaults to deaths_total
+        :param analytics_table: Name of the analytics table. Defaults to deaths_analytics
+        :param since: Dates after this date are recalculated, e.g. the day before the earliest changed date. All
+            dates if None
+        :return: The number of inserted and updated analytics rows
+        """
+        total_table = total_table or self.deaths_table
+        analytics_table = analytics_table or self.deaths_analytics_table
+        dh = DataHandler()
+
+        with self.transaction() as con:
+            cursor = con.execute('SELECT * FROM ' + total_table + ' LIMIT 0;')
+            value_col = cursor.description[2][0]
+            lower = ''
+            if since is not None:
+                lower = (pd.Timestamp(since) - pd.Timedelta(days=dh.get_analytics_lookback())).strftime(
+                    '%Y-%m-%d %H:%M:%S')
+            totals_df = pd.read_sql_query('SELECT * FROM ' + total_table + ' WHERE date>?;', con=con, params=(lower,))
+            if totals_df.empty:
+                return 0
+
+            countries, dates, matrix = dh.frame_to_matrix(totals_df, value_col)
+            analytics_df = dh.get_rolling_analytics(countries, dates, matrix, since=since, metric=value_col)
+            self.create_analytics_table(analytics_table, analytics_df.columns.values[2:])
+            return sum(self.bulk_upsert_to_table(analytics_df, analytics_table))
+
+    def read_compact_table(self, table_name):
+        """
+        Reads a data table in compact mode without expanding the country names and dates in SQL
+
+        :param table_name: Name of the regular table
+        :return: DataFrame with categorical country, int32 day and int32 value columns
+        """
+        if not self.compact:
+            raise ValueError('read_compact_table needs a Database created with compact=True')
+
+        with self.reader() as con:
+            countries_df = pd.read_sql_query('SELECT country_id, country FROM ' + self.countries_table +
+                                             ' ORDER BY country_id;', con=con)
+            data_df = pd.read_sql_query('SELECT * FROM ' + table_name + '_compact;', con=con)
+
+        codes = np.searchsorted(countries_df['country_id'].values, data_df['country_id'].values)
+        compact_df = pd.DataFrame({'country': pd.Categorical.from_codes(codes, countries_df['country']),
+                                   'day': data_df['day'].values.astype('int32')})
+        compact_df[data_df.columns.values[2]] = data_df.iloc[:, 2].values.astype('int32')
+        return compact_df
+
+    def export_matrix(self, table_name=None, export_dir=None):
+        """
+        Exports a data table as a countries x dates matrix in a .npy file and an index sidecar, table_name + '.json',
+        with the country names, the dates and the name of the matrix file. Each export writes a new matrix file and
+        then replaces the sidecar, so readers that mapped an earlier export keep a consistent matrix
+
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :param export_dir: Directory of the export. Defaults to export_dir
+        :return: Path of the sidecar
+        """
+        table_name = table_name or self.deaths_table
+        export_dir = export_dir or self.export_dir
+        if export_dir is None:
+            raise ValueError('export_matrix needs an export directory')
+        os.makedirs(export_dir, exist_ok=True)
+
+        with self.reader() as con:
+            data_df = pd.read_sql_query('SELECT * FROM ' + table_name + ';', con=con)
+        value_col = data_df.columns.values[2]
+        countries, dates, matrix = DataHandler().frame_to_matrix(data_df, value_col)
+
+        matrix_file = table_name + '.' + str(time.time_ns()) + '.npy'
+        write_atomic(os.path.join(export_dir, matrix_file), lambda f: np.save(f, matrix))
+        index = {'table': table_name, 'value_col': value_col, 'matrix': matrix_file, 'countries': countries.tolist(),
+                 'dates': dates.strftime('%Y-%m-%d').tolist()}
+        index_path = os.path.join(export_dir, table_name + '.json')
+        write_atomic(index_path, lambda f: f.write(json.dumps(index).encode()))
+
+        for old_file in glob.glob(os.path.join(export_dir, glob.escape(table_name) + '.*.npy')):
+            if os.path.basename(old_file) != matrix_file:
+                try:
+                    os.remove(old_file)
+                except OSError:
+                    pass  # Still mapped by a reader on a platform that cannot remove mapped files
+        return index_path
+
+    def read_matrix(self, table_name=None, export_dir=None, countries=None, start_date=None, end_date=None):
+        """
+        Reads the latest export of a data table, see export_matrix. The matrix is memory mapped read-only, so the
+        full dataset loads in milliseconds and is shared by all processes that read it. A date range is a view of
+        the mapped matrix, a selection of countries copies their rows
+
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :param export_dir: Directory of the export. Defaults to export_dir
+        :param countries: List of country names. All countries if None
+        :param start_date: First date. From the first exported date if None
+        :param end_date: Last date. Up to the last exported date if None
+        :return: Tuple with the country names, the DatetimeIndex of dates and the countries x dates matrix
+        """
+        table_name = table_name or self.deaths_table
+        export_dir = export_dir or self.export_dir
+        if export_dir is None:
+            raise ValueError('read_matrix needs an export directory')
+
+        with open(os.path.join(export_dir, table_name + '.json')) as f:
+            index = json.load(f)
+        matrix = np.load(os.path.join(export_dir, index['matrix']), mmap_mode='r')
+        all_countries = np.array(index['countries'], dtype=object)
+        dates = pd.DatetimeIndex(index['dates'])
+
+        first = 0 if start_date is None else dates.searchsorted(pd.Timestamp(start_date), side='left')
+        last = len(dates) if end_date is None else dates.searchsorted(pd.Timestamp(end_date), side='right')
+        matrix, dates = matrix[:, first:last], dates[first:last]
+
+        if countries is not None:
+            rows = pd.Index(all_countries).get_indexer(countries)
+            if (rows < 0).any():
+                raise ValueError('Countries not in the export: ' + str(list(np.asarray(countries)[rows < 0])))
+            return all_countries[rows], dates, matrix[rows]
+        return all_countries, dates, matrix
+
+    def get_data_version(self):
+        """
+        Returns a value that changes whenever the data in the database changes: the counter of committed changes of
+        this object and SQLite's data_version of a separate connection, which changes when any other connection,
+        including other processes, commits
+
+        :return: Tuple identifying the current data version
+        """
+        if self.db == ':memory:':
+            return self.data_version, None
+
+        with self._cache_lock:
+            if self._version_con is None:
+                self._version_con = self.create_connection()
+            return self.data_version, self._version_con.execute('PRAGMA data_version;').fetchone()[0]
+
+    def get_country_series(self, country, table_name=None, start_date=None, end_date=None):
+        """
+        Reads the time series of one country through the (country, date) primary key
+
+        :param country: Name of the country
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :param start_date: First date of the series. From the first stored date if None
+        :param end_date: Last date of the series. Up to the last stored date if None
+        :return: Series of values indexed by date
+        """
+        table_name = table_name or self.deaths_table
+        key = ('country_series', table_name, country, start_date, end_date)
+
+        def query():
+            with self.reader() as con:
+                compact_table = self._get_compact_table(con.cursor(), table_name)
+                if compact_table is not None:
+                    sql = 'SELECT ' + self._compact_columns(con.cursor(), compact_table, 't') + ' ' \
+                          'FROM countries c JOIN ' + compact_table + ' t ON t.country_id=c.country_id ' \
+                          'WHERE c.country=? AND t.day>=? AND t.day<=? ORDER BY t.day;'
+                    bounds = (-2 ** 31 if start_date is None else self._get_day_number(start_date),
+                              2 ** 31 - 1 if end_date is None else self._get_day_number(end_date))
+            if compact_table is None:
+                sql = 'SELECT * FROM ' + table_name + ' WHERE country=? AND date>=? AND date<=? ORDER BY date;'
+                bounds = self._date_bounds(start_date, end_date)
+            data_df = self._read_sql(sql, (country,) + bounds)
+            return pd.Series(data_df.iloc[:, 2].values, index=pd.DatetimeIndex(data_df['date'], name='date'),
+                             name=data_df.columns.values[2])
+
+        return self._cached_query(key, query).copy()
+
+    def get_date_range(self, start_date=None, end_date=None, table_name=None):
+        """
+        Reads the rows of all countries between two dates
+
+        :param start_date: First date. From the first stored date if None
+        :param end_date: Last date. Up to the last stored date if None
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :return: DataFrame with country, date and value columns, sorted by country and date
+        """
+        table_name = table_name or self.deaths_table
+        key = ('date_range', table_name, start_date, end_date)
+
+        def query():
+            sql = 'SELECT * FROM ' + table_name + ' WHERE date>=? AND date<=? ORDER BY country, date;'
+            return self._read_sql(sql, self._date_bounds(start_date, end_date))
+
+        return self._cached_query(key, query).copy()
+
+    def get_top_countries(self, n=10, date=None, table_name=None):
+        """
+        Finds the countries with the largest values on a date, e.g. the largest daily change in deaths
+
+        :param n: Number of countries
+        :param date: Date to rank the countries on. The last stored date if None
+        :param table_name: Name of the data table. Defaults to deaths_change_python
+        :return: DataFrame with country and value columns, largest value first
+        """
+        table_name = table_name or self.deaths_change_python_table
+        key = ('top_countries', table_name, n, date)
+
+        def query():
+            if date is None:
+                sql = 'SELECT * FROM ' + table_name + ' WHERE date=(SELECT MAX(date) FROM ' + table_name + ') '
+                params = ()
+            else:
+                sql = 'SELECT * FROM ' + table_name + ' WHERE date=? '
+                params = (pd.Timestamp(date).strftime('%Y-%m-%d %H:%M:%S'),)
+            data_df = self._read_sql(sql + 'ORDER BY 3 DESC, country LIMIT ' + str(int(n)) + ';', params)
+            return data_df.drop(columns='date')
+
+        return self._cached_query(key, query).copy()
+
+    def get_global_totals(self, table_name=None):
+        """
+        Sums the values of all countries per date
+
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :return: Series of global values indexed by date
+        """
+        table_name = table_name or self.deaths_table
+        key = ('global_totals', table_name)
+
+        def query():
+            with self.reader() as con:
+                value_col = con.execute('SELECT * FROM ' + table_name + ' LIMIT 0;').description[2][0]
+            data_df = self._read_sql('SELECT date, SUM(' + value_col + ') AS ' + value_col + ' FROM ' + table_name +
+                                     ' GROUP BY date ORDER BY date;', ())
+            return pd.Series(data_df[value_col].values, index=pd.DatetimeIndex(data_df['date'], name='date'),
+                             name=value_col)
+
+        return self._cached_query(key, query).copy()
+
+    def get_as_of(self, as_of, table_name=None, country=None, start_date=None, end_date=None):
+        """
+        Reconstructs a data table as it was at a past time from its revision log, see create_revisions_table. Only
+        the log rows ingested after as_of are read, through the ingested_at index, and the first of them per row
+        holds the value at as_of
+
+        :param as_of: Time of the snapshot. Naive times are UTC
+        :param table_name: Name of the data table. Defaults to deaths_total
+        :param country: Only the rows of this country. All countries if None
+        :param start_date: First date. From the first stored date if None
+        :param end_date: Last date. Up to the last stored date if None
+        :return: DataFrame with country, date and value columns, sorted by country and date
+        """
+        table_name = table_name or self.deaths_table
+        as_of = pd.Timestamp(as_of)
+        if as_of.tzinfo is not None:
+            as_of = as_of.tz_convert('UTC').tz_localize(None)
+        as_of = as_of.strftime('%Y-%m-%d %H:%M:%S.%f')
+        key = ('as_of', table_name, as_of, country, start_date, end_date)
+
+        def query():
+            with self.reader() as con:
+                value_col = con.execute('SELECT * FROM ' + table_name + ' LIMIT 0;').description[2][0]
+            # SQLite takes the bare value column from the row of MIN(ingested_at). The log is read through the
+            # ingested_at index, which the planner would otherwise skip for the primary key order of the GROUP BY
+            sql = 'SELECT t.country, t.date, CASE WHEN r.country IS NULL THEN t.' + value_col + ' \
+                       ELSE r.' + value_col + ' END AS ' + value_col + ' \
+                   FROM ' + table_name + ' t \
+                   JOIN ' + table_name + '_ingests i ON i.date=t.date AND i.ingested_at<=? \
+                   LEFT JOIN ( \
+                       SELECT country, date, ' + value_col + ', MIN(ingested_at) \
+                       FROM ' + table_name + '_revisions INDEXED BY ' + table_name + '_revisions_ingested_at \
+                       WHERE ingested_at>? GROUP BY country, date \
+                   ) r ON r.country=t.country AND r.date=t.date \
+                   WHERE (r.country IS NULL OR r.' + value_col + ' IS NOT NULL) AND t.date>=? AND t.date<=?'
+            params = (as_of, as_of) + self._date_bounds(start_date, end_date)
+            if country is not None:
+                sql += ' AND t.country=?'
+                params += (country,)
+            return self._read_sql(sql + ' ORDER BY t.country, t.date;', params)
+
+        return self._cached_query(key, query).copy()
+
+    def _cached_query(self, key, query):
+        """
+        Returns the memoized result of a query, or runs it. The memo is a bounded LRU cache that is emptied whenever
+        the data version changes
+
+        :param key: Hashable key of the query and its arguments
+        :param query: Function that runs the query
+        :return: Query result. Callers must not modify it
+        """
+        version = self.get_data_version()
+        with self._cache_lock:
+            if version != self._cache_version:
+                self._query_cache.clear()
+                self._cache_version = version
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._query_cache[key]
+            self.cache_misses += 1
+
+        result = query()
+        with self._cache_lock:
+            if version == self._cache_version:
+                self._query_cache[key] = result
+                if len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        return result
+
+    def _read_sql(self, sql, params):
+        with self.reader() as con:
+            data_df = pd.read_sql_query(sql, con=con, params=params)
+        if 'date' in data_df.columns:
+            data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d %H:%M:%S')
+        return data_df
+
+    def _date_bounds(self, start_date, end_date):
+        """
+        :return: Tuple with the text forms of the date bounds, open bounds replaced by extreme dates. The bounds must
+            stay text, or the NUMERIC affinity of the date columns would turn them into numbers
+        """
+        return pd.Timestamp(start_date).strftime('%Y-%m-%d %H:%M:%S') if start_date is not None else '', \
+            pd.Timestamp(end_date).strftime('%Y-%m-%d %H:%M:%S') if end_date is not None else '9999-12-31 23:59:59'
+
+    def _get_country_ids(self, cursor, countries):
+        """
+        Looks up the ids of countries in the 'countries' dimension table, adding the countries that are not there
+
+        :param cursor: Cursor of the connection in the current transaction
+        :param countries: Series of country names
+        :return: Array of country ids
+        """
+        country_codes, names = pd.factorize(countries.astype(str))
+        cursor.executemany('INSERT OR IGNORE INTO ' + self.countries_table + '(country) VALUES (?);',
+                           [(name,) for name in names])
+        ids = dict(cursor.execute('SELECT country, country_id FROM ' + self.countries_table + ';').fetchall())
+        return np.array([ids[name] for name in names], dtype='int64')[country_codes]
+
+    def _table_exists(self, cursor, table_name):
+        """
+        :param cursor: Cursor of the connection in the current transaction
+        :param table_name: Name of the table
+        :return: Whether the table exists
+        """
+        cursor.execute('SELECT 1 FROM sqlite_master WHERE type=\'table\' AND name=?;', (table_name,))
+        return cursor.fetchone() is not None
+
+    def _open_csv(self, csv_source):
+        """
+        :param csv_source: Path, URL or text file object of a csv file
+        :return: Context manager of a text file object positioned at the start of the file
+        """
+        if hasattr(csv_source, 'read'):
+            csv_source.seek(0)
+            return nullcontext(csv_source)
+        if re.match('https?://', csv_source):
+            return io.TextIOWrapper(urllib.request.urlopen(csv_source), encoding='utf-8', newline='')
+        return open(csv_source, newline='', encoding='utf-8')
+
+    def _parse_header_date(self, header):
+        """
+        :param header: Date column header of a csv file, e.g. '1/22/20'
+        :return: The date as stored in the tables
+        """
+        for date_format in ('%m/%d/%y', '%m/%d/%Y'):
+            try:
+                return datetime.strptime(header, date_format).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                pass
+        raise ValueError('Cannot parse the date column ' + header)
+
+    def _now(self):
+        """
+        :return: The current UTC time as stored in the ingested_at columns
+        """
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def _get_compact_table(self, cursor, table_name):
+        """
+        :param cursor: Cursor of the connection that reads the table
+        :param table_name: Name of the data table
+        :return: Name of the compact table that holds the rows of the data table, None if it is a regular table
+        """
+        if self.compact and self._table_exists(cursor, table_name + '_compact'):
+            return table_name + '_compact'
+        return None
+
+    def _compact_columns(self, cursor, compact_table, alias):
+        """
+        Lookups on the view of a compact table filter on its computed date text, which no index covers, so they read
+        the compact table by (country_id, day) instead and convert only the rows they return
+
+        :param cursor: Cursor of the connection that reads the table
+        :param compact_table: Name of the compact table
+        :param alias: Alias of the compact table in the query, which joins the countries table as c
+        :return: SELECT list with the country, date and value columns of the view
+        """
+        value_col = cursor.execute('SELECT * FROM ' + compact_table + ' LIMIT 0;').description[2][0]
+        return 'c.country, strftime(\'%Y-%m-%d %H:%M:%S\', ' + alias + '.day * 86400, \'unixepoch\') AS date, ' + \
+            alias + '.' + value_col
+
+    def _get_day_number(self, date):
+        """
+        :param date: Date
+        :return: Day number of the date as stored in the compact tables
+        """
+        return int(DataHandler().get_day_numbers(pd.Series([pd.Timestamp(date)]))[0])
+
+    def _create_key_table(self, cursor, name, data_df, compact=False):
+        """
+        Creates a temporary table with the (country, date) keys of the data rows
+
+        :param cursor: Cursor of the connection that reads the keys
+        :param name: Name of the temporary table
+        :param data_df: Data frame with country and date columns
+        :param compact: Store the keys as the (country_id, day) keys of the compact tables. Countries without an id
+            have no stored rows and are left out
+        :return:
+        """
+        cursor.execute('DROP TABLE IF EXISTS temp.' + name + ';')
+        if compact:
+            ids = dict(cursor.execute('SELECT country, country_id FROM ' + self.countries_table + ';').fetchall())
+            country_ids = data_df['country'].astype(str).map(ids)
+            known = country_ids.notna().values
+            cursor.execute('CREATE TEMP TABLE ' + name + ' (country_id INT, day INT, PRIMARY KEY (country_id, day));')
+            cursor.executemany('INSERT OR IGNORE INTO temp.' + name + ' VALUES (?, ?);',
+                               zip(country_ids[known].astype('int64').tolist(),
+                                   DataHandler().get_day_numbers(data_df.loc[known, 'date']).tolist()))
+            return
+        cursor.execute('CREATE TEMP TABLE ' + name + ' (country TEXT, date DATE, PRIMARY KEY (country, date));')
+        cursor.executemany('INSERT OR IGNORE INTO temp.' + name + ' VALUES (?, ?);',
+                           zip(data_df['country'].astype(str).tolist(), self._format_dates(data_df['date']).tolist()))
+
+    def _format_dates(self, dates):
+        """
+        Formats datetime dates the way they are stored as text in the tables
+
+        :param dates: Series of datetime dates
+        :return: Array of date strings
+        """
+        return np.char.replace(np.datetime_as_string(dates.values, unit='s'), 'T', ' ')
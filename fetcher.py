@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import tempfile
+import urllib.error
+import urllib.request
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from datahandler import DataHandler
+from fileutils import write_atomic
+
+Snapshot = namedtuple('Snapshot', ['url', 'content_hash', 'path'])
+
+
+class SnapshotCache:
+
+    def __init__(self, cache_dir='.snapshot_cache'):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.refs_dir = os.path.join(cache_dir, 'refs')
+        self.read_size = 1 << 20  # Bytes read from the response at a time
+        self.timeout = 60
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def fetch(self, url):
+        """
+        Downloads a source file unless the server reports it unchanged. The request carries the ETag and
+        Last-Modified values of the previous download, and the file is stored under the SHA-256 hash of its content.
+        The objects of the previous content are removed once no url refers to them. Whether the content is new to a
+        database is recorded in the database, see Database.get_ingested_hash
+
+        :param url: URL of the source file
+        :return: Snapshot with the content hash and the local path
+        """
+        ref = self._read_ref(url)
+        previous_hash = ref.get('content_hash')
+        request = urllib.request.Request(url)
+        if ref.get('content_hash') and os.path.exists(self._object_path(ref['content_hash'], '.csv')):
+            if ref.get('etag'):
+                request.add_header('If-None-Match', ref['etag'])
+            if ref.get('last_modified'):
+                request.add_header('If-Modified-Since', ref['last_modified'])
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                ref['content_hash'] = self._store(response)
+                ref['etag'] = response.headers.get('ETag')
+                ref['last_modified'] = response.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            # Not modified, the stored object is still current
+
+        ref['url'] = url
+        self._write_ref(url, ref)
+        if previous_hash is not None and previous_hash != ref['content_hash']:
+            self._evict(previous_hash)
+        return Snapshot(url, ref['content_hash'], self._object_path(ref['content_hash'], '.csv'))
+
+    def load_matrix(self, snapshot):
+        """
+        Loads the countries x dates deaths matrix of a snapshot from its sidecar files, creating them on first use so
+        a file is parsed only once
+
+        :param snapshot: Snapshot returned by fetch
+        :return: Tuple with the sorted country names, the DatetimeIndex of dates and the deaths matrix
+        """
+        matrix_path = self._object_path(snapshot.content_hash, '.npy')
+        index_path = self._object_path(snapshot.content_hash, '.json')
+
+        if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+            countries, dates, matrix = DataHandler().read_deaths_matrix(snapshot.path)
+            write_atomic(matrix_path, lambda f: np.save(f, matrix))
+            index = {'countries': countries.tolist(), 'dates': dates.strftime('%Y-%m-%d').tolist()}
+            write_atomic(index_path, lambda f: f.write(json.dumps(index).encode()))
+
+        with open(index_path) as f:
+            index = json.load(f)
+        return np.array(index['countries'], dtype=object), pd.to_datetime(index['dates']), \
+            np.load(matrix_path, mmap_mode='r')
+
+    def _evict(self, content_hash):
+        """
+        Removes the csv file and the sidecar files of a content hash unless a url still refers to it
+
+        :param content_hash: Content hash of the objects
+        :return:
+        """
+        for name in os.listdir(self.refs_dir):
+            try:
+                with open(os.path.join(self.refs_dir, name)) as f:
+                    if json.load(f).get('content_hash') == content_hash:
+                        return
+            except (FileNotFoundError, ValueError):
+                pass  # Removed or still being written by another process
+        for extension in ('.csv', '.npy', '.json'):
+            try:
+                os.remove(self._object_path(content_hash, extension))
+            except FileNotFoundError:
+                pass
+
+    def _store(self, response):
+        """
+        Streams a response body to the object store while hashing it
+
+        :param response: HTTP response
+        :return: SHA-256 hex digest of the content
+        """
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: response.read(self.read_size), b''):
+                    digest.update(block)
+                    f.write(block)
+            content_hash = digest.hexdigest()
+            os.replace(tmp_path, self._object_path(content_hash, '.csv'))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def _object_path(self, content_hash, extension):
+        return os.path.join(self.objects_dir, content_hash + extension)
+
+    def _ref_path(self, url):
+        return os.path.join(self.refs_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _read_ref(self, url):
+        try:
+            with open(self._ref_path(url)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_ref(self, url, ref):
+        write_atomic(self._ref_path(url), lambda f: f.write(json.dumps(ref).encode()))
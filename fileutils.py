@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+
+def write_atomic(path, write):
+    """
+    Writes a file through a temporary file in the same directory, so readers never see a partial file
+
+    :param path: Path of the file
+    :param write: Function that writes the content to a binary file object
+    :return:
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
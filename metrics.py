@@ -0,0 +1,249 @@
+import functools
+import json
+import sqlite3
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+_sink = None  # Receives the records while instrumentation is enabled, see enable
+_trace_memory = False
+_started_tracemalloc = False
+_patched = {}  # (class, method name) -> original function
+_local = threading.local()  # Stack of the records of the calls in progress on this thread
+
+
+class MemorySink:
+    """
+    Keeps the records in a list, e.g. for tests
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+class JsonLinesSink:
+    """
+    Appends each record as one JSON line to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class Connection(sqlite3.Connection):
+    """
+    Connection whose cursors time their statements while instrumentation is enabled. The statements are counted in
+    every call in progress on the thread
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or Cursor)
+
+    # The shortcuts of sqlite3.Connection do not go through the cursor methods
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
+
+    def executescript(self, *args, **kwargs):
+        return self.cursor().executescript(*args, **kwargs)
+
+
+class Cursor(sqlite3.Cursor):
+
+    def execute(self, *args, **kwargs):
+        if _sink is None:
+            return super().execute(*args, **kwargs)
+        with _statement():
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        if _sink is None:
+            return super().executemany(*args, **kwargs)
+        with _statement():
+            return super().executemany(*args, **kwargs)
+
+    def executescript(self, *args, **kwargs):
+        if _sink is None:
+            return super().executescript(*args, **kwargs)
+        with _statement():
+            return super().executescript(*args, **kwargs)
+
+
+def enable(sink, trace_memory=False, classes=None):
+    """
+    Records every call of the DataHandler and Database methods to a sink: wall and CPU time, rows in and out, the
+    SQLite statements and, with trace_memory, the peak of memory allocated during the call. The methods are wrapped
+    only while enabled, so disabled instrumentation costs nothing
+
+    :param sink: Object with a write(record) method, e.g. MemorySink or JsonLinesSink
+    :param trace_memory: Trace allocations with tracemalloc, which slows down the calls considerably
+    :param classes: Classes whose methods are recorded. Defaults to DataHandler and Database
+    :return:
+    """
+    global _sink, _trace_memory, _started_tracemalloc
+    if classes is None:
+        from datahandler import DataHandler
+        from db import Database
+        classes = [DataHandler, Database]
+
+    disable()
+    for cls in classes:
+        for name, func in list(vars(cls).items()):
+            # Context managers such as transaction() would only be timed while their generator is created
+            if name.startswith('__') or not callable(func) or hasattr(func, '__wrapped__'):
+                continue
+            _patched[(cls, name)] = func
+            setattr(cls, name, _instrument(cls.__name__, name, func))
+
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _sink = sink
+
+
+def disable():
+    """
+    Stops recording and restores the original methods
+
+    :return:
+    """
+    global _sink, _trace_memory, _started_tracemalloc
+    _sink = None
+    for (cls, name), func in _patched.items():
+        setattr(cls, name, func)
+    _patched.clear()
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    _trace_memory = False
+
+
+@contextmanager
+def recording(sink, trace_memory=False, classes=None):
+    """
+    Enables instrumentation for the enclosed block, see enable
+
+    :return: The sink
+    """
+    enable(sink, trace_memory, classes)
+    try:
+        yield sink
+    finally:
+        disable()
+
+
+def _instrument(class_name, method_name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sink = _sink
+        if sink is None:
+            return func(*args, **kwargs)
+
+        stack = _get_stack()
+        record = {'class': class_name, 'method': method_name, 'depth': len(stack),
+                  'rows_in': sum(_count_rows(arg, ints=False) or 0 for arg in args[1:] + tuple(kwargs.values())),
+                  'sql_statements': 0, 'sql_seconds': 0.0}
+        memory = _start_memory(stack)
+        stack.append(record)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            result = func(*args, **kwargs)
+            record['rows_out'] = _count_rows(result)
+            return result
+        except BaseException as e:
+            record['error'] = type(e).__name__ + ': ' + str(e)
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.thread_time() - cpu
+            stack.pop()
+            if memory is not None:
+                record['peak_bytes'] = _stop_memory(stack, record, memory)
+            sink.write(record)
+
+    return wrapper
+
+
+@contextmanager
+def _statement():
+    stack = _get_stack()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for record in stack:
+            record['sql_statements'] += 1
+            record['sql_seconds'] += elapsed
+
+
+def _get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _start_memory(stack):
+    """
+    Starts measuring the peak memory of a call. tracemalloc keeps a single peak, so the peak reached so far by the
+    enclosing call is saved before it is reset
+
+    :param stack: Records of the enclosing calls
+    :return: Traced memory at the start of the call, None if memory is not traced
+    """
+    if not (_trace_memory and tracemalloc.is_tracing()):
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1]['_peak_seen'] = max(stack[-1].get('_peak_seen', 0), peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+def _stop_memory(stack, record, start):
+    """
+    :param stack: Records of the enclosing calls
+    :param record: Record of the call
+    :param start: Traced memory at the start of the call
+    :return: Peak bytes allocated during the call, including its nested calls, on top of the memory in use at its
+        start
+    """
+    peak = max(record.pop('_peak_seen', 0), tracemalloc.get_traced_memory()[1])
+    if stack:
+        stack[-1]['_peak_seen'] = max(stack[-1].get('_peak_seen', 0), peak)
+    return peak - start
+
+
+def _count_rows(value, ints=True):
+    """
+    :param value: Argument or return value of a method
+    :param ints: Count an int as its value, e.g. a returned number of changed rows
+    :return: Number of rows of a data frame, series or array, the largest count in a tuple, None for other values
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray, list)):
+        return len(value)
+    if ints and isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, tuple):
+        counts = [count for count in (_count_rows(item, ints) for item in value) if count is not None]
+        return max(counts) if counts else None
+    return None
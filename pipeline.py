@@ -0,0 +1,200 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from datahandler import DataHandler
+from fetcher import SnapshotCache
+
+CSSE_TIME_SERIES_URL = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/' \
+                       'csse_covid_19_time_series/'
+
+# A time series file and the metric it holds. Its tables are name + '_total' and name + '_change_python'
+Series = namedtuple('Series', ['name', 'metric', 'source'])
+
+CSSE_SERIES = [
+    Series('deaths', 'deaths', CSSE_TIME_SERIES_URL + 'time_series_covid19_deaths_global.csv'),
+    Series('confirmed', 'confirmed', CSSE_TIME_SERIES_URL + 'time_series_covid19_confirmed_global.csv'),
+    Series('recovered', 'recovered', CSSE_TIME_SERIES_URL + 'time_series_covid19_recovered_global.csv'),
+    Series('deaths_us', 'deaths', CSSE_TIME_SERIES_URL + 'time_series_covid19_deaths_US.csv'),
+    Series('confirmed_us', 'confirmed', CSSE_TIME_SERIES_URL + 'time_series_covid19_confirmed_US.csv'),
+]
+
+
+def transform_block(csv_source, metric, since, until, seeded):
+    """
+    Reads the dates in (since, until] of a time series file and calculates the totals and daily changes per country.
+    Runs in a worker process
+
+    :param csv_source: Path or URL of the csv file
+    :param metric: Name of the value column
+    :param since: Dates after this date are read. All dates from the start if None
+    :param until: Dates up to and including this date are read
+    :param seeded: The first date read only seeds the daily change of the next date and is not returned
+    :return: Tuple with the totals and the daily change data frames
+    """
+    countries, dates, matrix = DataHandler().read_deaths_matrix(csv_source, since=since, until=until)
+    return transform_matrix(countries, dates, matrix, metric, seeded)
+
+
+def transform_snapshot(cache_dir, snapshot, metric, since):
+    """
+    Like transform_block for all dates after since, but reads the matrix sidecar of a cached snapshot, so a file is
+    parsed only once however many databases are synced from it. Runs in a worker process
+
+    :param cache_dir: Directory of the SnapshotCache
+    :param snapshot: Snapshot of the csv file
+    :param metric: Name of the value column
+    :param since: Dates after this date are returned. All dates if None
+    :return: Tuple with the totals and the daily change data frames
+    """
+    countries, dates, matrix = SnapshotCache(cache_dir).load_matrix(snapshot)
+    start = 0 if since is None else int((dates <= since).sum())
+    seeded = start > 0
+    first = start - 1 if seeded else 0  # The date before the first returned one seeds its daily change
+    return transform_matrix(countries, dates[first:], np.asarray(matrix[:, first:]), metric, seeded)
+
+
+def transform_matrix(countries, dates, matrix, metric, seeded):
+    """
+    :param countries: Sorted country names
+    :param dates: DatetimeIndex of the dates
+    :param matrix: Countries x dates totals matrix
+    :param metric: Name of the value column
+    :param seeded: The first date only seeds the daily change of the next date and is not returned
+    :return: Tuple with the totals and the daily change data frames
+    """
+    dh = DataHandler()
+    changes = dh.get_daily_change_matrix(matrix)
+    if seeded:
+        dates, matrix, changes = dates[1:], matrix[:, 1:], changes[:, 1:]
+
+    return dh.matrix_to_frame(countries, dates, matrix, value_name=metric), \
+        dh.matrix_to_frame(countries, dates, changes, value_name=metric + '_change')
+
+
+class Pipeline:
+
+    def __init__(self, db, series=None, max_workers=None, block_size=None, cache=None):
+        """
+        :param db: Database the series are synced to. Only this process writes to it
+        :param series: Series to sync. Defaults to all CSSE time series files
+        :param max_workers: Number of worker processes. Defaults to the number of CPUs
+        :param block_size: Number of date columns per worker task, so a large file is split across workers. One task
+            per file if None
+        :param cache: Optional SnapshotCache. Files whose content the database already holds are skipped, and the
+            others are read from the matrix sidecars of the cache
+        """
+        self.db = db
+        self.series = series if series is not None else CSSE_SERIES
+        self.max_workers = max_workers or os.cpu_count()
+        self.block_size = block_size
+        self.cache = cache
+
+    def get_tables(self, series):
+        """
+        :param series: Series
+        :return: Tuple with the names of the totals table and the daily change table of the series
+        """
+        return series.name + '_total', series.name + '_change_python'
+
+    def run(self):
+        """
+        Syncs all series. The files are read and transformed in a process pool, and each series is written to the
+        database by this process as soon as all its blocks are done, so the upserts never compete for the database
+
+        :return: Dict with the number of changed totals and change rows per series name
+        """
+        tasks, snapshots, results = [], {}, {}
+        for series in self.series:
+            if self.cache is None:
+                tasks.append((series, [(transform_block, (series.source, series.metric) + block)
+                                       for block in self._get_blocks(series, series.source)]))
+                continue
+
+            snapshot = self.cache.fetch(series.source)
+            if snapshot.content_hash == self.db.get_ingested_hash(self.get_tables(series)[0]):
+                results[series.name] = (0, 0)
+                continue
+            snapshots[series.name] = snapshot
+            tasks.append((series, [(transform_snapshot, (self.cache.cache_dir, snapshot, series.metric,
+                                                         self._get_sync_start_date(series)))]))
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures, parts = {}, {}
+            for series, calls in tasks:
+                parts[series.name] = [None] * len(calls)
+                if len(calls) == 0:
+                    results[series.name] = (0, 0)
+                for i, (function, args) in enumerate(calls):
+                    futures[pool.submit(function, *args)] = (series, i)
+
+            for future in as_completed(futures):
+                series, i = futures[future]
+                parts[series.name][i] = future.result()
+                if all(part is not None for part in parts[series.name]):
+                    results[series.name] = self._write(series, parts.pop(series.name), snapshots.get(series.name))
+
+        return results
+
+    def _get_blocks(self, series, source):
+        """
+        Splits the dates of a file that need syncing into worker tasks. Each block after the first also reads the
+        date before it to seed its first daily change
+
+        :param series: Series of the file
+        :param source: Path or URL of the file
+        :return: List of (since, until, seeded) arguments of transform_block
+        """
+        dates = DataHandler().read_csv_dates(source)
+        since = self._get_sync_start_date(series)
+        start = 0 if since is None else int((dates <= since).sum())
+        step = self.block_size or max(len(dates) - start, 1)
+
+        blocks = []
+        for first in range(start, len(dates), step):
+            last = min(first + step, len(dates)) - 1
+            seeded = first > 0
+            read_since = dates[first - 2] if first >= 2 else None
+            blocks.append((read_since, dates[last], seeded))
+        return blocks
+
+    def _get_sync_start_date(self, series):
+        """
+        Creates the tables of a series if needed. The totals table records ingest times, so the rows of a
+        WriteCoordinator submitted for it are ordered against the synced rows
+
+        :param series: Series
+        :return: Date after which the file has to be read, see Database.get_sync_start_date
+        """
+        total_table, change_table = self.get_tables(series)
+        self.db.create_data_table(total_table, series.metric)
+        self.db.create_data_table(change_table, series.metric + '_change')
+        self.db.create_ingest_times_table(total_table)
+        return self.db.get_sync_start_date(total_table)
+
+    def _write(self, series, parts, snapshot=None):
+        """
+        Syncs the transformed blocks of a series to its tables in one transaction, then refreshes their matrix
+        exports if the database has an export directory
+
+        :param series: Series of the blocks
+        :param parts: List of (totals, changes) data frames in date order
+        :param snapshot: Snapshot the blocks were read from, recorded as ingested in the same transaction
+        :return: Tuple with the number of changed totals rows and change rows
+        """
+        total_table, change_table = self.get_tables(series)
+        totals_df = pd.concat([part[0] for part in parts], ignore_index=True)
+        changes_df = pd.concat([part[1] for part in parts], ignore_index=True)
+
+        with self.db.transaction():
+            changed_rows = self.db.insert_to_table(totals_df, total_table, incremental=True), \
+                self.db.insert_to_table(changes_df, change_table, incremental=True)
+            if snapshot is not None:
+                self.db.mark_ingested(total_table, series.source, snapshot.content_hash)
+
+        if self.db.export_dir is not None:
+            self.db.export_matrix(total_table)
+            self.db.export_matrix(change_table)
+        return changed_rows
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from backfill import DailyReportBackfill
+from datahandler import DataHandler
+from db import Database
+import testutils
+
+
+class FlakyHandler(SimpleHTTPRequestHandler):
+    """
+    Stand-in for the CSSE file server. Serves the report files of a directory and fails the first request of each
+    path listed in the server's flaky set
+    """
+
+    def do_GET(self):
+        if self.path in self.server.flaky:
+            self.server.flaky.remove(self.path)
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDailyReportBackfill(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.reports_dir = os.path.join(self.tmp_dir.name, 'reports')
+        os.makedirs(self.reports_dir)
+
+        # One daily report per date column of the dummy data, with the schema change of March 2020
+        self.csv_df = testutils.get_dummy_data()
+        self.date_cols = ['1/1/2020', '1/4/2020', '1/15/2020', '2/1/2020', '2/13/2020']
+        for i, col in enumerate(self.date_cols):
+            report_df = self.csv_df[['Province/State', 'Country/Region', col]].rename(columns={col: 'Deaths'})
+            if i >= 2:
+                report_df = report_df.rename(columns={'Province/State': 'Province_State',
+                                                      'Country/Region': 'Country_Region'})
+            report_df.to_csv(os.path.join(self.reports_dir, pd.to_datetime(col).strftime('%m-%d-%Y') + '.csv'),
+                             index=False)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(FlakyHandler, directory=self.reports_dir))
+        self.server.flaky = {'/01-15-2020.csv'}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:' + str(self.server.server_port) + '/'
+
+        self.db = Database(os.path.join(self.tmp_dir.name, 'Backfill.db'))
+        self.backfill = DailyReportBackfill(self.db, self.base_url, concurrency=3, batch_size=2)
+        self.backfill.retry_delay = 0.01
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_backfill_matches_time_series_transform(self):
+        summary = self.backfill.run('2020-01-01', '2020-02-13')
+        self.assertEqual(summary['loaded'], 5)
+        self.assertEqual(len(summary['missing']), 44 - 5)
+
+        dh = DataHandler()
+        expected_df = dh.get_total_deaths_per_country_and_day(self.csv_df)
+        expected_df = expected_df.sort_values(['country', 'date']).reset_index(drop=True)
+        expected_df['date'] = expected_df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.reader() as con:
+            totals_df = pd.read_sql('SELECT * FROM deaths_total ORDER BY country, date;', con=con)
+            changes_df = pd.read_sql('SELECT * FROM deaths_change_python ORDER BY country, date;', con=con)
+        self.assertTrue(expected_df.equals(totals_df))
+
+        expected_df = testutils.get_dummy_change_data()
+        expected_df['date'] = expected_df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        self.assertTrue(expected_df.equals(changes_df))
+
+    def test_backfill_resumes(self):
+        self.backfill.run('2020-01-01', '2020-01-15')
+        self.assertEqual(len(self.db.get_backfilled_dates('deaths_total')), 3)
+
+        summary = self.backfill.run('2020-01-01', '2020-02-13')
+        self.assertEqual(summary['loaded'], 2, "Reports loaded by the first run must not be fetched again")
+        self.assertEqual(self.db.execute_query('SELECT COUNT(*) FROM deaths_total;')[0][0], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
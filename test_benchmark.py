@@ -0,0 +1,62 @@
+import unittest
+
+from benchmark import Benchmark, STAGES
+from datahandler import DataHandler
+import testutils
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_data_layout(self):
+        csv_df = testutils.get_synthetic_data(countries=4, provinces=3, dates=10)
+        self.assertListEqual(list(csv_df.columns.values[:3]), list(testutils.get_dummy_data().columns.values[:3]))
+        self.assertEqual(csv_df.shape, (4 * 3, 3 + 10))
+
+        totals_df = DataHandler().get_total_deaths_per_country_and_day(csv_df)
+        self.assertEqual(len(totals_df), 4 * 10)
+        self.assertTrue((DataHandler().get_daily_change_of_deaths(totals_df)['deaths_change'] >= 0).all(),
+                        "Generated deaths must be cumulative")
+
+    def test_corrections_share(self):
+        csv_df = testutils.get_synthetic_data(countries=50, provinces=2, dates=100)
+        corrected_df = testutils.get_corrected_data(csv_df, share=0.1)
+
+        changed = (corrected_df.iloc[:, 3:] != csv_df.iloc[:, 3:]).to_numpy().mean()
+        self.assertAlmostEqual(changed, 0.1, delta=0.02)
+        self.assertTrue(csv_df.iloc[:, :3].equals(corrected_df.iloc[:, :3]))
+
+        corrected_df = testutils.get_corrected_data(csv_df, share=0.1, window=14)
+        changed = (corrected_df.iloc[:, 3:] != csv_df.iloc[:, 3:]).to_numpy().any(axis=0)
+        self.assertFalse(changed[:-14].any(), "Only the trailing window is corrected")
+        self.assertTrue(changed[-14:].any())
+
+    def test_run_and_regression_check(self):
+        benchmark = Benchmark(sizes=[(5, 2, 20)], correction_share=0.05)
+        results = benchmark.run()
+        self.assertListEqual(list(results['results'][0]['stages']), STAGES)
+        self.assertEqual(results['results'][0]['rows'], 5 * 20)
+        self.assertGreater(results['results'][0]['changed_rows'], 0)
+        self.assertListEqual(benchmark.check_regressions(results, results), [])
+        for measures in results['results'][0]['stages'].values():
+            self.assertListEqual(sorted(measures), ['cpu_seconds', 'peak_mb', 'seconds'])
+
+        # A stage that got slower than its baseline regresses, one that got faster does not
+        baseline = {'results': [dict(results['results'][0], stages={
+            'transform': {'seconds': 0.0, 'peak_mb': 1000.0},
+            'diff': {'seconds': 1000.0, 'peak_mb': 1000.0}})]}
+        benchmark.min_seconds = 0.0
+        regressions = benchmark.check_regressions(results, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('transform'))
+
+    def test_run_without_memory_trace(self):
+        benchmark = Benchmark(sizes=[(5, 2, 20)], correction_share=0.05, trace_memory=False)
+        results = benchmark.run()
+        for measures in results['results'][0]['stages'].values():
+            self.assertListEqual(sorted(measures), ['cpu_seconds', 'seconds'])
+        self.assertListEqual(benchmark.check_regressions(results, Benchmark(sizes=[(5, 2, 20)]).run()), [],
+                             "Peak memory is only compared when both runs traced it")
+
+
+if __name__ == '__main__':
+    unittest.main()
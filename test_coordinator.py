@@ -0,0 +1,138 @@
+import os
+import queue
+import tempfile
+import threading
+import unittest
+
+import pandas as pd
+
+from coordinator import WriteCoordinator
+from datahandler import DataHandler
+from db import Database
+import testutils
+
+
+class TestWriteCoordinator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = Database(':memory:')
+        self.db.create_total_deaths_table()
+        self.db.create_deaths_change_python_table()
+        self.total_deaths_df = DataHandler().get_total_deaths_per_country_and_day(testutils.get_dummy_data())
+
+    def tearDown(self) -> None:
+        self.db.close()
+
+    def _read_table(self, table_name):
+        with self.db.reader() as con:
+            data_df = pd.read_sql('SELECT * FROM ' + table_name + ' ORDER BY country, date;', con=con)
+        data_df['date'] = pd.to_datetime(data_df['date'])
+        return data_df
+
+    def _expected(self, data_df):
+        return data_df.sort_values(['country', 'date']).reset_index(drop=True)
+
+    def test_parallel_producers_coalesce_by_ingest_time(self):
+        coordinator = WriteCoordinator(self.db)
+        corrected_df = self.total_deaths_df.copy()
+        corrected_df['deaths'] += 100
+
+        # Each producer submits every date of one country, the corrections with the later ingest time
+        def produce(country):
+            rows = self.total_deaths_df['country'] == country
+            coordinator.submit(corrected_df[rows], 'deaths_total', 'deaths_change_python', '2020-03-02')
+            coordinator.submit(self.total_deaths_df[rows], 'deaths_total', 'deaths_change_python', '2020-03-01')
+
+        threads = [threading.Thread(target=produce, args=(country,)) for country in ['Australia', 'Sri Lanka', 'UK',
+                                                                                     'US']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        coordinator.close()
+
+        self.assertEqual(coordinator.batches, 1, "Queued change sets are written in one transaction")
+        self.assertEqual((coordinator.rows_submitted, coordinator.rows_written), (40, 20))
+        self.assertTrue(self._expected(corrected_df).equals(self._read_table('deaths_total')))
+        expected_changes = DataHandler().get_daily_change_of_deaths(corrected_df).reset_index(drop=True)
+        self.assertTrue(expected_changes.equals(self._read_table('deaths_change_python')))
+
+    def test_stale_rows_of_later_batches_are_ignored(self):
+        with WriteCoordinator(self.db) as coordinator:
+            coordinator.submit(self.total_deaths_df, 'deaths_total', ingested_at='2020-03-02').result()
+
+            stale_df = self.total_deaths_df.iloc[:4].assign(deaths=-1)
+            newer_df = self.total_deaths_df.iloc[4:8].assign(deaths=-2)
+            coordinator.submit(stale_df, 'deaths_total', ingested_at='2020-03-01').result()
+            coordinator.submit(newer_df, 'deaths_total', ingested_at='2020-03-03').result()
+
+        expected_df = self.total_deaths_df.copy()
+        expected_df.loc[4:7, 'deaths'] = -2
+        self.assertTrue(self._expected(expected_df).equals(self._read_table('deaths_total')))
+
+    def test_ingest_times_persist_across_coordinators(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_name = os.path.join(tmp_dir, 'Coordinator.db')
+            with Database(db_name) as db, WriteCoordinator(db) as coordinator:
+                db.create_total_deaths_table()
+                coordinator.submit(self.total_deaths_df, 'deaths_total', ingested_at='2020-03-02').result()
+
+            # A restarted writer, e.g. another process, must not overwrite the rows with older ones
+            with Database(db_name) as db, WriteCoordinator(db) as coordinator:
+                stale_df = self.total_deaths_df.iloc[:4].assign(deaths=-1)
+                newer_df = self.total_deaths_df.iloc[4:8].assign(deaths=-2)
+                coordinator.submit(stale_df, 'deaths_total', ingested_at='2020-03-01 12:00+00:00').result()
+                coordinator.submit(newer_df, 'deaths_total', ingested_at='2020-03-03 01:00+02:00').result()
+                self.assertEqual(coordinator.rows_written, 4)
+
+                with db.reader() as con:
+                    stored_df = pd.read_sql('SELECT * FROM deaths_total ORDER BY country, date;', con=con)
+                    ingest_times = con.execute('SELECT ingested_at, COUNT(*) FROM deaths_total_ingest_times \
+                                                GROUP BY ingested_at;').fetchall()
+
+        expected_df = self.total_deaths_df.copy()
+        expected_df.loc[4:7, 'deaths'] = -2
+        stored_df['date'] = pd.to_datetime(stored_df['date'])
+        self.assertTrue(self._expected(expected_df).equals(stored_df))
+        self.assertListEqual(ingest_times, [('2020-03-02 00:00:00.000000', 16), ('2020-03-02 23:00:00.000000', 4)])
+
+    def test_direct_writes_are_ordered_with_submissions(self):
+        # The Pipeline and the daily report backfill write their rows directly, with the current time
+        self.db.create_ingest_times_table('deaths_total')
+        self.db.insert_to_deaths_total_table(self.total_deaths_df, incremental=True)
+        self.db.update_deaths_change_python_table(self.total_deaths_df)
+        changes_df = self._read_table('deaths_change_python')
+
+        with WriteCoordinator(self.db) as coordinator:
+            stale_df = self.total_deaths_df.assign(deaths=-1)
+            coordinator.submit(stale_df, 'deaths_total', 'deaths_change_python', ingested_at='2020-03-01').result()
+            self.assertEqual(coordinator.rows_written, 0, "Rows ingested before a direct write are dropped")
+
+            newer_df = self.total_deaths_df.iloc[:4].assign(deaths=-2)
+            coordinator.submit(newer_df, 'deaths_total', ingested_at=pd.Timestamp.now(tz='UTC') + pd.Timedelta(days=1))
+        self.assertEqual(coordinator.rows_written, 4)
+
+        expected_df = self.total_deaths_df.copy()
+        expected_df.loc[:3, 'deaths'] = -2
+        self.assertTrue(self._expected(expected_df).equals(self._read_table('deaths_total')))
+        self.assertTrue(changes_df.equals(self._read_table('deaths_change_python')))
+
+        # A direct write with an older time than a stored one leaves that row alone
+        self.db.bulk_upsert_to_table(self.total_deaths_df, 'deaths_total')
+        self.assertTrue(self._expected(expected_df).equals(self._read_table('deaths_total')))
+
+    def test_backpressure_and_errors(self):
+        coordinator = WriteCoordinator(self.db, max_queue=1)
+        failing = coordinator.submit(self.total_deaths_df, 'no_such_table')
+        with self.assertRaises(queue.Full):
+            coordinator.submit(self.total_deaths_df, 'deaths_total', timeout=0.05)
+
+        coordinator.start()
+        self.assertIsInstance(failing.exception(timeout=10), Exception)
+        coordinator.submit(self.total_deaths_df, 'deaths_total').result(timeout=10)
+        coordinator.close()
+        self.assertEqual(len(self._read_table('deaths_total')), 20, "A failed batch does not stop the writer")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import contextlib
+import io
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import covid19
+from db import Database
+import testutils
+
+
+class TestCovid19(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.tmp_dir.name, 'covid19.db')
+        self.csv_path = os.path.join(self.tmp_dir.name, 'deaths.csv')
+        self.csv_df = testutils.get_dummy_data()
+        self.csv_df.to_csv(self.csv_path, index=False)
+        self.sync_args = ['--source', pathlib.Path(self.csv_path).as_uri(),
+                          '--cache-dir', os.path.join(self.tmp_dir.name, 'cache'), '--workers', '1']
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def run_main(self, argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(covid19.main(['--db', self.db_name] + argv), 0)
+        return out.getvalue()
+
+    def test_parser_does_not_import_pandas(self):
+        code = 'import sys, covid19; covid19.build_parser(); print("pandas" in sys.modules)'
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(covid19.__file__))).stdout
+        self.assertEqual(output.strip(), 'False')
+
+    def test_sync_and_query(self):
+        self.assertIn('deaths 20/20', self.run_main(['sync'] + self.sync_args))
+        self.assertIn('deaths 0/0', self.run_main(['sync'] + self.sync_args), "An unchanged file is skipped")
+
+        top = self.run_main(['query', 'top', '-n', '2', '--format', 'csv'])
+        self.assertEqual(top.splitlines(), ['country,deaths_change', 'Australia,3', 'Sri Lanka,2'])
+        series = self.run_main(['query', 'country', '--country', 'US', '--format', 'csv'])
+        self.assertEqual(series.splitlines()[-1], '2020-02-13,19')
+
+    def test_daemon_syncs_on_trigger(self):
+        args = covid19.build_parser().parse_args(['--db', self.db_name, 'daemon'] + self.sync_args)
+        trigger_file = os.path.join(self.tmp_dir.name, 'trigger')
+        with Database(self.db_name) as db, contextlib.redirect_stdout(io.StringIO()):
+            service = covid19.Daemon(db, covid19.create_pipeline(db, args), interval=3600, trigger_file=trigger_file)
+            service.poll_interval = 0.05
+            thread = threading.Thread(target=service.run)
+            thread.start()
+            try:
+                self.wait_for(lambda: service.last_results is not None)
+                self.assertEqual(service.last_results, {'deaths': (20, 20)})
+
+                self.csv_df.loc[0, '2/13/2020'] = 9
+                self.csv_df.to_csv(self.csv_path, index=False)
+                last_sync = service.last_sync
+                pathlib.Path(trigger_file).touch()
+                self.wait_for(lambda: service.last_sync != last_sync)
+                self.assertEqual(service.last_results, {'deaths': (1, 1)})
+                self.assertFalse(os.path.exists(trigger_file))
+            finally:
+                service.stop()
+                thread.join()
+
+    def test_daemon_survives_a_failed_first_sync(self):
+        os.remove(self.csv_path)
+        args = covid19.build_parser().parse_args(['--db', self.db_name, 'daemon'] + self.sync_args)
+        trigger_file = os.path.join(self.tmp_dir.name, 'trigger')
+        errors = io.StringIO()
+        with Database(self.db_name) as db, contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(errors):
+            service = covid19.Daemon(db, covid19.create_pipeline(db, args), interval=3600, trigger_file=trigger_file)
+            service.poll_interval = 0.05
+            thread = threading.Thread(target=service.run)
+            thread.start()
+            try:
+                self.wait_for(lambda: 'Sync failed' in errors.getvalue())
+                self.assertTrue(thread.is_alive(), "The daemon keeps running after the startup sync failed")
+
+                self.csv_df.to_csv(self.csv_path, index=False)
+                pathlib.Path(trigger_file).touch()
+                self.wait_for(lambda: service.last_results is not None)
+                self.assertEqual(service.last_results, {'deaths': (20, 20)})
+            finally:
+                service.stop()
+                thread.join()
+
+    def wait_for(self, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'Timed out')
+            time.sleep(0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
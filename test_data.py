@@ -1,4 +1,6 @@
+import io
 import unittest
+import numpy as np
 import pandas as pd
 import pandas.api.types as ptypes
 
@@ -84,6 +86,35 @@ class TestData(unittest.TestCase):
 
         self.assertEqual(changed_row_ids, updated_rows_list, "The output of get_modified_data_rows must match the changed_row_ids ")
 
+    def test_row_changes_independent_of_row_order(self):
+        curr_data_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')].copy()
+        curr_data_df = curr_data_df.sample(frac=1, random_state=7)  # Shuffled, as rows may come back from the db
+        curr_data_df['date'] = curr_data_df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[3, 'deaths'] = new_df.loc[3, 'deaths'] + 1
+
+        inserted, updated, unchanged = self.data.get_row_changes(new_df, curr_data_df)
+
+        self.assertListEqual(list(inserted), list(new_df[new_df['date'] == pd.to_datetime('2/13/2020')].index))
+        self.assertListEqual(list(updated), [3])
+        self.assertEqual(len(inserted) + len(updated) + len(unchanged), len(new_df))
+
+    def test_row_changes_and_checksums_ignore_value_dtype(self):
+        # A blank cell makes read_csv parse its column as float64, while the stored values are integers
+        float_df = self.total_deaths_df.assign(deaths=self.total_deaths_df['deaths'].astype('float64'))
+        int32_df = self.total_deaths_df.assign(deaths=self.total_deaths_df['deaths'].astype('int32') - 3)
+
+        inserted, updated, unchanged = self.data.get_row_changes(float_df, self.total_deaths_df)
+        self.assertEqual((len(inserted), len(updated), len(unchanged)), (0, 0, len(float_df)))
+        self.assertTrue(self.data.get_checksum_per_country(float_df).equals(
+            self.data.get_checksum_per_country(self.total_deaths_df)))
+        self.assertTrue(self.data.get_checksum_per_country(int32_df).equals(self.data.get_checksum_per_country(
+            self.total_deaths_df.assign(deaths=self.total_deaths_df['deaths'] - 3))))
+
+        float_df.loc[0, 'deaths'] += 0.5
+        self.assertListEqual(list(self.data.get_changed_rows(float_df, self.total_deaths_df)), [0])
+
     def test_daily_change_calculation(self):
         dummy_data = testutils.get_dummy_data()
         d = DataHandler()
@@ -104,3 +135,104 @@ class TestData(unittest.TestCase):
         actual = d.get_daily_change_of_deaths(deaths)
         self.assertEqual(actual.loc[0, 'deaths_change'], 4, "The first day's change in deaths should be 4")
 
+    def test_numpy_engine_total_deaths_identical(self):
+        actual = self.data.get_total_deaths_per_country_and_day(self.csv_df, engine='numpy')
+        self.assertTrue(self.total_deaths_df.equals(actual), "Both engines must produce identical total deaths")
+
+    def test_numpy_engine_daily_change_identical(self):
+        expected = self.data.get_daily_change_of_deaths(self.total_deaths_df)
+
+        actual = self.data.get_daily_change_of_deaths(self.total_deaths_df, engine='numpy')
+        self.assertTrue(expected.equals(actual), "Both engines must produce identical daily changes")
+        self.assertListEqual(list(expected.index), list(actual.index))
+
+        shuffled = self.total_deaths_df.sample(frac=1, random_state=3)
+        actual = self.data.get_daily_change_of_deaths(shuffled, engine='numpy')
+        self.assertTrue(expected.equals(actual), "Row order of the input must not matter")
+
+    def test_numpy_engine_daily_change_falls_back_on_missing_rows(self):
+        ragged = self.total_deaths_df.drop(index=[0])
+        expected = self.data.get_daily_change_of_deaths(ragged)
+        actual = self.data.get_daily_change_of_deaths(ragged, engine='numpy')
+        self.assertTrue(expected.equals(actual))
+
+    def test_incremental_daily_change_ripples_correction(self):
+        full_change = self.data.get_daily_change_of_deaths(self.total_deaths_df)
+
+        # Row 8 is Australia on 2020-01-15, between rows 4 (2020-01-04) and 12 (2020-02-01)
+        new_totals_df = self.total_deaths_df.copy()
+        new_totals_df.loc[8, 'deaths'] = new_totals_df.loc[8, 'deaths'] + 2
+        expected = self.data.get_daily_change_of_deaths(new_totals_df)
+
+        changed_df = new_totals_df.loc[[8]]
+        stored_df = self.total_deaths_df.loc[[4, 12]]
+        actual = self.data.get_daily_change_of_deaths_incremental(changed_df, stored_df)
+
+        self.assertListEqual(list(actual['date']), [pd.to_datetime('2020-01-15'), pd.to_datetime('2020-02-01')])
+        self.assertListEqual(list(actual['deaths_change']), list(expected.loc[[8, 12], 'deaths_change']))
+        self.assertNotEqual(list(actual['deaths_change']), list(full_change.loc[[8, 12], 'deaths_change']))
+
+    def test_streaming_csv_matches_in_memory_transform(self):
+        csv_file = io.StringIO(self.csv_df.to_csv(index=False))
+
+        for chunksize, date_chunksize in [(None, None), (2, None), (4, 2), (1, 1)]:
+            countries, dates, matrix = self.data.read_deaths_matrix(csv_file, chunksize=chunksize,
+                                                                    date_chunksize=date_chunksize, value_dtype='int64')
+            actual = self.data.matrix_to_frame(countries, dates, matrix, value_name='deaths')
+            self.assertTrue(self.total_deaths_df.equals(actual),
+                            'Chunk sizes ' + str((chunksize, date_chunksize)) + ' must not change the result')
+
+    def test_streaming_csv_reads_only_dates_after_watermark(self):
+        csv_file = io.StringIO(self.csv_df.to_csv(index=False))
+
+        countries, dates, matrix = self.data.read_deaths_matrix(csv_file, since=pd.to_datetime('1/15/2020'),
+                                                                chunksize=3)
+        self.assertListEqual(list(dates), [pd.to_datetime('2/1/2020'), pd.to_datetime('2/13/2020')])
+        self.assertEqual(matrix.shape, (4, 2))
+
+        expected = self.total_deaths_df[self.total_deaths_df['date'] > pd.to_datetime('1/15/2020')]
+        actual = self.data.matrix_to_frame(countries, dates, matrix, value_name='deaths')
+        self.assertListEqual(list(actual['deaths']), list(expected['deaths']))
+
+        countries, dates, matrix = self.data.read_deaths_matrix(csv_file, since=pd.to_datetime('2/13/2020'))
+        self.assertEqual(matrix.shape, (4, 0), "No new dates after the watermark")
+
+    def test_streaming_csv_reads_blank_cells_as_zero(self):
+        csv_file = io.StringIO('Province/State,Country/Region,Lat,Long,1/22/20,1/23/20\n'
+                               'A,Country1,0,0,1,\n'
+                               'B,Country1,0,0,,2\n'
+                               ',Country2,0,0,3,4\n')
+
+        for value_dtype in ['int32', 'uint16', 'float64']:
+            countries, dates, matrix = self.data.read_deaths_matrix(csv_file, chunksize=2, value_dtype=value_dtype)
+            self.assertListEqual(list(countries), ['Country1', 'Country2'])
+            self.assertListEqual(matrix.tolist(), [[1, 2], [3, 4]])
+            self.assertEqual(matrix.dtype, np.dtype(value_dtype), 'The matrix must keep the requested dtype')
+
+    def test_rolling_analytics_match_pandas_rolling(self):
+        rng = np.random.default_rng(0)
+        dates = pd.date_range('2020-01-22', periods=40, freq='D')
+        matrix = np.cumsum(rng.integers(0, 20, size=(3, 40)), axis=1)
+        totals_df = self.data.matrix_to_frame(np.array(['A', 'B', 'C'], dtype=object), dates, matrix, 'deaths')
+
+        countries, dates, matrix = self.data.frame_to_matrix(totals_df, 'deaths')
+        analytics_df = self.data.get_rolling_analytics(countries, dates, matrix)
+        self.assertListEqual(list(analytics_df.columns), ['country', 'date', 'deaths_avg_7', 'deaths_avg_14',
+                                                          'deaths_wow_growth', 'deaths_doubling_days'])
+
+        changes_df = self.data.get_daily_change_of_deaths(totals_df).sort_index()
+        by_country = changes_df.groupby('country')['deaths_change']
+        week = by_country.transform(lambda s: s.rolling(7).sum())
+        last_week = by_country.transform(lambda s: s.shift(7).rolling(7).sum())
+        week_ago = totals_df.groupby('country')['deaths'].shift(7)
+
+        np.testing.assert_allclose(analytics_df['deaths_avg_7'], week / 7)
+        np.testing.assert_allclose(analytics_df['deaths_avg_14'], by_country.transform(lambda s: s.rolling(14).mean()))
+        np.testing.assert_allclose(analytics_df['deaths_wow_growth'], week / last_week - 1)
+        np.testing.assert_allclose(analytics_df['deaths_doubling_days'],
+                                   7 * np.log(2) / np.log(totals_df['deaths'] / week_ago))
+
+        # Only the last days, calculated from the lookback dates before them
+        recent_df = self.data.get_rolling_analytics(countries, dates, matrix, since=dates[30])
+        expected_df = analytics_df[analytics_df['date'] > dates[30]].reset_index(drop=True)
+        self.assertTrue(expected_df.equals(recent_df))
@@ -1,4 +1,10 @@
+import io
+import multiprocessing
+import sqlite3
+import tempfile
 import unittest
+from datetime import datetime, timedelta, timezone
+import numpy as np
 import pandas as pd
 
 from db import Database
@@ -7,6 +13,18 @@ from datahandler import DataHandler
 import os
 
 
+def insert_from_process(db_name, barrier, offset):
+    """
+    Writes corrections of the dummy totals to a database file, started together with other processes by a barrier
+    """
+    totals_df = DataHandler().get_total_deaths_per_country_and_day(testutils.get_dummy_data())
+    with Database(db_name) as db:
+        barrier.wait()
+        for i in range(10):
+            totals_df['deaths'] += offset + i
+            db.insert_to_deaths_total_table(totals_df)
+
+
 class TestDatabase(unittest.TestCase):
 
     @classmethod
@@ -20,6 +38,10 @@ class TestDatabase(unittest.TestCase):
         cls.total_deaths_table = 'deaths_total'
         cls.death_change_python_table = 'deaths_change_python'
 
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.db.close()
+
     def setUp(self) -> None:
         # Start with a clean slate
         self.total_deaths_df = DataHandler().get_total_deaths_per_country_and_day(self.csv_df)
@@ -28,12 +50,80 @@ class TestDatabase(unittest.TestCase):
             cursor = con.cursor()
             cursor.execute('DROP TABLE IF EXISTS ' + self.total_deaths_table + ';')
             cursor.execute('DROP TABLE IF EXISTS ' + self.death_change_python_table + ';')
+            cursor.execute('DROP TABLE IF EXISTS sync_watermark;')
+            cursor.execute('DROP TABLE IF EXISTS deaths_change_sql;')
+            cursor.execute('DROP TABLE IF EXISTS deaths_analytics;')
+            cursor.execute('DROP TABLE IF EXISTS deaths_total_revisions;')
+            cursor.execute('DROP TABLE IF EXISTS deaths_total_ingests;')
+            cursor.execute('DROP TABLE IF EXISTS deaths_total_ingest_times;')
             con.commit()
 
     def test_create_connection(self):
         con = self.db.create_connection()
         self.assertIsNotNone(con, "Database connection")
 
+    def test_long_lived_connection_pragmas(self):
+        self.assertIs(self.db.get_connection(), self.db.get_connection(), "The writer connection must be reused")
+        self.assertEqual(self.db.execute_query('PRAGMA journal_mode;'), [('wal',)])
+
+    def test_concurrent_writer_processes_wait_for_the_lock(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_name = os.path.join(tmp_dir, 'Shared.db')
+            with Database(db_name) as db:
+                db.create_total_deaths_table()
+
+            barrier = multiprocessing.Barrier(3)
+            processes = [multiprocessing.Process(target=insert_from_process, args=(db_name, barrier, offset))
+                         for offset in range(3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertListEqual([process.exitcode for process in processes], [0, 0, 0],
+                                 "A writer must wait for the lock instead of failing with 'database is locked'")
+
+            with Database(db_name) as db:
+                self.assertEqual(db.execute_query('SELECT COUNT(*) FROM deaths_total;'), [(20,)])
+
+    def test_reads_do_not_wait_for_another_writer(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_name = os.path.join(tmp_dir, 'Shared.db')
+            with Database(db_name) as writer, Database(db_name) as analyst:
+                writer.create_total_deaths_table()
+                writer.insert_to_deaths_total_table(self.total_deaths_df, incremental=True)
+                writer.mark_ingested(self.total_deaths_table, 'deaths.csv', 'abc')
+                writer.mark_backfilled(self.total_deaths_table, ['2020-01-22'])
+                analyst.pragmas['busy_timeout'] = 100
+
+                with writer.transaction() as con:
+                    con.execute('DELETE FROM ' + self.total_deaths_table + ';')
+                    self.assertEqual(analyst.execute_query('SELECT COUNT(*) FROM ' + self.total_deaths_table + ';'),
+                                     [(20,)], "A read sees the last committed rows while another connection writes")
+                    self.assertEqual(len(analyst.get_watermarks(self.total_deaths_table)), 4)
+                    self.assertEqual(analyst.get_ingested_hash(self.total_deaths_table), 'abc')
+                    self.assertEqual(len(analyst.get_backfilled_dates(self.total_deaths_table)), 1)
+                    self.assertEqual(len(analyst.get_neighbour_totals(self.total_deaths_df.head(2))), 2)
+
+    def test_transaction_rolls_back_on_error(self):
+        self.db.create_total_deaths_table()
+
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.insert_to_deaths_total_table(self.total_deaths_df)
+                raise RuntimeError('Sync failed')
+
+        row_count = self.db.execute_query('SELECT COUNT(*) FROM ' + self.total_deaths_table + ';')[0][0]
+        self.assertEqual(row_count, 0, "Nothing from a failed transaction may be committed")
+
+    def test_reader_sees_committed_rows(self):
+        self.db.create_total_deaths_table()
+        self.db.insert_to_deaths_total_table(self.total_deaths_df)
+
+        with self.db.reader() as con:
+            row_count = con.execute('SELECT COUNT(*) FROM ' + self.total_deaths_table + ';').fetchone()[0]
+            self.assertRaises(sqlite3.OperationalError, con.execute, 'DELETE FROM ' + self.total_deaths_table + ';')
+        self.assertEqual(row_count, len(self.total_deaths_df))
+
     def test_no_data_duplicates(self):
         self.db.create_total_deaths_table()
 
@@ -194,6 +284,392 @@ class TestDatabase(unittest.TestCase):
 
         self.assertIs(new_changed_rows, 0,"There should not be any changes to deaths_change_python table in the second run")
 
+    def test_bulk_upsert_counts_and_types(self):
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[0, 'deaths'] = new_df.loc[0, 'deaths'] + 1
+
+        # UPDATE ... FROM, and the ON CONFLICT upsert used before SQLite 3.33
+        default = self.db.update_from
+        self.addCleanup(setattr, self.db, 'update_from', default)
+        for update_from in [True, False]:
+            self.db.update_from = update_from
+            with self.db.transaction() as con:
+                con.execute('DROP TABLE IF EXISTS ' + self.total_deaths_table + ';')
+            self.db.create_total_deaths_table()
+            # A row already stored, so the new rows are not inserted directly into an empty table
+            self.db.bulk_upsert_to_table(starting_df.iloc[:1], self.total_deaths_table)
+
+            self.assertEqual(self.db.bulk_upsert_to_table(starting_df, self.total_deaths_table),
+                             (len(starting_df) - 1, 0))
+            self.assertEqual(self.db.bulk_upsert_to_table(new_df, self.total_deaths_table), (4, 1),
+                             "The latest date must be inserted and only the modified row updated")
+
+            types = self.db.execute_query('SELECT DISTINCT typeof(deaths) FROM ' + self.total_deaths_table + ';')
+            self.assertEqual(types, [('integer',)], "Deaths must be stored as integers")
+
+    def test_incremental_sync_inserts_only_new_dates(self):
+        self.db.create_total_deaths_table()
+
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.assertEqual(self.db.insert_to_deaths_total_table(starting_df, incremental=True), len(starting_df))
+
+        changed_rows = self.db.insert_to_deaths_total_table(self.total_deaths_df, incremental=True)
+        self.assertEqual(changed_rows, 4, "Only the rows of the latest date should be inserted")
+
+        total_rows = self.db.execute_query('SELECT COUNT(*) FROM ' + self.total_deaths_table)[0][0]
+        self.assertEqual(total_rows, len(self.total_deaths_df))
+
+        self.assertEqual(self.db.insert_to_deaths_total_table(self.total_deaths_df, incremental=True), 0,
+                         "A second sync of the same data must not change any rows")
+
+        watermarks = self.db.get_watermarks(self.total_deaths_table)
+        self.assertEqual(len(watermarks), 4)
+        self.assertTrue((watermarks['last_date'] == pd.to_datetime('2/13/2020')).all())
+
+    def test_incremental_sync_from_streamed_csv(self):
+        self.db.create_total_deaths_table()
+        self.assertIsNone(self.db.get_sync_start_date(self.total_deaths_table))
+
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.db.insert_to_deaths_total_table(starting_df, incremental=True)
+        since = self.db.get_sync_start_date(self.total_deaths_table)
+        self.assertEqual(since, pd.to_datetime('2/1/2020') - pd.Timedelta(days=self.db.revision_window))
+
+        dh = DataHandler()
+        csv_file = io.StringIO(self.csv_df.to_csv(index=False))
+        new_df = dh.matrix_to_frame(*dh.read_deaths_matrix(csv_file, since=since), value_name='deaths')
+        self.assertEqual(self.db.insert_to_deaths_total_table(new_df, incremental=True), 4)
+
+    def test_incremental_sync_updates_corrections_in_revision_window(self):
+        self.db.create_total_deaths_table()
+        self.db.insert_to_deaths_total_table(self.total_deaths_df, incremental=True)
+
+        # Row 16 (Australia, 2020-02-13) is in the revision window, row 0 (Australia, 2020-01-01) is not
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[16, 'deaths'] = new_df.loc[16, 'deaths'] + 3
+        new_df.loc[0, 'deaths'] = new_df.loc[0, 'deaths'] + 1
+
+        changed_rows = self.db.insert_to_deaths_total_table(new_df, incremental=True)
+        self.assertEqual(changed_rows, 1, "Only the correction inside the revision window should be updated")
+
+        deaths = self.db.execute_query('SELECT deaths FROM ' + self.total_deaths_table +
+                                       ' WHERE country="Australia" AND date="2020-02-13 00:00:00";')[0][0]
+        self.assertEqual(deaths, new_df.loc[16, 'deaths'])
+
+        self.assertEqual(self.db.insert_to_deaths_total_table(new_df, incremental=True), 0,
+                         "The stored checksum must follow the corrected data")
+
+    def test_incremental_update_of_daily_changes(self):
+        self.db.create_total_deaths_table()
+        self.db.create_deaths_change_python_table()
+
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.db.insert_to_deaths_total_table(starting_df)
+        self.db.insert_to_deaths_change_python_table(DataHandler().get_daily_change_of_deaths(starting_df))
+
+        # A new day and a retrospective correction of Sri Lanka on 2020-01-04
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[5, 'deaths'] = new_df.loc[5, 'deaths'] + 1
+        self.db.insert_to_deaths_total_table(new_df)
+        changed_rows = self.db.update_deaths_change_python_table()
+
+        self.assertEqual(changed_rows, 4 + 2, "The new day and the corrected day with its next day must change")
+
+        expected_df = DataHandler().get_daily_change_of_deaths(new_df).reset_index(drop=True)
+        expected_df['date'] = expected_df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.reader() as con:
+            result = pd.read_sql('SELECT * FROM ' + self.death_change_python_table + ' ORDER BY country, date;', con=con)
+        self.assertTrue(expected_df.equals(result))
+
+    def test_refresh_deaths_change_sql_table(self):
+        self.db.create_total_deaths_table()
+
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.db.insert_to_deaths_total_table(starting_df)
+        self.assertEqual(self.db.rebuild_deaths_change_sql_table(), len(starting_df))
+
+        # A new day and a retrospective correction of UK on 2020-01-15
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[10, 'deaths'] = new_df.loc[10, 'deaths'] - 1
+        self.db.insert_to_deaths_total_table(new_df)
+
+        changed_rows = self.db.refresh_deaths_change_sql_table()
+        self.assertEqual(changed_rows, 4 + 2, "The new day and the corrected day with its next day must change")
+
+        refreshed = self.db.execute_query('SELECT * FROM deaths_change_sql ORDER BY country, date;')
+        self.db.rebuild_deaths_change_sql_table()
+        rebuilt = self.db.execute_query('SELECT * FROM deaths_change_sql ORDER BY country, date;')
+        self.assertListEqual(refreshed, rebuilt, "A refresh must match a full LAG recalculation")
+
+    def test_incremental_update_of_analytics_table(self):
+        self.db.create_total_deaths_table()
+        dates = pd.date_range('2020-01-22', periods=30, freq='D')
+        countries = np.array(['Australia', 'Sri Lanka'], dtype=object)
+        matrix = np.cumsum(np.arange(60).reshape(2, 30) % 7, axis=1)
+        self.db.insert_to_deaths_total_table(DataHandler().matrix_to_frame(countries, dates, matrix, 'deaths'))
+        self.assertEqual(self.db.update_analytics_table(), 2 * 30)
+
+        # A correction on the last day changes only the analytics of that day
+        matrix[0, -1] += 5
+        self.db.insert_to_deaths_total_table(DataHandler().matrix_to_frame(countries, dates, matrix, 'deaths'))
+        self.assertEqual(self.db.update_analytics_table(since=dates[-5]), 1)
+
+        with self.db.reader() as con:
+            stored_df = pd.read_sql('SELECT * FROM deaths_analytics ORDER BY date, country;', con=con)
+        expected_df = DataHandler().get_rolling_analytics(countries, dates, matrix)
+        self.assertEqual(len(stored_df), len(expected_df))
+        np.testing.assert_allclose(stored_df['deaths_avg_7'], expected_df['deaths_avg_7'])
+        np.testing.assert_allclose(stored_df['deaths_doubling_days'], expected_df['deaths_doubling_days'])
+
+    def test_sql_ingest_matches_pandas_engine(self):
+        self.db.create_total_deaths_table()
+        self.db.create_deaths_change_python_table()
+        self.db.insert_to_deaths_total_table(self.total_deaths_df)
+        self.db.insert_to_deaths_change_python_table(DataHandler().get_daily_change_of_deaths(self.total_deaths_df))
+        expected_totals = self.db.execute_query('SELECT * FROM deaths_total ORDER BY country, date;')
+        expected_changes = self.db.execute_query('SELECT * FROM deaths_change_python ORDER BY country, date;')
+
+        with self.db.transaction() as con:
+            con.execute('DELETE FROM deaths_total;')
+            con.execute('DELETE FROM deaths_change_python;')
+        csv_file = io.StringIO(self.csv_df.to_csv(index=False))
+        self.assertEqual(self.db.ingest_csv(csv_file), (20, 20))
+        self.assertListEqual(self.db.execute_query('SELECT * FROM deaths_total ORDER BY country, date;'),
+                             expected_totals)
+        self.assertListEqual(self.db.execute_query('SELECT * FROM deaths_change_python ORDER BY country, date;'),
+                             expected_changes)
+
+        # A correction of UK on 2020-01-15 changes its total and the daily changes of that day and the next
+        corrected_df = self.csv_df.copy()
+        corrected_df.loc[5, '1/15/2020'] = 5
+        self.assertEqual(self.db.ingest_csv(io.StringIO(corrected_df.to_csv(index=False))), (1, 2))
+        self.assertEqual(self.db.ingest_csv(io.StringIO(corrected_df.to_csv(index=False))), (0, 0))
+        self.assertEqual(self.db.execute_query('PRAGMA temp_store;'), [(2,)], "temp_store is switched back after staging")
+
+    def test_revision_log_and_as_of_snapshots(self):
+        self.db.create_total_deaths_table()
+        self.db.create_revisions_table(self.total_deaths_table)
+        before_first = datetime.now(timezone.utc)
+
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.db.insert_to_deaths_total_table(starting_df)
+        first = datetime.now(timezone.utc)
+
+        # A new day and a retrospective correction of UK on 2020-01-15
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[10, 'deaths'] = new_df.loc[10, 'deaths'] - 1
+        self.db.insert_to_deaths_total_table(new_df)
+        second = datetime.now(timezone.utc)
+
+        # A country backfilled on a date that was published before
+        backfill_df = pd.DataFrame({'country': ['Atlantis'], 'date': [pd.to_datetime('1/4/2020')], 'deaths': [1]})
+        self.db.bulk_upsert_to_table(backfill_df, self.total_deaths_table)
+
+        log = self.db.execute_query('SELECT country, date, deaths FROM deaths_total_revisions ORDER BY country;')
+        self.assertListEqual(log, [('Atlantis', '2020-01-04 00:00:00', None),
+                                   ('UK', '2020-01-15 00:00:00', self.total_deaths_df.loc[10, 'deaths'])])
+
+        def expected(data_df):
+            return data_df.sort_values(['country', 'date']).reset_index(drop=True)
+
+        self.assertEqual(len(self.db.get_as_of(before_first)), 0)
+        self.assertTrue(expected(starting_df).equals(self.db.get_as_of(first)))
+        self.assertTrue(expected(new_df).equals(self.db.get_as_of(second)))
+        self.assertTrue(expected(pd.concat([new_df, backfill_df])).equals(self.db.get_as_of(datetime.now(timezone.utc))))
+
+        uk = self.db.get_as_of(first, country='UK', start_date='1/15/2020', end_date='1/15/2020')
+        self.assertListEqual(list(uk['deaths']), [self.total_deaths_df.loc[10, 'deaths']])
+
+    def test_ingest_times_cover_csv_ingest_and_row_upserts(self):
+        self.db.create_total_deaths_table()
+        self.db.create_ingest_times_table(self.total_deaths_table)
+        self.db.ingest_csv(io.StringIO(self.csv_df.to_csv(index=False)))
+        self.assertEqual(self.db.execute_query('SELECT COUNT(*) FROM deaths_total_ingest_times;'), [(20,)])
+
+        # A row written by another writer with a later ingest time
+        later = (datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        uk_df = pd.DataFrame({'country': ['UK'], 'date': [pd.to_datetime('1/15/2020')], 'deaths': [7]})
+        self.assertEqual(self.db.bulk_upsert_to_table(uk_df, self.total_deaths_table, ingested_at=later), (0, 1))
+
+        corrected_df = self.csv_df.copy()
+        corrected_df.loc[5, '1/15/2020'] = 5
+        self.assertEqual(self.db.ingest_csv(io.StringIO(corrected_df.to_csv(index=False)))[0], 0)
+        self.assertEqual(self.db.upsert_to_table(uk_df.assign(deaths=8), self.total_deaths_table), 0)
+        self.assertEqual(self.db.execute_query('SELECT deaths FROM deaths_total WHERE country=\'UK\' AND '
+                                               'date=\'2020-01-15 00:00:00\';'), [(7,)])
+
+    def test_revision_log_covers_csv_ingest_and_row_upserts(self):
+        self.db.create_total_deaths_table()
+        self.db.create_revisions_table(self.total_deaths_table)
+        self.db.ingest_csv(io.StringIO(self.csv_df.to_csv(index=False)))
+        first = datetime.now(timezone.utc)
+
+        corrected_df = self.csv_df.copy()
+        corrected_df.loc[5, '1/15/2020'] = 5
+        self.assertEqual(self.db.ingest_csv(io.StringIO(corrected_df.to_csv(index=False)))[0], 1)
+        second = datetime.now(timezone.utc)
+
+        upsert_df = pd.DataFrame({'country': ['US'], 'date': [pd.to_datetime('1/4/2020')], 'deaths': [9]})
+        self.assertEqual(self.db.upsert_to_table(upsert_df, self.total_deaths_table), 1)
+
+        log = self.db.execute_query('SELECT country, date FROM deaths_total_revisions ORDER BY country;')
+        self.assertListEqual(log, [('UK', '2020-01-15 00:00:00'), ('US', '2020-01-04 00:00:00')])
+
+        expected = self.total_deaths_df.sort_values(['country', 'date']).reset_index(drop=True)
+        self.assertTrue(expected.equals(self.db.get_as_of(first)))
+        uk = self.db.get_as_of(second, country='UK', start_date='1/15/2020', end_date='1/15/2020')
+        self.assertListEqual(list(uk['deaths']), [5])
+
+    def test_matrix_export_and_partial_reads(self):
+        self.db.create_total_deaths_table()
+        self.db.insert_to_deaths_total_table(self.total_deaths_df)
+        with tempfile.TemporaryDirectory() as export_dir:
+            self.db.export_matrix(export_dir=export_dir)
+            countries, dates, matrix = self.db.read_matrix(export_dir=export_dir)
+            self.assertIsInstance(matrix, np.memmap)
+            self.assertListEqual(list(countries), ['Australia', 'Sri Lanka', 'UK', 'US'])
+            expected = DataHandler().get_deaths_matrix(self.csv_df)
+            self.assertTrue(np.array_equal(matrix, expected[2]))
+
+            countries, dates, matrix = self.db.read_matrix(export_dir=export_dir, countries=['US', 'UK'],
+                                                           start_date='1/4/2020', end_date='2/1/2020')
+            self.assertListEqual(list(countries), ['US', 'UK'])
+            self.assertListEqual(list(dates), list(pd.to_datetime(['1/4/2020', '1/15/2020', '2/1/2020'])))
+            self.assertListEqual(matrix.tolist(), [[5, 10, 17], [1, 4, 6]])
+
+            with self.assertRaises(ValueError):
+                self.db.read_matrix(export_dir=export_dir, countries=['Atlantis'])
+
+    def test_cached_queries(self):
+        self.db.create_total_deaths_table()
+        self.db.create_deaths_change_python_table()
+        self.db.insert_to_deaths_total_table(self.total_deaths_df)
+        self.db.insert_to_deaths_change_python_table(DataHandler().get_daily_change_of_deaths(self.total_deaths_df))
+
+        series = self.db.get_country_series('US', start_date='2020-01-04')
+        self.assertListEqual(list(series.values), [5, 10, 17, 19])
+        self.assertEqual(series.index[0], pd.to_datetime('2020-01-04'))
+
+        hits = self.db.cache_hits
+        series[:] = 0  # Modifying a result must not change the cached one
+        self.assertListEqual(list(self.db.get_country_series('US', start_date='2020-01-04').values), [5, 10, 17, 19])
+        self.assertEqual(self.db.cache_hits, hits + 1)
+
+        self.assertListEqual(list(self.db.get_global_totals().values), [0, 7, 19, 29, 38])
+        self.assertEqual(len(self.db.get_date_range('2020-01-15', '2020-02-01')), 8)
+
+        top = self.db.get_top_countries(2)
+        self.assertListEqual(list(top['country']), ['Australia', 'Sri Lanka'])
+
+        # An upsert changes the data version, so the next query reads the new value
+        version = self.db.get_data_version()
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[19, 'deaths'] = 20
+        self.db.insert_to_deaths_total_table(new_df)
+        self.assertNotEqual(self.db.get_data_version(), version)
+        self.assertEqual(self.db.get_global_totals().iloc[-1], 39)
+
+    def test_data_version_follows_other_connections(self):
+        self.db.create_total_deaths_table()
+        version = self.db.get_data_version()
+
+        other = Database(self.db.db)
+        other.insert_to_deaths_total_table(self.total_deaths_df)
+        other.close()
+
+        self.assertNotEqual(self.db.get_data_version(), version)
+
+
+class TestCompactDatabase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = Database(':memory:', compact=True)
+        self.total_deaths_df = DataHandler().get_total_deaths_per_country_and_day(testutils.get_dummy_data())
+        self.db.create_total_deaths_table()
+        self.db.create_deaths_change_python_table()
+
+    def tearDown(self) -> None:
+        self.db.close()
+
+    def test_view_keeps_column_names_and_values(self):
+        starting_df = self.total_deaths_df[self.total_deaths_df['date'] != pd.to_datetime('2/13/2020')]
+        self.db.insert_to_deaths_total_table(starting_df)
+
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[1, 'deaths'] = new_df.loc[1, 'deaths'] + 1
+        self.assertEqual(self.db.insert_to_deaths_total_table(new_df), 4 + 1)
+
+        expected_df = new_df.sort_values(['country', 'date']).reset_index(drop=True)
+        expected_df['date'] = expected_df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.transaction() as con:
+            result = pd.read_sql('SELECT * FROM deaths_total ORDER BY country, date;', con=con)
+        self.assertTrue(expected_df.equals(result))
+
+    def test_compact_storage_and_dtypes(self):
+        self.db.insert_to_deaths_total_table(self.total_deaths_df)
+
+        self.assertEqual(self.db.execute_query('SELECT COUNT(*) FROM countries;')[0][0], 4)
+        self.assertEqual(self.db.execute_query('SELECT DISTINCT typeof(country_id), typeof(day) '
+                                               'FROM deaths_total_compact;'), [('integer', 'integer')])
+
+        compact_df = self.db.read_compact_table('deaths_total')
+        self.assertEqual(list(compact_df.dtypes.astype(str)), ['category', 'int32', 'int32'])
+
+        expected_df = DataHandler().get_compact_frame(self.total_deaths_df)
+        merged = expected_df.merge(compact_df, on=['country', 'day'], suffixes=('', '_db'))
+        self.assertEqual(len(merged), len(self.total_deaths_df))
+        self.assertTrue((merged['deaths'] == merged['deaths_db']).all())
+
+    def test_incremental_paths_through_view(self):
+        self.db.insert_to_deaths_total_table(self.total_deaths_df, incremental=True)
+        self.db.insert_to_deaths_change_python_table(DataHandler().get_daily_change_of_deaths(self.total_deaths_df))
+        self.db.rebuild_deaths_change_sql_table()
+
+        new_df = self.total_deaths_df.copy()
+        new_df.loc[13, 'deaths'] = new_df.loc[13, 'deaths'] + 2
+        self.assertEqual(self.db.insert_to_deaths_total_table(new_df, incremental=True), 1)
+        self.assertEqual(self.db.update_deaths_change_python_table(), 2)
+        self.assertEqual(self.db.refresh_deaths_change_sql_table(), 2)
+
+        python_changes = self.db.execute_query('SELECT * FROM deaths_change_python ORDER BY country, date;')
+        sql_changes = self.db.execute_query('SELECT * FROM deaths_change_sql ORDER BY country, date;')
+        self.assertListEqual(python_changes, sql_changes)
+
+    def test_key_lookups_use_the_compact_primary_key(self):
+        # Counts the SQLite virtual machine steps of each lookup, in the compact and in a regular database. A filter
+        # on the date text of the view scans every row, a lookup through (country_id, day) only the matching ones
+        regular = Database(':memory:')
+        self.addCleanup(regular.close)
+        totals_df = DataHandler().get_total_deaths_per_country_and_day(testutils.get_synthetic_data(50, 1, 200))
+        changed_df = totals_df.sample(20, random_state=0)
+        watermarks = pd.DataFrame({'country': changed_df['country'].values, 'last_date': changed_df['date'].values})
+
+        steps = {}
+        for db in (regular, self.db):
+            db.create_total_deaths_table()
+            db.insert_to_deaths_total_table(totals_df)
+            db.rebuild_deaths_change_sql_table()
+            lookups = {'refresh': lambda: db.refresh_deaths_change_sql_table(changed_df),
+                       'neighbours': lambda: db.get_neighbour_totals(changed_df),
+                       'windows': lambda: db._read_revision_windows(db.deaths_table, watermarks),
+                       'series': lambda: db.get_country_series('Country 00007', start_date='2020-03-01',
+                                                               end_date='2020-03-31')}
+            results = {}
+            for name, lookup in lookups.items():
+                counter = [0]
+                db.get_connection().set_progress_handler(lambda: counter.__setitem__(0, counter[0] + 1) or 0, 100)
+                results[name] = lookup()
+                db.get_connection().set_progress_handler(None, 100)
+                steps.setdefault(name, []).append(counter[0])
+
+            self.assertEqual(results['refresh'], 0)
+            self.assertEqual(len(results['neighbours']), 40)
+            self.assertEqual(len(results['windows']), 20 * 14)
+            self.assertEqual(len(results['series']), 31)
+
+        for name, (regular_steps, compact_steps) in steps.items():
+            self.assertLess(compact_steps, 3 * regular_steps + 10, name + ' must not scan the compact table')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from datahandler import DataHandler
+from fetcher import SnapshotCache
+import testutils
+
+
+class CsvHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the CSSE file server. Serves the server's csv content with an ETag and answers conditional requests
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        etag = '"' + hashlib.md5(self.server.content).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestSnapshotCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), CsvHandler)
+        cls.server.requests = 0
+        cls.url = 'http://127.0.0.1:' + str(cls.server.server_port) + '/time_series_covid19_deaths_global.csv'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self) -> None:
+        self.csv_df = testutils.get_dummy_data()
+        self.server.content = self.csv_df.to_csv(index=False).encode()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = SnapshotCache(self.tmp_dir.name)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_source_is_not_downloaded_again(self):
+        snapshot = self.cache.fetch(self.url)
+        self.assertEqual(snapshot.content_hash, hashlib.sha256(self.server.content).hexdigest())
+
+        requests = self.server.requests
+        again = self.cache.fetch(self.url)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(again, snapshot)
+
+    def test_changed_source_replaces_previous_objects(self):
+        previous = self.cache.fetch(self.url)
+        self.cache.load_matrix(previous)
+
+        self.csv_df.loc[0, '2/13/2020'] = 9
+        self.server.content = self.csv_df.to_csv(index=False).encode()
+        snapshot = self.cache.fetch(self.url)
+
+        self.assertEqual(snapshot.content_hash, hashlib.sha256(self.server.content).hexdigest())
+        self.assertListEqual(os.listdir(self.cache.objects_dir), [snapshot.content_hash + '.csv'],
+                             "Objects no url refers to are removed")
+
+    def test_matrix_sidecar(self):
+        snapshot = self.cache.fetch(self.url)
+        countries, dates, matrix = self.cache.load_matrix(snapshot)
+        self.assertTrue(os.path.exists(os.path.join(self.cache.objects_dir, snapshot.content_hash + '.npy')))
+
+        expected = DataHandler().get_deaths_matrix(self.csv_df)
+        self.assertListEqual(list(countries), list(expected[0]))
+        self.assertListEqual(list(dates), list(expected[1]))
+        self.assertTrue(np.array_equal(matrix, expected[2]))
+
+        # Served from the sidecar once it exists
+        os.remove(snapshot.path)
+        self.assertTrue(np.array_equal(self.cache.load_matrix(snapshot)[2], expected[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
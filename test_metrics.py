@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import unittest
+
+import metrics
+from datahandler import DataHandler
+from db import Database
+import testutils
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.csv_df = testutils.get_dummy_data()
+        self.db = Database(':memory:')
+        self.db.create_total_deaths_table()
+
+    def tearDown(self) -> None:
+        metrics.disable()
+        self.db.close()
+
+    def test_records_calls_rows_and_statements(self):
+        with metrics.recording(metrics.MemorySink()) as sink:
+            total_deaths_df = DataHandler().get_total_deaths_per_country_and_day(self.csv_df)
+            self.db.insert_to_deaths_total_table(total_deaths_df)
+
+        transform = [r for r in sink.records if r['method'] == 'get_total_deaths_per_country_and_day'][0]
+        self.assertEqual((transform['class'], transform['rows_in'], transform['rows_out']), ('DataHandler', 6, 20))
+        self.assertEqual(transform['sql_statements'], 0)
+        self.assertGreaterEqual(transform['wall_seconds'], 0)
+
+        insert = [r for r in sink.records if r['method'] == 'insert_to_deaths_total_table'][0]
+        self.assertEqual((insert['class'], insert['depth'], insert['rows_in']), ('Database', 0, 20))
+        self.assertGreater(insert['sql_statements'], 0)
+        nested = [r for r in sink.records if r['depth'] > 0]
+        self.assertTrue(nested, "Nested method calls are recorded too")
+        self.assertTrue(all(r['sql_statements'] <= insert['sql_statements'] for r in nested))
+
+    def test_disabled_restores_methods(self):
+        sink = metrics.MemorySink()
+        metrics.enable(sink)
+        self.assertTrue(hasattr(DataHandler.get_deaths_matrix, '__wrapped__'))
+        metrics.disable()
+
+        self.assertFalse(hasattr(DataHandler.get_deaths_matrix, '__wrapped__'))
+        self.assertFalse(hasattr(Database.insert_to_table, '__wrapped__'))
+        DataHandler().get_deaths_matrix(self.csv_df)
+        self.assertListEqual(sink.records, [])
+
+    def test_peak_memory_and_errors(self):
+        with metrics.recording(metrics.MemorySink(), trace_memory=True) as sink:
+            DataHandler().get_total_deaths_per_country_and_day(self.csv_df, engine='numpy')
+            with self.assertRaises(ValueError):
+                DataHandler().get_total_deaths_from_daily_report(self.csv_df, '2020-01-01')
+
+        transform = [r for r in sink.records if r['method'] == 'get_total_deaths_per_country_and_day'][0]
+        melt = [r for r in sink.records if r['method'] == 'matrix_to_frame'][0]
+        self.assertGreater(melt['peak_bytes'], 0)
+        self.assertGreaterEqual(transform['peak_bytes'], melt['peak_bytes'], "A peak includes the nested calls")
+        self.assertTrue(sink.records[-1]['error'].startswith('ValueError'))
+
+    def test_json_lines_sink(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metrics.jsonl')
+            with metrics.recording(metrics.JsonLinesSink(path)):
+                self.db.execute_query('SELECT 1;')
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual([r['method'] for r in records], ['get_connection', 'execute_query'])
+        self.assertEqual(records[-1]['sql_statements'], 2, "BEGIN and the query")
+
+
+if __name__ == '__main__':
+    unittest.main()
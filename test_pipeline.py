@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from datahandler import DataHandler
+from db import Database
+from fetcher import SnapshotCache
+from pipeline import Pipeline, Series
+import testutils
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv_df = testutils.get_dummy_data()
+
+        # A US style file, with county rows and a differently named country column
+        us_df = self.csv_df.rename(columns={'Province/State': 'Admin2', 'Country/Region': 'Country_Region'})
+        us_df['Country_Region'] = 'US'
+
+        self.series = [Series('deaths', 'deaths', self._write_csv('deaths.csv', self.csv_df)),
+                       Series('confirmed', 'confirmed', self._write_csv('confirmed.csv', self.csv_df)),
+                       Series('deaths_us', 'deaths', self._write_csv('deaths_us.csv', us_df))]
+        self.db = Database(os.path.join(self.tmp_dir.name, 'Pipeline.db'))
+
+    def tearDown(self) -> None:
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def _write_csv(self, name, csv_df):
+        path = os.path.join(self.tmp_dir.name, name)
+        csv_df.to_csv(path, index=False)
+        return path
+
+    def _read_table(self, table_name):
+        with self.db.reader() as con:
+            return pd.read_sql('SELECT * FROM ' + table_name + ' ORDER BY country, date;', con=con)
+
+    def _expected(self, csv_df, metric):
+        dh = DataHandler()
+        totals_df = dh.get_total_deaths_per_country_and_day(csv_df, metric=metric)
+        changes_df = dh.get_daily_change_of_deaths(totals_df, metric=metric)
+        for df in (totals_df, changes_df):
+            df.sort_values(['country', 'date'], inplace=True)
+            df.reset_index(drop=True, inplace=True)
+            df['date'] = df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        return totals_df, changes_df
+
+    def test_all_series_match_sequential_transform(self):
+        results = Pipeline(self.db, self.series, max_workers=2, block_size=2).run()
+        self.assertEqual(results['deaths'], (20, 20))
+        self.assertEqual(results['deaths_us'], (5, 5))
+
+        expected_totals, expected_changes = self._expected(self.csv_df, 'confirmed')
+        self.assertTrue(expected_totals.equals(self._read_table('confirmed_total')))
+        self.assertTrue(expected_changes.equals(self._read_table('confirmed_change_python')))
+
+        us_totals = self._read_table('deaths_us_total')
+        self.assertListEqual(list(us_totals['deaths']), [0, 7, 19, 29, 38])
+
+    def test_second_run_only_syncs_new_data(self):
+        Pipeline(self.db, self.series, max_workers=2).run()
+        results = Pipeline(self.db, self.series, max_workers=2, block_size=2).run()
+        self.assertEqual(results, {'deaths': (0, 0), 'confirmed': (0, 0), 'deaths_us': (0, 0)})
+
+        self.csv_df['2/20/2020'] = self.csv_df['2/13/2020'] + 1
+        self._write_csv('deaths.csv', self.csv_df)
+        results = Pipeline(self.db, self.series, max_workers=2, block_size=1).run()
+        self.assertEqual(results['deaths'], (4, 4))
+
+        expected_totals, expected_changes = self._expected(self.csv_df, 'deaths')
+        self.assertTrue(expected_totals.equals(self._read_table('deaths_total')))
+        self.assertTrue(expected_changes.equals(self._read_table('deaths_change_python')))
+
+
+    def test_cached_sources_are_synced_to_every_database(self):
+        cache = SnapshotCache(os.path.join(self.tmp_dir.name, 'cache'))
+        series = [Series(s.name, s.metric, 'file://' + s.source) for s in self.series]
+        results = Pipeline(self.db, series, max_workers=2, cache=cache).run()
+        self.assertEqual(results['deaths'], (20, 20))
+        self.assertEqual(Pipeline(self.db, series, max_workers=2, cache=cache).run()['deaths'], (0, 0))
+
+        # The content was ingested into the first database only
+        with Database(os.path.join(self.tmp_dir.name, 'Other.db')) as other:
+            self.assertEqual(Pipeline(other, series, max_workers=2, cache=cache).run(), results)
+
+        self.csv_df['2/20/2020'] = self.csv_df['2/13/2020'] + 1
+        self._write_csv('deaths.csv', self.csv_df)
+        results = Pipeline(self.db, series, max_workers=2, cache=cache).run()
+        self.assertEqual(results, {'deaths': (4, 4), 'confirmed': (0, 0), 'deaths_us': (0, 0)})
+
+        expected_totals, expected_changes = self._expected(self.csv_df, 'deaths')
+        self.assertTrue(expected_totals.equals(self._read_table('deaths_total')))
+        self.assertTrue(expected_changes.equals(self._read_table('deaths_change_python')))
+
+    def test_exports_are_refreshed_after_sync(self):
+        self.db.export_dir = os.path.join(self.tmp_dir.name, 'exports')
+        Pipeline(self.db, self.series[:1], max_workers=2).run()
+        countries, dates, matrix = self.db.read_matrix('deaths_total')
+        self.assertEqual(matrix.shape, (4, 5))
+
+        self.csv_df['2/20/2020'] = self.csv_df['2/13/2020'] + 1
+        self._write_csv('deaths.csv', self.csv_df)
+        Pipeline(self.db, self.series[:1], max_workers=2).run()
+
+        countries, dates, matrix = self.db.read_matrix('deaths_total')
+        self.assertEqual(dates[-1], pd.Timestamp('2020-02-20'))
+        self.assertTrue((DataHandler().get_deaths_matrix(self.csv_df)[2] == matrix).all())
+        changes = self.db.read_matrix('deaths_change_python', countries=['US'])[2]
+        self.assertListEqual(changes[0].tolist(), [0, 5, 5, 7, 2, 2])
+        self.assertEqual(len(os.listdir(self.db.export_dir)), 4, "Older matrix files are removed")
+
+if __name__ == '__main__':
+    unittest.main()
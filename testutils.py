@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -28,3 +29,56 @@ def get_dummy_change_data():
     expected_df['date'] = pd.to_datetime(expected_df['date'])
 
     return expected_df
+
+
+def get_synthetic_data(countries=100, provinces=3, dates=200, seed=0):
+    """
+    Generates a time series table with the layout of get_dummy_data at any size, for benchmarks
+
+    :param countries: Number of countries
+    :param provinces: Number of provinces per country. Countries have a single row with an empty province if 1
+    :param dates: Number of daily date columns, starting on 1/22/2020
+    :param seed: Seed of the random daily deaths
+    :return: DataFrame with countries * provinces rows of cumulative deaths
+    """
+    rng = np.random.default_rng(seed)
+    rows = countries * provinces
+    date_cols = [str(d.month) + '/' + str(d.day) + '/' + str(d.year % 100)
+                 for d in pd.date_range('2020-01-22', periods=dates, freq='D')]
+
+    if provinces == 1:
+        province_names = np.full(rows, '', dtype=object)
+    else:
+        province_names = np.array(['Province ' + str(i) for i in range(provinces)] * countries, dtype=object)
+    data = {
+        'Province/State': province_names,
+        'Country/Region': np.repeat(np.array(['Country ' + str(i).zfill(5) for i in range(countries)], dtype=object),
+                                    provinces),
+        'Lat': rng.uniform(-60, 60, rows).round(2),
+    }
+    deaths = np.cumsum(rng.poisson(3, size=(rows, dates)), axis=1)
+    return pd.concat([pd.DataFrame(data), pd.DataFrame(deaths, columns=date_cols)], axis=1)
+
+
+def get_corrected_data(csv_df, share=0.01, seed=0, window=None):
+    """
+    Applies retrospective corrections to a time series table, as CSSE does when a country revises its counts
+
+    :param csv_df: DataFrame from get_dummy_data or get_synthetic_data
+    :param share: Share of the (province, date) cells that are corrected
+    :param seed: Seed of the corrected cells and amounts
+    :param window: Number of trailing dates that are corrected, e.g. the revision window of an incremental sync. All
+        dates if None
+    :return: Corrected copy of csv_df
+    """
+    rng = np.random.default_rng(seed)
+    corrected_df = csv_df.copy()
+    date_cols = list(csv_df.columns.values[3:])
+    if window is not None:
+        date_cols = date_cols[max(len(date_cols) - window, 0):]
+    values = corrected_df[date_cols].to_numpy()
+
+    cells = rng.random(values.shape) < share
+    values[cells] += rng.integers(1, 10, size=int(cells.sum()))
+    corrected_df[date_cols] = values
+    return corrected_df